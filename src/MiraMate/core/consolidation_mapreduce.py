@@ -0,0 +1,122 @@
+"""
+分块 map-reduce 记忆整理
+- 缓存条目先按标签分组（每条归入其标签中在本批出现次数最多的一个），同一主题的条目放在相邻位置，
+  再按估算的 token 数装箱成若干块，每块不超过 MIRAMATE_CONSOLIDATION_CHUNK_TOKENS
+- map：各块并发调用整合链（并发数由调用方的信号量控制），单块失败只影响该块的条目
+- reduce：各块的整合结果再次按标签分组装箱，含多条结果的组交给同一整合链做最终去重；
+  reduce 失败时退回到未合并的分块结果，不丢数据
+- 每次调用记录输入 / 输出 token（模型返回 usage_metadata 时使用实际值，否则按文本估算）与耗时
+"""
+import asyncio
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from langchain_core.output_parsers import JsonOutputParser
+
+# 单块（一次模型调用）中待整合数据的 token 上限
+CONSOLIDATION_CHUNK_TOKENS = int(os.getenv("MIRAMATE_CONSOLIDATION_CHUNK_TOKENS", "3000"))
+# 空闲整理同时进行的模型调用数（所有阶段共用）
+CONSOLIDATION_PARALLEL = int(os.getenv("MIRAMATE_CONSOLIDATION_PARALLEL", "3"))
+
+_json_parser = JsonOutputParser()
+_encoding = None
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数：优先使用 tiktoken（cl100k_base），不可用时按中文每字约 1 token、其他字符每 4 个约 1 token 估算。"""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    wide = sum(1 for ch in text if ord(ch) > 0x2E7F)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def entry_tokens(entry: Any) -> int:
+    return estimate_tokens(json.dumps(entry, ensure_ascii=False))
+
+
+def plan_chunks(entries: List[Dict], max_tokens: Optional[int] = CONSOLIDATION_CHUNK_TOKENS) -> List[List[Dict]]:
+    """按标签分组后装箱；max_tokens 为 None 时整批作为一块。单条超过上限的条目独占一块。"""
+    if not entries:
+        return []
+    if not max_tokens:
+        return [list(entries)]
+    frequency = Counter(tag for e in entries for tag in set(e.get("tags") or []))
+    groups: Dict[str, List[Dict]] = defaultdict(list)
+    for e in entries:
+        tags = [t for t in e.get("tags") or [] if t]
+        # 出现次数相同时取条目自身靠前的标签
+        primary = max(tags, key=lambda t: (frequency[t], -tags.index(t))) if tags else ""
+        groups[primary].append(e)
+
+    chunks: List[List[Dict]] = []
+    current: List[Dict] = []
+    size = 0
+    # 大组先装，小组随后填充剩余空间；组内保持原有（时间）顺序
+    for _, members in sorted(groups.items(), key=lambda kv: -len(kv[1])):
+        for e in members:
+            tokens = entry_tokens(e)
+            if current and size + tokens > max_tokens:
+                chunks.append(current)
+                current, size = [], 0
+            current.append(e)
+            size += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+async def invoke_consolidation(prompt, llm_chain, inputs: Dict[str, Any], data_key: Optional[str]) -> Tuple[Any, Dict[str, Any]]:
+    """
+    调用 prompt | llm 并解析 JSON，返回 (结果, 开销)。
+    data_key 为 None 时返回整个 JSON 对象，否则返回其中的列表。
+    """
+    started = time.monotonic()
+    message = await llm_chain.ainvoke(inputs)
+    parsed = _json_parser.invoke(message)
+    result = parsed if data_key is None else (parsed or {}).get(data_key, []) or []
+    usage = getattr(message, "usage_metadata", None) or {}
+    cost = {
+        "input_tokens": usage.get("input_tokens"),
+        "output_tokens": usage.get("output_tokens"),
+        "estimated": not usage,
+        "seconds": round(time.monotonic() - started, 2),
+    }
+    if not usage:
+        cost["input_tokens"] = estimate_tokens(prompt.format(**inputs))
+        cost["output_tokens"] = estimate_tokens(getattr(message, "content", "") or "")
+    return result, cost
+
+
+async def reduce_items(items: List[Dict], call: Callable[[List[Dict]], Awaitable[Tuple[List[Dict], Dict[str, Any]]]],
+                       max_tokens: Optional[int] = CONSOLIDATION_CHUNK_TOKENS) -> Tuple[List[Dict], List[Dict[str, Any]]]:
+    """
+    reduce：把各块的整合结果按标签重新分组，多条结果的组再整合一次以去除跨块重复。
+    返回 (最终结果, 各次调用的开销)。单组失败时保留该组的原结果。
+    """
+    groups = plan_chunks(items, max_tokens)
+
+    async def _reduce(group: List[Dict]):
+        if len(group) < 2:
+            return group, None
+        try:
+            return await call(group)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[IdleProcessor] ⚠️ 合并去重失败，保留分块结果: {e}")
+            return group, None
+
+    results = await asyncio.gather(*(_reduce(g) for g in groups))
+    merged = [item for group_items, _ in results for item in group_items]
+    costs = [cost for _, cost in results if cost]
+    return merged, costs
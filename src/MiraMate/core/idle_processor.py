@@ -1,14 +1,38 @@
-import threading
+"""
+空闲记忆整理
+- IdleProcessor 是运行在事件循环中的调度器：由互动信号与缓存写入通知唤醒，其余时间只睡到下一个到期时间点，
+  不再每 60 秒轮询一次缓存文件
+- 触发条件：空闲超过 idle_threshold 秒且存在缓存；或缓存条目数达到 MIRAMATE_IDLE_CACHE_THRESHOLD
+  且距离上次互动已超过 MIRAMATE_IDLE_CACHE_QUIET_SECONDS 秒
+- 事实 / 偏好 / 画像 / 重要事件几个阶段互不依赖，使用 ainvoke 并发执行；事实与偏好缓存按标签和 token 上限分块整合
+  后再合并去重（见 consolidation_mapreduce），模型调用总并发由 MIRAMATE_CONSOLIDATION_PARALLEL 限制
+- 用户重新活跃时立即取消正在进行的整理，把模型额度让给实时对话；各阶段以检查点方式执行
+  （见 consolidation_checkpoint），被取消或崩溃后下一次整理从检查点继续，已完成的模型调用与写入不会重复
+"""
+import asyncio
+import hashlib
+import os
 import time
 import json
-from typing import Dict, List, Any
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
 
 from MiraMate.modules.llms import main_llm
 from MiraMate.modules.memory_system import memory_system
+from MiraMate.modules.async_runtime import run_blocking
+from MiraMate.modules.shared_state import get_shared_state
+from MiraMate.core.consolidation_mapreduce import (
+    CONSOLIDATION_CHUNK_TOKENS, CONSOLIDATION_PARALLEL, entry_tokens, invoke_consolidation, plan_chunks, reduce_items,
+)
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
 
-# TODO：后面要把临时关注事件也加入空闲处理，解决高频发生的临时关注事件无法及时删除的问题。
+# 缓存条目数达到该值时，不必等满空闲阈值，只需短暂安静即可整理
+IDLE_CACHE_THRESHOLD = int(os.getenv("MIRAMATE_IDLE_CACHE_THRESHOLD", "50"))
+# 按缓存条目数触发时要求的最短安静时长（秒），避免在连续对话中途抢占主模型
+IDLE_CACHE_QUIET_SECONDS = float(os.getenv("MIRAMATE_IDLE_CACHE_QUIET_SECONDS", "60"))
+# 多进程部署时，未运行 IdleProcessor 的 worker 通过该频道转发互动信号
+USER_ACTIVITY_CHANNEL = "user_activity"
 
 # --- 1. 创建一个通用的Prompt生成函数以减少重复代码 ---
 def create_consolidation_prompt(task_description: str, data_key: str, output_format: str) -> ChatPromptTemplate:
@@ -56,7 +80,8 @@ fact_prompt = create_consolidation_prompt(
     data_key="consolidated_facts",
     output_format='{"content": "整合后的事实陈述。", "tags": ["相关标签"], "confidence": 1.0, "source": "事实来源"}'
 )
-fact_consolidation_chain = fact_prompt | main_llm | JsonOutputParser()
+fact_consolidation_llm = fact_prompt | main_llm
+fact_consolidation_chain = fact_consolidation_llm | JsonOutputParser()
 
 # b. 偏好整合链
 preference_prompt = create_consolidation_prompt(
@@ -64,7 +89,8 @@ preference_prompt = create_consolidation_prompt(
     data_key="consolidated_preferences",
     output_format='{"content": "整合后的用户偏好。", "type": "偏好类型", "tags": ["相关标签"], "confidence": 0.9, "source": "偏好来源"}'
 )
-preference_consolidation_chain = preference_prompt | main_llm | JsonOutputParser()
+preference_consolidation_llm = preference_prompt | main_llm
+preference_consolidation_chain = preference_consolidation_llm | JsonOutputParser()
 
 # c. 画像更新整合链 (这个稍微特殊，输出不是列表)
 # TODO；优化用户画像的处理，减少冗余
@@ -106,7 +132,8 @@ profile_prompt = ChatPromptTemplate.from_template("""# 指令
 }}
 # 开始分析并生成最终的画像更新JSON:
 """)
-profile_consolidation_chain = profile_prompt | main_llm | JsonOutputParser()
+profile_consolidation_llm = profile_prompt | main_llm
+profile_consolidation_chain = profile_consolidation_llm | JsonOutputParser()
 
 
 # --- d. 重要事件识别链 ---
@@ -189,136 +216,473 @@ TEMP_FOCUS_CLEAN_PROMPT = ChatPromptTemplate.from_template(
 )
 temp_focus_clean_chain = TEMP_FOCUS_CLEAN_PROMPT | main_llm | JsonOutputParser()
 
+def _fingerprint(*inputs: Any) -> str:
+    return hashlib.sha1(json.dumps(inputs, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _commit_checkpoint(stage: str, kind: Optional[str], checkpoint: Dict[str, Any], apply: Callable[[Any, str], None]):
+    """
+    （在线程池中执行）从检查点记录的进度开始逐条写入，每条使用 "<job_id>_<序号>" 派生的确定性 ID，
+    写入后推进进度；全部完成后删除本批缓存条目并移除检查点。
+    写入失败时抛出异常并保留检查点，下一次整理从失败的条目继续；模型输出格式不对的条目直接跳过。
+    """
+    checkpoints = memory_system.consolidation_checkpoints
+    items = checkpoint["items"]
+    for i in range(checkpoint.get("committed", 0), len(items)):
+        try:
+            apply(items[i], f"{checkpoint['job_id']}_{i}")
+        except (KeyError, TypeError) as e:
+            print(f"[IdleProcessor] ⚠️ 跳过格式不正确的整理结果: {e}")
+        checkpoint["committed"] = i + 1
+        checkpoints.save(stage, checkpoint)
+    if "cache_ids" in checkpoint:
+        memory_system.finish_consolidation(stage, kind, checkpoint["cache_ids"])
+
+
 class IdleProcessor:
-    def __init__(self, idle_threshold_seconds: int = 1200):
+    def __init__(self, idle_threshold_seconds: int = 1200,
+                 cache_threshold: int = IDLE_CACHE_THRESHOLD,
+                 quiet_seconds: float = IDLE_CACHE_QUIET_SECONDS):
         self.idle_threshold = idle_threshold_seconds
+        self.cache_threshold = max(1, cache_threshold)
+        self.quiet_seconds = quiet_seconds
         self.last_interaction_time = time.time()
-        self._stop_event = threading.Event()
-        self._thread = threading.Thread(target=self._worker_loop, daemon=True)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._job: Optional[asyncio.Task] = None
+        # 缓存条目数（启动时查询一次，之后由写入通知累加、每次整理后重新查询）
+        self._pending = 0
+        # 自上次互动以来是否已经整理过；互动时复位，避免同一段空闲内反复触发
+        self._handled = False
+        # 所有阶段共用的模型调用并发上限
+        self._llm_slots = asyncio.Semaphore(max(1, CONSOLIDATION_PARALLEL))
+        # 各阶段最近一次整理的分块进度与 token 开销
+        self._progress: Dict[str, Dict[str, Any]] = {}
+        self.stats: Dict[str, Any] = {
+            "runs": 0,
+            "cancelled": 0,
+            "resumed": 0,
+            "last_trigger": None,
+            "last_run_at": None,
+            "last_duration_s": None,
+        }
+
+    # --- 外部信号 ---
+    def _call_in_loop(self, callback: Callable, *args):
+        """在调度器所在的事件循环中执行回调（可从任意线程调用）。"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            callback(*args)
+        else:
+            loop.call_soon_threadsafe(callback, *args)
 
     def update_last_interaction_time(self):
         self.last_interaction_time = time.time()
         print("[IdleProcessor] 互动计时器已重置。")
+        self._call_in_loop(self._on_activity)
+
+    def _on_activity(self):
+        self._handled = False
+        if self._job is not None and not self._job.done():
+            print("[IdleProcessor] ⏸️ 用户重新活跃，取消正在进行的记忆整理。")
+            self._job.cancel()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _on_remote_activity(self, message: Dict[str, Any]):
+        """其他 worker 转发的互动信号；顺带刷新缓存计数（其他进程写入的缓存不会通知到本进程）。"""
+        if (message or {}).get("origin") == os.getpid():
+            return
+        self.last_interaction_time = time.time()
+        self._on_activity()
+        self._pending = await self._count_pending()
 
-    def _process_caches(self):
-        """核心处理逻辑：分步调用LLM整合各类缓存并写入数据库。"""
-        print("\n[IdleProcessor] 开始分步处理缓存记忆...")
-        
-        # --- a. 处理事实缓存 ---
-        facts_cache = memory_system.load_fact_cache()
-        if facts_cache:
-            try:
-                print("[IdleProcessor] 正在整合事实记忆...")
-                result = fact_consolidation_chain.invoke({"raw_cache_data": json.dumps(facts_cache, ensure_ascii=False)})
-                for fact in result.get("consolidated_facts", []):
-                    memory_system.save_fact_memory(content=fact['content'], tags=fact['tags'], confidence=fact.get('confidence', 1.0), source=fact.get('source', '未知来源'))
-                memory_system.clear_fact_cache()
-                print("[IdleProcessor] ✅ 事实记忆处理完成，缓存已清除。")
-            except Exception as e:
-                print(f"[IdleProcessor] ❌ 事实记忆处理失败: {e}")
+    def _on_cache_append(self, kind: str):
+        self._call_in_loop(self._bump_pending)
 
-        # --- b. 处理偏好缓存 ---
-        preferences_cache = memory_system.load_preference_cache()
-        if preferences_cache:
+    def _bump_pending(self):
+        self._pending += 1
+        if self._pending >= self.cache_threshold and self._wakeup is not None:
+            self._wakeup.set()
+
+    # --- 调度 ---
+    async def _count_pending(self) -> int:
+        try:
+            status = await run_blocking(memory_system.get_cache_status, False)
+            return sum(status.values())
+        except Exception as e:
+            print(f"[IdleProcessor] ⚠️ 读取缓存状态失败: {e}")
+            return 0
+
+    def _next_due(self):
+        """返回 (距离下次触发的秒数, 触发原因)；秒数为 None 表示只等待外部信号。"""
+        if self._handled:
+            return None, None
+        idle = time.time() - self.last_interaction_time
+        due, reason = self.idle_threshold - idle, "idle"
+        if self._pending >= self.cache_threshold and self.quiet_seconds - idle < due:
+            due, reason = self.quiet_seconds - idle, "cache_threshold"
+        return max(0.0, due), reason
+
+    async def _run(self):
+        print("[IdleProcessor] 调度器已启动。")
+        self._pending = await self._count_pending()
+        while True:
+            delay, reason = self._next_due()
+            if delay == 0:
+                await self._run_job(reason)
+                continue
+            self._wakeup.clear()
             try:
-                print("[IdleProcessor] 正在整合偏好记忆...")
-                result = preference_consolidation_chain.invoke({"raw_cache_data": json.dumps(preferences_cache, ensure_ascii=False)})
-                for pref in result.get("consolidated_preferences", []):
-                     memory_system.save_user_preference(content=pref['content'], preference_type=pref['type'], tags=pref['tags'])
-                memory_system.clear_preference_cache()
-                print("[IdleProcessor] ✅ 偏好记忆处理完成，缓存已清除。")
-            except Exception as e:
-                print(f"[IdleProcessor] ❌ 偏好记忆处理失败: {e}")
-        
-        # --- c. 处理画像更新缓存 ---
-        profile_updates_cache = memory_system.load_profile_cache()
-        if profile_updates_cache:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_job(self, reason: str):
+        self._handled = True
+        self._pending = await self._count_pending()
+        if not self._pending:
+            return
+        print(f"\n[IdleProcessor] 触发记忆整理（{reason}，缓存 {self._pending} 条）...")
+        started = time.monotonic()
+        self._job = asyncio.get_running_loop().create_task(self._process_caches(), name="IdleProcessorJob")
+        # 只等待整理任务结束，不把它的取消传播到调度器本身
+        await asyncio.wait({self._job})
+        job, self._job = self._job, None
+        if job.cancelled():
+            self.stats["cancelled"] += 1
+        elif job.exception() is not None:
+            print(f"[IdleProcessor] ❌ 记忆整理异常结束: {job.exception()}")
+        else:
+            self.stats["runs"] += 1
+            self.stats["last_trigger"] = reason
+            self.stats["last_run_at"] = time.time()
+            self.stats["last_duration_s"] = round(time.monotonic() - started, 2)
+        self._pending = await self._count_pending()
+
+    # --- 整理阶段 ---
+    async def _process_caches(self):
+        """核心处理逻辑：并发调用LLM整合各类缓存并写入数据库。"""
+        print("\n[IdleProcessor] 开始并发处理缓存记忆...")
+        await asyncio.gather(
+            self._consolidate_facts(),
+            self._consolidate_preferences(),
+            self._consolidate_profile(),
+            self._process_events(),
+        )
+        print("[IdleProcessor] 所有缓存处理流程结束。")
+
+    async def _cache_stage(self, stage: str, kind: str, label: str,
+                           load: Callable[[], List[Dict]],
+                           call: Callable[[List[Dict]], Awaitable[Tuple[List[Any], Dict[str, Any]]]],
+                           apply: Callable[[Any, str], None],
+                           chunk_tokens: Optional[int] = CONSOLIDATION_CHUNK_TOKENS,
+                           reduce: bool = True):
+        """
+        以检查点方式执行一个缓存整理阶段：
+        1. 存在提交阶段的检查点时直接从中继续写入（不再调用模型）
+        2. 否则先在本地预去重（与其他缓存条目或已有记忆近似重复的条目不交给模型），
+           再把剩余缓存按标签 / token 上限切块（map），各块并发调用模型，每完成一块就把结果登记进检查点；
+           中途被取消时，下次只补跑未完成的块
+        3. 多于一块时对各块结果做一次合并去重（reduce），连同成功块的缓存 ID 登记为提交阶段的检查点
+        4. 逐条以确定性 ID 写入记忆库并推进进度，最后只删除成功块的缓存条目并移除检查点；
+           失败块的条目留在缓存中，下一轮重新整理
+        """
+        checkpoints = memory_system.consolidation_checkpoints
+        checkpoint = await run_blocking(checkpoints.load, stage)
+        if checkpoint is not None and "items" in checkpoint:
+            self.stats["resumed"] += 1
+            print(f"[IdleProcessor] ↩️ 从检查点继续{label}（已提交 {checkpoint.get('committed', 0)}/{len(checkpoint['items'])}）...")
+            await run_blocking(_commit_checkpoint, stage, kind, checkpoint, apply)
+            print(f"[IdleProcessor] ✅ {label}检查点已提交，已清除该批 {len(checkpoint['cache_ids'])} 条缓存。")
+            checkpoint = None
+
+        entries = await run_blocking(load)
+        if checkpoint is not None:
+            # map 阶段的检查点：按登记的分块恢复（已被清除的条目跳过）
+            self.stats["resumed"] += 1
+            by_id = {e.get("id"): e for e in entries}
+            chunks = [[by_id[i] for i in ids if i in by_id] for ids in checkpoint["chunks"]]
+            print(f"[IdleProcessor] ↩️ 从检查点继续整合{label}（已完成 {len(checkpoint['partials'])}/{len(chunks)} 块）...")
+        else:
+            # 检查点之外的缓存（包括上一批整理期间新写入的条目）作为新的一批处理
+            if not entries:
+                return
+            # 本地预去重：与其他缓存条目或已有记忆重复的条目不交给模型，提交时随本批一起删除
+            novel, dedup = await run_blocking(memory_system.dedup_cache_entries, kind, entries)
+            if dedup["dropped_ids"]:
+                dropped = set(dedup["dropped_ids"])
+                saved_tokens = sum(entry_tokens(e) for e in entries if e.get("id") in dropped)
+                print(f"[IdleProcessor] 🧹 {label}预去重：{len(entries)} 条 → {len(novel)} 条（缓存内重复 {dedup['within_cache']}，"
+                      f"与已有记忆重复 {dedup['existing']}，约节省 {saved_tokens} tokens）")
+            if not novel:
+                await run_blocking(memory_system.finish_consolidation, stage, kind, dedup["dropped_ids"])
+                return
+            entries = novel
+            chunks = plan_chunks(entries, chunk_tokens)
+            checkpoint = {
+                "job_id": uuid4().hex[:12],
+                "chunks": [[e["id"] for e in chunk if e.get("id")] for chunk in chunks],
+                "dropped_ids": dedup["dropped_ids"],
+                "partials": {},
+                "costs": {},
+                "created_at": time.time(),
+            }
+            await run_blocking(checkpoints.save, stage, checkpoint)
+            print(f"[IdleProcessor] 正在整合{label}（{len(entries)} 条缓存，分 {len(chunks)} 块）...")
+
+        progress = self._progress[stage] = {
+            "label": label,
+            "chunks": len(chunks),
+            "done": len(checkpoint["partials"]),
+            "failed": 0,
+            "deduplicated": len(checkpoint.get("dropped_ids", [])),
+            "input_tokens": sum(c["input_tokens"] for c in checkpoint["costs"].values()),
+            "output_tokens": sum(c["output_tokens"] for c in checkpoint["costs"].values()),
+        }
+        save_lock = asyncio.Lock()
+
+        async def _map(index: int, chunk: List[Dict]):
+            key = str(index)
+            if key in checkpoint["partials"] or not chunk:
+                return
             try:
-                print("[IdleProcessor] 正在整合画像更新...")
-                current_profile = memory_system.load_user_profile() or {}
-                final_updates = profile_consolidation_chain.invoke({
-                    "raw_cache_data": json.dumps(profile_updates_cache, ensure_ascii=False),
-                    "user_profile": json.dumps(current_profile, ensure_ascii=False)
-                })
-                if final_updates:
-                    memory_system.update_user_profile(**final_updates)
-                memory_system.clear_profile_cache()
-                print("[IdleProcessor] ✅ 用户画像处理完成，缓存已清除。")
+                async with self._llm_slots:
+                    try:
+                        items, cost = await call(chunk)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as first_error:
+                        print(f"[IdleProcessor] ⚠️ {label}第 {index + 1} 块整合失败，重试一次: {first_error}")
+                        items, cost = await call(chunk)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                print(f"[IdlePocessor] ❌ 用户画像处理失败: {e}")
+                progress["failed"] += 1
+                print(f"[IdleProcessor] ❌ {label}第 {index + 1}/{len(chunks)} 块整合失败，{len(chunk)} 条缓存留待下一轮: {e}")
+                return
+            checkpoint["partials"][key] = items
+            checkpoint["costs"][key] = cost
+            progress["done"] += 1
+            progress["input_tokens"] += cost["input_tokens"]
+            progress["output_tokens"] += cost["output_tokens"]
+            print(f"[IdleProcessor] 📦 {label}第 {index + 1}/{len(chunks)} 块完成：{len(chunk)} 条 → {len(items)} 条，"
+                  f"输入 {'~' if cost['estimated'] else ''}{cost['input_tokens']} tokens，输出 {cost['output_tokens']} tokens，"
+                  f"耗时 {cost['seconds']}s（进度 {progress['done']}/{len(chunks)}）")
+            async with save_lock:
+                await run_blocking(checkpoints.save, stage, checkpoint)
+
+        await asyncio.gather(*(_map(i, chunk) for i, chunk in enumerate(chunks)))
+
+        done = sorted(checkpoint["partials"], key=int)
+        if not done:
+            print(f"[IdleProcessor] ❌ {label}所有分块均整合失败，缓存保留。")
+            await run_blocking(memory_system.finish_consolidation, stage, kind, checkpoint.get("dropped_ids"))
+            return
+        items = [item for key in done for item in checkpoint["partials"][key]]
+        if reduce and len(done) > 1 and len(items) > 1:
+            async def _reduce_call(group):
+                async with self._llm_slots:
+                    return await call(group)
+
+            before = len(items)
+            items, reduce_costs = await reduce_items(items, _reduce_call, chunk_tokens)
+            for cost in reduce_costs:
+                progress["input_tokens"] += cost["input_tokens"]
+                progress["output_tokens"] += cost["output_tokens"]
+            print(f"[IdleProcessor] 🔗 {label}合并去重：{before} 条 → {len(items)} 条（{len(reduce_costs)} 次调用）")
+
+        checkpoint = {
+            "job_id": checkpoint["job_id"],
+            "cache_ids": [i for key in done for i in checkpoint["chunks"][int(key)]] + checkpoint.get("dropped_ids", []),
+            "items": items,
+            "committed": 0,
+            "created_at": checkpoint["created_at"],
+        }
+        await run_blocking(checkpoints.save, stage, checkpoint)
+        await run_blocking(_commit_checkpoint, stage, kind, checkpoint, apply)
+        print(f"[IdleProcessor] ✅ {label}处理完成，已清除本批 {len(checkpoint['cache_ids'])} 条缓存"
+              f"（共 {progress['input_tokens']} 输入 / {progress['output_tokens']} 输出 tokens）。")
+
+    async def _consolidate_facts(self):
+        async def call(entries):
+            inputs = {"raw_cache_data": json.dumps(entries, ensure_ascii=False)}
+            return await invoke_consolidation(fact_prompt, fact_consolidation_llm, inputs, "consolidated_facts")
+
+        def apply(fact, key):
+            saved = memory_system.upsert_fact_memory(content=fact['content'], tags=fact['tags'], confidence=fact.get('confidence', 1.0),
+                                                     source=fact.get('source', '未知来源'), memory_id=f"fact_{key}")
+            if saved is None:
+                raise RuntimeError("写入事实记忆失败")
 
+        try:
+            await self._cache_stage("fact", "fact", "事实记忆", memory_system.load_fact_cache, call, apply)
+        except Exception as e:
+            print(f"[IdleProcessor] ❌ 事实记忆处理失败: {e}")
+
+    async def _consolidate_preferences(self):
+        async def call(entries):
+            inputs = {"raw_cache_data": json.dumps(entries, ensure_ascii=False)}
+            return await invoke_consolidation(preference_prompt, preference_consolidation_llm, inputs, "consolidated_preferences")
+
+        def apply(pref, key):
+            saved = memory_system.upsert_user_preference(content=pref['content'], preference_type=pref['type'], tags=pref['tags'],
+                                                         memory_id=f"preference_{key}")
+            if saved is None:
+                raise RuntimeError("写入偏好记忆失败")
 
-        # --- d. 处理重要事件识别 ---
         try:
-            print("[IdleProcessor] 正在分析是否存在新的重要事件...")
-            # 从数据库和文件中获取所需信息
-            recent_dialogues = memory_system.get_recent_dialogs(limit=5) # 获取最近10条对话作为上下文
-            temp_focus_events = memory_system.get_active_focus_events()
+            await self._cache_stage("preference", "preference", "偏好记忆", memory_system.load_preference_cache, call, apply)
+        except Exception as e:
+            print(f"[IdleProcessor] ❌ 偏好记忆处理失败: {e}")
+
+    async def _consolidate_profile(self):
+        async def call(entries):
+            current_profile = await run_blocking(memory_system.load_user_profile) or {}
+            inputs = {
+                "raw_cache_data": json.dumps(entries, ensure_ascii=False),
+                "user_profile": json.dumps(current_profile, ensure_ascii=False)
+            }
+            final_updates, cost = await invoke_consolidation(profile_prompt, profile_consolidation_llm, inputs, None)
+            return ([final_updates] if final_updates else []), cost
+
+        def apply(updates, key):
+            # 画像字段更新本身是幂等的，重放同一检查点只会写入相同的值
+            memory_system.update_user_profile(**updates)
 
+        try:
+            # 画像更新需要参照完整的当前画像并整体产出 always_remember，不分块
+            await self._cache_stage("profile", "profile", "用户画像", memory_system.load_profile_cache, call, apply,
+                                    chunk_tokens=None, reduce=False)
+        except Exception as e:
+            print(f"[IdleProcessor] ❌ 用户画像处理失败: {e}")
+
+    async def _process_events(self):
+        """
+        重要事件识别与临时关注事件清理：两者读取同一批对话，按顺序执行。
+        两者都不消费缓存，因此以输入指纹作为水位：输入与上次完成时相同则跳过，空闲整理反复触发时
+        不会对同一批对话重复识别出相同的重要事件。
+        """
+        checkpoints = memory_system.consolidation_checkpoints
+        recent_dialogues = await run_blocking(memory_system.get_recent_dialogs, 5)
+        temp_focus_events = await run_blocking(memory_system.get_active_focus_events)
+        fingerprint = _fingerprint(recent_dialogues, temp_focus_events)
+
+        # --- d. 处理重要事件识别 ---
+        try:
+            checkpoint = await run_blocking(checkpoints.load, "important_events") or {}
+            if "items" in checkpoint:
+                self.stats["resumed"] += 1
+                print("[IdleProcessor] ↩️ 从检查点继续保存重要事件...")
+            elif checkpoint.get("fingerprint") == fingerprint:
+                checkpoint = None
+                print("[IdleProcessor] 对话与关注事件自上次分析后没有变化，跳过重要事件识别。")
             # 仅在有内容可分析时才调用LLM
-            if recent_dialogues or temp_focus_events:
-                result = important_event_identification_chain.invoke({
-                    "recent_dialogues": json.dumps(recent_dialogues, ensure_ascii=False, indent=2),
-                    "temp_focus_events": json.dumps(temp_focus_events, ensure_ascii=False, indent=2)
-                })
-                
-                identified_events = result.get("identified_important_events", [])
+            elif recent_dialogues or temp_focus_events:
+                print("[IdleProcessor] 正在分析是否存在新的重要事件...")
+                async with self._llm_slots:
+                    result = await important_event_identification_chain.ainvoke({
+                        "recent_dialogues": json.dumps(recent_dialogues, ensure_ascii=False, indent=2),
+                        "temp_focus_events": json.dumps(temp_focus_events, ensure_ascii=False, indent=2)
+                    })
+                checkpoint = {
+                    "job_id": uuid4().hex[:12],
+                    "fingerprint": fingerprint,
+                    "items": result.get("identified_important_events", []),
+                    "committed": 0,
+                    "created_at": time.time(),
+                }
+                await run_blocking(checkpoints.save, "important_events", checkpoint)
+            else:
+                checkpoint = None
+                print("[IdleProcessor] 无可供分析的对话或关注事件，跳过重要事件识别。")
+
+            if checkpoint:
+                identified_events = checkpoint["items"]
                 if identified_events:
                     print(f"[IdleProcessor] ✅ 识别到 {len(identified_events)} 个新的重要事件，正在存入记忆库...")
-                    for event in identified_events:
-                        memory_system.save_important_event(**event)
                 else:
                     print("[IdleProcessor] 未发现新的重要事件。")
-            else:
-                print("[IdleProcessor] 无可供分析的对话或关注事件，跳过重要事件识别。")
+
+                def apply(event, key):
+                    if memory_system.save_important_event(**event, memory_id=f"event_{key}") is None:
+                        raise RuntimeError("写入重要事件失败")
+
+                await run_blocking(_commit_checkpoint, "important_events", None, checkpoint, apply)
+                # 完成后只保留输入指纹作为水位
+                await run_blocking(checkpoints.save, "important_events", {"fingerprint": checkpoint["fingerprint"]})
         except Exception as e:
             print(f"[IdleProcessor] ❌ 重要事件识别失败: {e}")
 
         # --- e. 清理已完成/不再需要的临时关注事件 ---
         try:
-            # 仅在存在关注事件时尝试清理
-            existing_temp_events = memory_system.get_active_focus_events()
-            if existing_temp_events:
+            # 仅在存在关注事件、且输入自上次判定后有变化时尝试清理（按 ID 删除本身是幂等的）
+            watermark = await run_blocking(checkpoints.load, "temp_focus_clean") or {}
+            if temp_focus_events and watermark.get("fingerprint") != fingerprint:
                 print("[IdleProcessor] 正在判定需要删除的临时关注事件...")
-                recent_dialogues = memory_system.get_recent_dialogs(limit=5)
-                result = temp_focus_clean_chain.invoke({
-                    "recent_dialogues": json.dumps(recent_dialogues, ensure_ascii=False, indent=2),
-                    "temp_focus_events": json.dumps(existing_temp_events, ensure_ascii=False, indent=2)
-                })
+                async with self._llm_slots:
+                    result = await temp_focus_clean_chain.ainvoke({
+                        "recent_dialogues": json.dumps(recent_dialogues, ensure_ascii=False, indent=2),
+                        "temp_focus_events": json.dumps(temp_focus_events, ensure_ascii=False, indent=2)
+                    })
                 to_delete_ids = result.get("to_delete_ids", []) or []
+
+                def _commit():
+                    removed = memory_system.delete_temp_focus_events_by_ids(to_delete_ids) if to_delete_ids else 0
+                    checkpoints.save("temp_focus_clean", {"fingerprint": fingerprint})
+                    return removed
+
+                removed = await run_blocking(_commit)
                 if to_delete_ids:
-                    removed = memory_system.delete_temp_focus_events_by_ids(to_delete_ids)
                     print(f"[IdleProcessor] ✅ 已删除 {removed} 条临时关注事件。")
                 else:
                     print("[IdleProcessor] 未发现需要删除的临时关注事件。")
         except Exception as e:
             print(f"[IdleProcessor] ❌ 清理临时关注事件失败: {e}")
 
-        print("[IdleProcessor] 所有缓存处理流程结束。")
-
-
-    def _worker_loop(self):
-        """后台线程的工作循环。"""
-        print("[IdleProcessor] 后台工作线程已启动。")
-        while not self._stop_event.is_set():
-            time_since_last_interaction = time.time() - self.last_interaction_time
-            
-            if time_since_last_interaction > self.idle_threshold:
-                # 检查是否有任何缓存需要处理
-                cache_status = memory_system.get_cache_status()
-                if sum(cache_status.values()) > 0:
-                    print(f"\n[IdleProcessor] 检测到空闲且有缓存数据，触发记忆处理...")
-                    self._process_caches()
-                
-                # 无论是否处理，都重置计时器，避免CPU空转检查
-                self.update_last_interaction_time()
-            
-            self._stop_event.wait(60)
+    # --- 生命周期 ---
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
 
     def start(self):
-        self._thread.start()
+        """在当前事件循环中启动调度器（必须在事件循环内调用）。"""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        memory_system.add_cache_listener(self._on_cache_append)
+        state = get_shared_state()
+        if state.shared:
+            state.subscribe_async(USER_ACTIVITY_CHANNEL, self._on_remote_activity)
+        self._task = self._loop.create_task(self._run(), name="IdleProcessor")
 
     def stop(self):
-        self._stop_event.set()
-        self._thread.join()
-        print("[IdleProcessor] 后台工作线程已停止。")
\ No newline at end of file
+        memory_system.remove_cache_listener(self._on_cache_append)
+        for task in (self._job, self._task):
+            if task is not None:
+                self._call_in_loop(task.cancel)
+        self._task = self._job = None
+        print("[IdleProcessor] 调度器已停止。")
+
+    def snapshot(self) -> Dict[str, Any]:
+        delay, reason = self._next_due()
+        return {
+            **self.stats,
+            "running": self.running,
+            "consolidating": self._job is not None and not self._job.done(),
+            "pending_cache_entries": self._pending,
+            "cache_threshold": self.cache_threshold,
+            "idle_threshold_s": self.idle_threshold,
+            "quiet_s": self.quiet_seconds,
+            "next_trigger": reason,
+            "next_trigger_in_s": None if delay is None else round(delay, 1),
+            "progress": self._progress,
+        }
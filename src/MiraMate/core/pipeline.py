@@ -1,5 +1,6 @@
 from datetime import datetime
 import os
+import threading
 from typing import List
 from jinja2 import Environment, FileSystemLoader
 from langchain_core.runnables import RunnableLambda, RunnableParallel, RunnableConfig
@@ -15,6 +16,8 @@ from MiraMate.modules.status_system import get_status_summary
 from MiraMate.modules.TimeTokenMemory import CustomTokenMemory
 from MiraMate.modules.memory_cache import memory_cache
 from MiraMate.modules.settings import get_persona, get_project_root as _settings_project_root
+from MiraMate.modules.async_runtime import run_blocking
+from MiraMate.modules.shared_state import get_shared_state
 
 
 
@@ -97,6 +100,16 @@ JSON输出:
 understanding_chain = (understanding_prompt | small_llm | JsonOutputParser()).with_config(run_name="EnhancedUnderstandingChain")
 
 # --- 3. 最终链条的构建 ---
+def offloaded(func, name: str) -> RunnableLambda:
+    """
+    包装会阻塞的同步函数（文件读写、ChromaDB 检索、嵌入计算）：
+    同步调用路径不变，ainvoke / astream 时在专用线程池中执行，不阻塞事件循环。
+    """
+    async def _afunc(x):
+        return await run_blocking(func, x)
+    return RunnableLambda(func, afunc=_afunc, name=name)
+
+
 # a. 并行获取上下文的组件
 context_fetcher = RunnableParallel(
     understanding={
@@ -104,9 +117,9 @@ context_fetcher = RunnableParallel(
         "conversation_history": lambda x: format_history_for_understanding(x["history"]),
         "current_time": lambda _: format_natural_time(datetime.now())
     } | understanding_chain,
-    agent_state=lambda _: get_status_summary(),
-    user_profile=lambda _: memory_system.load_user_profile(),
-    focus_events=lambda _: memory_system.get_active_focus_events(),
+    agent_state=offloaded(lambda _: get_status_summary(), "FetchAgentState"),
+    user_profile=offloaded(lambda _: memory_system.load_user_profile(), "FetchUserProfile"),
+    focus_events=offloaded(lambda _: memory_system.get_active_focus_events(), "FetchFocusEvents"),
     user_input=lambda x: x["user_input"],
     history=lambda x: x["history"]
 ).with_config(run_name="ParallelContextFetching")
@@ -149,7 +162,11 @@ def retrieve_and_cache_memories(input_dict: dict, config: RunnableConfig) -> dic
         "current_time": format_natural_time(datetime.now())
     }
 
-retrieval_chain = RunnableLambda(retrieve_and_cache_memories).with_config(
+async def aretrieve_and_cache_memories(input_dict: dict, config: RunnableConfig) -> dict:
+    """retrieve_and_cache_memories 的异步版本：检索与缓存更新整体在专用线程池中执行。"""
+    return await run_blocking(retrieve_and_cache_memories, input_dict, config)
+
+retrieval_chain = RunnableLambda(retrieve_and_cache_memories, afunc=aretrieve_and_cache_memories).with_config(
     run_name="RetrievalAndCacheChain"
 )
 
@@ -180,18 +197,53 @@ core_chain = (
 
 # f. 使用 RunnableWithMessageHistory 为核心链添加记忆功能
 session_memories = {}
+_session_memories_lock = threading.Lock()
 
 def get_memory_for_session(session_id: str):
     """根据 session_id 获取或创建独立的记忆实例。"""
-    if session_id not in session_memories:
-        session_memories[session_id] = CustomTokenMemory(
-            llm_model_name="gpt-4o", # 可以从配置或环境变量读取
-            max_token_limit=100000,
-            retention_time=1800,
-            continuity_threshold=180,
-            min_conversation_to_keep=10
-        )
-    return session_memories[session_id]
+    with _session_memories_lock:
+        if session_id not in session_memories:
+            session_memories[session_id] = CustomTokenMemory(
+                llm_model_name="gpt-4o", # 可以从配置或环境变量读取
+                max_token_limit=100000,
+                retention_time=1800,
+                continuity_threshold=180,
+                min_conversation_to_keep=10
+            )
+        return session_memories[session_id]
+
+def drop_session(session_id: str):
+    """释放会话的对话记忆与检索缓存（会话长期空闲被回收时调用）。"""
+    with _session_memories_lock:
+        session_memories.pop(session_id, None)
+    memory_cache.drop_session(session_id)
+    state = get_shared_state()
+    if state.shared:
+        state.kv_delete("sessions", session_id)
+
+def restore_session(session_id: str):
+    """
+    多进程部署时，在回合开始前（已持有跨进程会话锁）用共享状态中的快照替换本进程的会话记忆与检索缓存，
+    从而接续其他 worker 处理过的回合。单进程部署时不做任何事。
+    """
+    state = get_shared_state()
+    if not state.shared:
+        return
+    snapshot = state.kv_get("sessions", session_id)
+    if snapshot is None:
+        return
+    get_memory_for_session(session_id).load_records(snapshot["history"])
+    memory_cache.import_session(session_id, snapshot["cache"])
+
+def persist_session(session_id: str):
+    """多进程部署时，在回合结束后把会话记忆与检索缓存写回共享状态。"""
+    state = get_shared_state()
+    if not state.shared:
+        return
+    state.kv_set("sessions", session_id, {
+        "history": get_memory_for_session(session_id).export_records(),
+        "cache": memory_cache.export_session(session_id),
+    })
 
 # 最终导出给 main.py 使用的、包含完整功能的链
 final_chain = RunnableWithMessageHistory(
@@ -73,6 +73,17 @@ class CustomTokenMemory(BaseChatMessageHistory):
         self.memory.clear()
         self.total_token_count = 0
 
+    # --- 序列化（多进程部署时在 worker 之间接续会话） ---
+
+    def export_records(self) -> List[Dict[str, Any]]:
+        """导出内部记录（消息文本、时间戳、token 数），可直接 JSON 序列化。"""
+        return [dict(item) for item in self.memory]
+
+    def load_records(self, records: List[Dict[str, Any]]) -> None:
+        """用导出的记录替换当前内容。"""
+        self.memory = deque(dict(item) for item in records)
+        self.total_token_count = sum(item["token_count"] for item in self.memory)
+
     # --- 内部辅助方法 ---
 
     def _add_message(self, message: BaseMessage, token_count: int) -> None:
@@ -0,0 +1,124 @@
+"""
+事件循环辅助：阻塞调用卸载与循环延迟监控
+- 对话管线中的同步调用（状态 / 画像文件读写、ChromaDB 检索与嵌入计算）统一交给专用线程池执行，
+  不再占用事件循环，一个用户的回合不会拖慢其他 WebSocket / SSE 连接
+- 专用线程池与 asyncio 默认线程池（asyncio.to_thread，启动预热等使用）相互隔离，大小由
+  MIRAMATE_BLOCKING_WORKERS 单独配置
+- LoopLagMonitor 周期性测量事件循环的调度延迟（期望唤醒时间与实际唤醒时间之差），用于验证并发对话下
+  事件循环仍保持响应，结果通过 /api/stats 暴露
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+BLOCKING_WORKERS = int(os.getenv("MIRAMATE_BLOCKING_WORKERS", str(min(16, (os.cpu_count() or 1) + 4))))
+# 循环延迟采样间隔与告警阈值（毫秒）
+LOOP_LAG_INTERVAL_MS = float(os.getenv("MIRAMATE_LOOP_LAG_INTERVAL_MS", "100"))
+LOOP_LAG_WARN_MS = float(os.getenv("MIRAMATE_LOOP_LAG_WARN_MS", "200"))
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_blocking_executor() -> ThreadPoolExecutor:
+    """管线阻塞调用专用的线程池（首次使用时创建）。"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="MiraMateBlocking")
+        return _executor
+
+
+async def run_blocking(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """在专用线程池中执行同步函数（携带当前 contextvars，LangChain 回调与追踪上下文不丢失）。"""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await loop.run_in_executor(get_blocking_executor(), call)
+
+
+def shutdown_blocking_executor(wait: bool = False):
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait, cancel_futures=True)
+
+
+class LoopLagMonitor:
+    """
+    事件循环延迟监控：每隔 interval 睡眠一次，实际唤醒时间超出预期的部分即为循环被阻塞的时长。
+    保留最近 window 个样本用于计算分位数。
+    """
+
+    def __init__(self, interval_ms: float = LOOP_LAG_INTERVAL_MS, warn_ms: float = LOOP_LAG_WARN_MS,
+                 window: int = 600):
+        self.interval = interval_ms / 1000.0
+        self.warn_ms = warn_ms
+        self._samples: deque = deque(maxlen=window)
+        self._task: Optional[asyncio.Task] = None
+        self.max_lag_ms = 0.0
+        self.slow_ticks = 0
+        self._last_warning = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """在当前事件循环中启动监控任务（幂等）。"""
+        if not self.running:
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="LoopLagMonitor")
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, (time.perf_counter() - expected) * 1000)
+            self._samples.append(lag_ms)
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            if lag_ms >= self.warn_ms:
+                self.slow_ticks += 1
+                now = time.monotonic()
+                # 限制告警频率，避免阻塞期间刷屏
+                if now - self._last_warning > 10:
+                    self._last_warning = now
+                    print(f"⚠️ 事件循环被阻塞 {lag_ms:.0f}ms（阈值 {self.warn_ms:.0f}ms）")
+
+    def snapshot(self) -> Dict[str, Any]:
+        samples = sorted(self._samples)
+
+        def _p(q: float) -> Optional[float]:
+            if not samples:
+                return None
+            return round(samples[min(len(samples) - 1, int(q * len(samples)))], 2)
+
+        return {
+            "running": self.running,
+            "interval_ms": self.interval * 1000,
+            "samples": len(samples),
+            "p50_ms": _p(0.5),
+            "p99_ms": _p(0.99),
+            "max_ms": round(self.max_lag_ms, 2),
+            "slow_ticks": self.slow_ticks,
+            "warn_ms": self.warn_ms,
+            "blocking_workers": BLOCKING_WORKERS,
+        }
+
+
+# 全局循环延迟监控实例（由 Web 服务在启动时开启）
+loop_lag_monitor = LoopLagMonitor()
@@ -0,0 +1,345 @@
+"""
+Web 聊天记录存储
+- 单进程（memory 共享状态后端）：记录默认持久化到分段追加日志（transcript_log），重启后仍可查询；
+  最近的记录同时保存在固定容量的环形缓冲中（紧凑元组），读取最新几页不访问磁盘
+- 每条记录有连续递增的序号 seq，分页支持两种方式：offset（兼容旧接口）与游标 cursor（下一页的起始 seq），
+  两者的读取成本都只与页大小有关，与记录总量无关
+- query() 额外支持按写入时间过滤（since / until，经稀疏索引二分定位）与全文检索（多个关键词同时出现在
+  用户消息或回复中）；检索在单次请求内最多检查 scan_limit 条记录，未找满一页时返回游标由客户端继续
+- MIRAMATE_HISTORY_PERSIST=0 时不落盘，只保留环形缓冲中的最近记录
+- 多进程（sqlite 共享状态后端）：沿用共享状态中的有界列表，各 worker 看到同一份记录
+"""
+import json
+import os
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from MiraMate.modules.settings import get_memory_dir
+from MiraMate.modules.shared_state import SharedStateBackend
+from MiraMate.modules.transcript_log import TranscriptLog
+
+HISTORY_PERSIST = os.getenv(
+    "MIRAMATE_HISTORY_PERSIST", os.getenv("MIRAMATE_HISTORY_SPILL", "1")
+).strip().lower() in ("1", "true", "yes", "on")
+HISTORY_DIR = os.getenv("MIRAMATE_HISTORY_DIR", os.path.join(get_memory_dir(), "transcripts"))
+HISTORY_SEGMENT_BYTES = int(float(os.getenv("MIRAMATE_HISTORY_SEGMENT_MB", "4")) * 1024 * 1024)
+# 单次检索最多检查的记录数
+HISTORY_SCAN_LIMIT = int(os.getenv("MIRAMATE_HISTORY_SCAN_LIMIT", "5000"))
+# 上一版本的单文件落盘路径（启动时迁移到分段日志）
+LEGACY_SPILL_PATH = os.path.join(get_memory_dir(), "chat_history.jsonl")
+# 聊天记录在共享状态后端中的列表名
+CHAT_HISTORY_LIST = "chat_history"
+
+_FIELDS = ("id", "user_message", "ai_response", "timestamp", "emotional_state", "session_id")
+
+
+def _pack(record: Dict[str, Any]) -> Tuple:
+    return tuple(record.get(field) for field in _FIELDS)
+
+
+def _unpack(packed: Tuple) -> Dict[str, Any]:
+    return dict(zip(_FIELDS, packed))
+
+
+class RingBuffer:
+    """固定容量的环形缓冲：写满后新元素覆盖最旧的元素。下标 0 为最旧的元素。"""
+
+    __slots__ = ("capacity", "_items", "_start", "_size")
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self._items: List[Any] = [None] * self.capacity
+        self._start = 0
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, item: Any):
+        if self._size < self.capacity:
+            self._items[(self._start + self._size) % self.capacity] = item
+            self._size += 1
+        else:
+            self._items[self._start] = item
+            self._start = (self._start + 1) % self.capacity
+
+    def get(self, index: int) -> Any:
+        if not 0 <= index < self._size:
+            raise IndexError(index)
+        return self._items[(self._start + index) % self.capacity]
+
+    def clear(self):
+        self._items = [None] * self.capacity
+        self._start = 0
+        self._size = 0
+
+
+def _to_epoch(value: Any) -> Optional[float]:
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return None
+    return float(value)
+
+
+def text_matcher(text: Optional[str]) -> Optional[Callable[[Dict[str, Any]], bool]]:
+    """全文检索：所有关键词（空白分隔，不区分大小写）都出现在用户消息或回复中。"""
+    terms = [term.lower() for term in (text or "").split()]
+    if not terms:
+        return None
+
+    def match(record: Dict[str, Any]) -> bool:
+        haystack = f"{record.get('user_message') or ''}\n{record.get('ai_response') or ''}".lower()
+        return all(term in haystack for term in terms)
+
+    return match
+
+
+class HistoryStore:
+    """聊天记录存储接口，记录为 ChatHistoryItem.model_dump(mode="json") 得到的字典。"""
+
+    name = "base"
+
+    def append(self, record: Dict[str, Any]):
+        raise NotImplementedError
+
+    def range(self, offset: int = 0, limit: int = 50, reverse: bool = True) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def query(self, cursor: Optional[int] = None, limit: int = 50, reverse: bool = True,
+              since: Optional[datetime] = None, until: Optional[datetime] = None, text: Optional[str] = None,
+              offset: int = 0, scan_limit: int = HISTORY_SCAN_LIMIT) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """
+        游标分页查询，返回 (记录列表, next_cursor)；next_cursor 为 None 表示没有更多记录。
+        通用实现以列表下标作为游标（倒序时下标 0 为最新记录），按批读取并过滤。
+        """
+        match = text_matcher(text)
+        since_ts, until_ts = _to_epoch(since), _to_epoch(until)
+        position = offset if cursor is None else cursor
+        total = self.count()
+        records: List[Dict[str, Any]] = []
+        scanned = 0
+        while position < total and len(records) < limit and scanned < scan_limit:
+            batch = self.range(position, min(100, scan_limit - scanned), reverse)
+            if not batch:
+                break
+            for record in batch:
+                position += 1
+                scanned += 1
+                ts = _to_epoch(record.get("timestamp"))
+                if ts is not None and ((since_ts is not None and ts < since_ts) or (until_ts is not None and ts > until_ts)):
+                    continue
+                if match and not match(record):
+                    continue
+                records.append(record)
+                if len(records) >= limit:
+                    break
+        return records, (position if position < total else None)
+
+    def describe(self) -> Dict[str, Any]:
+        return {"store": self.name, "count": self.count()}
+
+    def close(self):
+        pass
+
+
+class RingHistoryStore(HistoryStore):
+    """环形缓冲（最近记录）+ 可选的分段追加日志（全部记录）。游标为记录序号 seq。"""
+
+    name = "ring"
+
+    def __init__(self, capacity: int, log: Optional[TranscriptLog] = None):
+        self.capacity = capacity
+        self.log = log
+        self._ring = RingBuffer(capacity)  # 元素为 (seq, ts, packed)
+        self._lock = threading.Lock()
+        self._first_seq = 0
+        self._next_seq = 0
+        if log is not None:
+            self._first_seq, self._next_seq = log.first_seq, log.next_seq
+            # 最近的记录放回环形缓冲
+            start = max(log.first_seq, log.next_seq - capacity)
+            for seq, ts, record in log.iterate(start):
+                self._ring.append((seq, ts, _pack(record)))
+            if len(log):
+                print(f"📜 已从 {log.directory} 恢复 {len(log)} 条聊天记录")
+
+    def append(self, record: Dict[str, Any]):
+        with self._lock:
+            if self.log is not None:
+                seq, ts = self.log.append(record)
+            else:
+                seq, ts = self._next_seq, datetime.now().timestamp()
+            self._ring.append((seq, ts, _pack(record)))
+            self._next_seq = seq + 1
+            if len(self._ring) == self.capacity and self.log is None:
+                self._first_seq = self._ring.get(0)[0]
+
+    def count(self) -> int:
+        return self._next_seq - self._first_seq
+
+    def _ring_row(self, seq: int) -> Optional[Tuple[int, float, Tuple]]:
+        """seq 仍在环形缓冲中时返回 (seq, ts, packed)，否则返回 None。"""
+        with self._lock:
+            size = len(self._ring)
+            if not size:
+                return None
+            base = self._ring.get(0)[0]
+            if base <= seq < base + size:
+                return self._ring.get(seq - base)
+        return None
+
+    def _iterate(self, start: int, reverse: bool) -> Iterator[Tuple[int, float, Dict[str, Any]]]:
+        """从 start 开始逐条产出 (seq, ts, record)：环形缓冲内的记录直接读取，更早的记录从日志读取。"""
+        first, end = self._first_seq, self._next_seq
+        if reverse:
+            seq = min(start, end - 1)
+            while seq >= first:
+                row = self._ring_row(seq)
+                if row is None:
+                    # 已越过环形缓冲的最旧记录，其余部分由日志按索引块倒序读取
+                    if self.log is not None:
+                        yield from self.log.iterate(seq, reverse=True)
+                    return
+                yield row[0], row[1], _unpack(row[2])
+                seq -= 1
+        else:
+            seq = max(start, first)
+            while seq < end:
+                row = self._ring_row(seq)
+                if row is not None:
+                    yield row[0], row[1], _unpack(row[2])
+                    seq += 1
+                    continue
+                if self.log is None:
+                    return
+                # 早于环形缓冲的记录：每次从日志读取一个索引块
+                rows = list(self.log.iterate(seq, stop=min(end, seq + self.log.index_interval)))
+                if not rows:
+                    return
+                yield from rows
+                seq = rows[-1][0] + 1
+
+    def range(self, offset=0, limit=50, reverse=True):
+        records, _ = self.query(limit=limit, reverse=reverse, offset=offset)
+        return records
+
+    def query(self, cursor=None, limit=50, reverse=True, since=None, until=None, text=None,
+              offset=0, scan_limit=HISTORY_SCAN_LIMIT):
+        match = text_matcher(text)
+        since_ts, until_ts = _to_epoch(since), _to_epoch(until)
+        first, end = self._first_seq, self._next_seq
+        if cursor is None:
+            cursor = end - 1 - max(0, offset) if reverse else first + max(0, offset)
+        # 时间范围经日志的稀疏索引直接定位起点（写入时间单调不减）
+        if self.log is not None:
+            if reverse and until_ts is not None:
+                cursor = min(cursor, self.log.seq_at_time(until_ts + 1e-6) - 1)
+            elif not reverse and since_ts is not None:
+                cursor = max(cursor, self.log.seq_at_time(since_ts))
+
+        records: List[Dict[str, Any]] = []
+        next_cursor: Optional[int] = None
+        scanned = 0
+        for seq, ts, record in self._iterate(cursor, reverse):
+            if len(records) >= limit or scanned >= scan_limit:
+                # 还有未检查的记录：从这里继续
+                next_cursor = seq
+                break
+            scanned += 1
+            # 写入时间单调：越过时间范围的另一端即可结束
+            if reverse and since_ts is not None and ts < since_ts:
+                break
+            if not reverse and until_ts is not None and ts > until_ts:
+                break
+            if (since_ts is not None and ts < since_ts) or (until_ts is not None and ts > until_ts):
+                continue
+            if match and not match(record):
+                continue
+            records.append(record)
+        return records, next_cursor
+
+    def clear(self):
+        with self._lock:
+            self._ring.clear()
+            if self.log is not None:
+                self.log.clear()
+            self._first_seq = self._next_seq
+
+    def describe(self):
+        info = {
+            "store": self.name,
+            "count": self.count(),
+            "in_memory": len(self._ring),
+            "capacity": self.capacity,
+        }
+        if self.log is not None:
+            info["transcript_log"] = self.log.describe()
+        return info
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+
+def _migrate_legacy_spill(log: TranscriptLog):
+    """把上一版本的单文件落盘记录导入分段日志（仅在日志为空时执行一次）。"""
+    if len(log) or not os.path.exists(LEGACY_SPILL_PATH):
+        return
+    imported = 0
+    with open(LEGACY_SPILL_PATH, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            log.append(json.loads(line))
+            imported += 1
+    os.replace(LEGACY_SPILL_PATH, LEGACY_SPILL_PATH + ".migrated")
+    print(f"📜 已将 {imported} 条聊天记录迁移到 {log.directory}")
+
+
+class SharedListHistoryStore(HistoryStore):
+    """多进程部署：记录保存在共享状态后端的有界列表中。"""
+
+    name = "shared"
+
+    def __init__(self, state: SharedStateBackend, capacity: int):
+        self.state = state
+        self.capacity = capacity
+
+    def append(self, record):
+        self.state.list_append(CHAT_HISTORY_LIST, record, self.capacity)
+
+    def range(self, offset=0, limit=50, reverse=True):
+        return self.state.list_range(CHAT_HISTORY_LIST, offset, limit, reverse)
+
+    def count(self):
+        return self.state.list_len(CHAT_HISTORY_LIST)
+
+    def clear(self):
+        self.state.list_clear(CHAT_HISTORY_LIST)
+
+    def describe(self):
+        return {"store": self.name, "backend": self.state.name, "count": self.count(), "capacity": self.capacity}
+
+
+def create_history_store(state: SharedStateBackend, capacity: int) -> HistoryStore:
+    """根据共享状态后端选择聊天记录存储。"""
+    if state.shared:
+        return SharedListHistoryStore(state, capacity)
+    if not HISTORY_PERSIST:
+        return RingHistoryStore(capacity)
+    log = TranscriptLog(HISTORY_DIR, segment_bytes=HISTORY_SEGMENT_BYTES)
+    _migrate_legacy_spill(log)
+    return RingHistoryStore(capacity, log)
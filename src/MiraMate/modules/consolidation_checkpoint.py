@@ -0,0 +1,71 @@
+"""
+记忆整理检查点
+- 空闲整理的每个阶段在调用模型之后、写入记忆库之前先登记检查点：本批处理的缓存条目 ID、模型输出、
+  已提交的条目数。整理被用户互动打断或进程崩溃后，下一次整理从检查点继续，不再重复调用模型
+- 写入记忆库使用由检查点派生的确定性 ID（upsert），重放同一检查点不会产生重复记忆；
+  提交完成后只删除本批处理过的缓存条目，整理期间新写入的缓存保留到下一轮
+- SQLite 后端下存放在 kv 命名空间 "consolidation"，并与清理缓存条目在同一事务中删除；
+  json 后端下存放在 consolidation_checkpoints.json（临时文件 + os.replace 原子落盘）
+"""
+import json
+import os
+import threading
+from typing import Any, Dict, Optional
+
+NAMESPACE = "consolidation"
+
+
+class CheckpointStore:
+    """按阶段名保存检查点（每个阶段同时最多一个）。"""
+
+    def __init__(self, path: str, db=None):
+        self.path = path
+        self.db = db
+        self._lock = threading.Lock()
+
+    def _read_file(self) -> Dict[str, Any]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 整理检查点文件损坏，将忽略: {e}")
+            return {}
+
+    def _write_file(self, data: Dict[str, Any]):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def load(self, stage: str) -> Optional[Dict[str, Any]]:
+        if self.db is not None:
+            return self.db.kv_get_all(NAMESPACE).get(stage)
+        with self._lock:
+            return self._read_file().get(stage)
+
+    def save(self, stage: str, checkpoint: Dict[str, Any]):
+        if self.db is not None:
+            self.db.kv_set(NAMESPACE, {stage: checkpoint})
+            return
+        with self._lock:
+            data = self._read_file()
+            data[stage] = checkpoint
+            self._write_file(data)
+
+    def delete(self, stage: str):
+        if self.db is not None:
+            self.db.kv_delete(NAMESPACE, [stage])
+            return
+        with self._lock:
+            data = self._read_file()
+            if data.pop(stage, None) is not None:
+                self._write_file(data)
+
+    def all(self) -> Dict[str, Any]:
+        if self.db is not None:
+            return self.db.kv_get_all(NAMESPACE)
+        with self._lock:
+            return self._read_file()
@@ -0,0 +1,395 @@
+"""
+独立的嵌入工作进程
+- 嵌入模型只在子进程中加载，主进程（事件循环、IdleProcessor 线程、异步后处理链）不再执行 CPU 密集的编码，
+  也不再与模型推理争抢 GIL
+- 子进程对并发请求做微批处理：收到第一个请求后最多再等待 max_wait_ms，把期间到达的请求合并成一次 encode
+- 主进程通过 WorkerEmbeddingBackend（实现 EmbeddingBackend 接口）接入，记忆系统经由同一个
+  create_embedding_function() 适配器使用它
+- 通过 MIRAMATE_EMBEDDING_WORKER=1 启用；子进程异常退出时，未完成的请求立即失败，下一次请求自动重启子进程
+- 结果向量经共享内存环形缓冲（vector_ring.VectorRing）回传，队列上只传递槽位号；
+  超过单槽容量的请求或槽位耗尽时回退为队列传输
+"""
+import atexit
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from MiraMate.modules.embeddings import EMBEDDING_BACKEND, EmbeddingBackend
+from MiraMate.modules.vector_ring import VectorLease, VectorRing
+
+EMBEDDING_WORKER_ENABLED = os.getenv("MIRAMATE_EMBEDDING_WORKER", "0") == "1"
+MAX_BATCH = int(os.getenv("MIRAMATE_EMBEDDING_MAX_BATCH", "64"))
+MAX_WAIT_MS = float(os.getenv("MIRAMATE_EMBEDDING_BATCH_WAIT_MS", "5"))
+# 共享内存环形缓冲：槽位数与每槽最多容纳的向量行数
+RING_SLOTS = int(os.getenv("MIRAMATE_EMBEDDING_RING_SLOTS", "32"))
+RING_SLOT_ROWS = int(os.getenv("MIRAMATE_EMBEDDING_RING_SLOT_ROWS", "64"))
+# 等待空闲槽位的最长时间（秒），超时后该请求回退为队列传输
+RING_ACQUIRE_TIMEOUT = 0.05
+# 子进程加载模型的最长等待时间（秒）
+STARTUP_TIMEOUT = 600
+REQUEST_TIMEOUT = 120
+
+
+def _worker_main(request_q, response_q, backend_name: str, max_batch: int, max_wait: float):
+    """
+    子进程入口。请求格式 (req_id, texts, slot)，("attach", ring_spec) 附加共享内存缓冲，None 表示退出。
+    响应格式：("ready", info) / ("result", req_id, vectors, batch_size) / ("error", req_id, message) / ("fatal", message)
+    slot >= 0 时结果写入共享内存对应槽位，响应中的 vectors 为 None。
+    """
+    from MiraMate.modules.embeddings import create_backend
+    try:
+        backend = create_backend(backend_name)
+    except Exception as e:
+        response_q.put(("fatal", repr(e)))
+        return
+    response_q.put(("ready", {"backend": backend.name, "model": backend.model_name,
+                              "dimension": backend.dimension, **backend.footprint()}))
+
+    ring: Optional[VectorRing] = None
+
+    def _attach(spec):
+        nonlocal ring
+        if ring is not None:
+            ring.close()
+        ring = VectorRing.attach(spec)
+
+    stopping = False
+    while not stopping:
+        item = request_q.get()
+        if item is None:
+            break
+        if item[0] == "attach":
+            _attach(item[1])
+            continue
+        batch = [item]
+        total = len(item[1])
+        # 微批：在时间窗口内继续收集请求，直到达到批大小上限
+        deadline = time.monotonic() + max_wait
+        while total < max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = request_q.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            if item[0] == "attach":
+                _attach(item[1])
+                continue
+            batch.append(item)
+            total += len(item[1])
+
+        texts = [text for _, request_texts, _ in batch for text in request_texts]
+        try:
+            vectors = backend.encode(texts)
+        except Exception as e:
+            for req_id, _, _ in batch:
+                response_q.put(("error", req_id, repr(e)))
+            continue
+        offset = 0
+        for req_id, request_texts, slot in batch:
+            chunk = vectors[offset:offset + len(request_texts)]
+            offset += len(request_texts)
+            if slot >= 0 and ring is not None:
+                ring.write(slot, chunk)
+                response_q.put(("result", req_id, None, len(batch)))
+            else:
+                response_q.put(("result", req_id, chunk, len(batch)))
+
+
+class EmbeddingWorker:
+    """主进程侧的工作进程句柄：提交请求、接收结果、管理子进程生命周期。"""
+
+    def __init__(self, backend_name: str = EMBEDDING_BACKEND, max_batch: int = MAX_BATCH,
+                 max_wait_ms: float = MAX_WAIT_MS, ring_slots: int = RING_SLOTS,
+                 ring_slot_rows: int = RING_SLOT_ROWS):
+        self.backend_name = backend_name
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.ring_slots = ring_slots
+        self.ring_slot_rows = ring_slot_rows
+        # 共享内存缓冲在子进程报告向量维度后创建，并在子进程重启后沿用
+        self.ring: Optional[VectorRing] = None
+        # spawn：子进程不继承主进程中的线程与锁状态（fork 后再加载 torch 容易死锁）
+        self._ctx = mp.get_context("spawn")
+        self._process: Optional[mp.Process] = None
+        self._request_q = None
+        self._response_q = None
+        self._receiver: Optional[threading.Thread] = None
+        # req_id -> (future, slot, 行数, 是否以借用视图返回)
+        self._pending: Dict[int, Tuple[Future, int, int, bool]] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self.info: Dict[str, Any] = {}
+        self.stats = {"requests": 0, "texts": 0, "batches_observed": 0, "batch_size_sum": 0, "restarts": 0,
+                      "shared_memory_results": 0, "queued_results": 0}
+
+    # --- 生命周期 ---
+    @property
+    def alive(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def start(self, timeout: float = STARTUP_TIMEOUT):
+        """启动子进程并等待模型加载完成（幂等）。"""
+        with self._lock:
+            if self.alive:
+                # 已启动（或正在由其他线程启动）：只需等待就绪
+                process = self._process
+            else:
+                process = self._spawn()
+        if not self._ready.wait(timeout):
+            raise RuntimeError("嵌入工作进程启动超时")
+        if "error" in self.info or not process.is_alive():
+            raise RuntimeError(f"嵌入工作进程启动失败: {self.info.get('error')}")
+
+    def _spawn(self):
+        """（需持有锁）创建新的子进程；重启时让上一代进程未完成的请求立即失败。"""
+        if self._process is not None:
+            self.stats["restarts"] += 1
+            stale, self._pending = self._pending, {}
+            self._abandon(stale, "嵌入工作进程已重启")
+        self._ready.clear()
+        self.info = {}
+        self._request_q = self._ctx.Queue()
+        self._response_q = self._ctx.Queue()
+        self._process = self._ctx.Process(
+            target=_worker_main,
+            args=(self._request_q, self._response_q, self.backend_name, self.max_batch, self.max_wait),
+            name="MiraMateEmbeddingWorker",
+            daemon=True,
+        )
+        self._process.start()
+        self._receiver = threading.Thread(target=self._receive_loop, args=(self._process, self._response_q),
+                                          name="EmbeddingWorkerReceiver", daemon=True)
+        self._receiver.start()
+        print(f"🚀 嵌入工作进程启动中 (pid={self._process.pid})")
+        return self._process
+
+    def stop(self, timeout: float = 5.0):
+        with self._lock:
+            process, self._process = self._process, None
+            if process is None:
+                return
+            try:
+                self._request_q.put(None)
+            except Exception:
+                pass
+        process.join(timeout)
+        if process.is_alive():
+            process.terminate()
+        self._fail_pending("嵌入工作进程已停止")
+        with self._lock:
+            ring, self.ring = self.ring, None
+        if ring is not None:
+            ring.close()
+
+    def _abandon(self, pending: Dict[int, Tuple[Future, int, int, bool]], message: str):
+        """让一组未完成的请求失败并归还其槽位（子进程已不会再写入这些槽位）。"""
+        for future, slot, _, _ in pending.values():
+            if slot >= 0 and self.ring is not None:
+                self.ring.release(slot)
+            if not future.done():
+                future.set_exception(RuntimeError(message))
+
+    def _fail_pending(self, message: str):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        self._abandon(pending, message)
+
+    def _prepare_ring(self, request_q, dimension: int):
+        """子进程就绪后创建（或沿用）共享内存缓冲，并通知子进程附加。"""
+        if self.ring_slots <= 0:
+            return
+        if self.ring is None or self.ring.dim != dimension:
+            if self.ring is not None:
+                self.ring.close()
+            try:
+                self.ring = VectorRing(self.ring_slots, self.ring_slot_rows, dimension)
+            except Exception as e:
+                print(f"⚠️ 创建共享内存向量缓冲失败，回退为队列传输: {e}")
+                self.ring = None
+                return
+        request_q.put(("attach", self.ring.spec()))
+
+    def _receive_loop(self, process, response_q):
+        while True:
+            try:
+                message = response_q.get(timeout=1.0)
+            except queue.Empty:
+                if not process.is_alive():
+                    self._ready.set()  # 唤醒仍在等待启动的调用方
+                    # 若已被新进程取代，旧请求已在 _spawn 中处理
+                    if process is self._process:
+                        print(f"⚠️ 嵌入工作进程意外退出 (exitcode={process.exitcode})，下次请求时将重启")
+                        self._fail_pending(f"嵌入工作进程意外退出 (exitcode={process.exitcode})")
+                    return
+                continue
+            except (EOFError, OSError):
+                return
+
+            kind = message[0]
+            if kind == "ready":
+                self.info = message[1]
+                # 必须在唤醒调用方之前发出 attach，保证它排在所有请求之前
+                self._prepare_ring(self._request_q, int(self.info["dimension"]))
+                self._ready.set()
+            elif kind == "fatal":
+                self.info = {"error": message[1]}
+                self._ready.set()
+            elif kind in ("result", "error"):
+                with self._lock:
+                    entry = self._pending.pop(message[1], None)
+                if entry is None:
+                    continue
+                self._resolve(entry, kind, message)
+
+    def _resolve(self, entry: Tuple[Future, int, int, bool], kind: str, message):
+        future, slot, rows, lease = entry
+        ring = self.ring
+        # 调用方已超时取消（或请求已失败）时结果无人读取，槽位立即归还；
+        # 进入 running 状态后调用方无法再取消，下面的 set_result 不会与 cancel 竞争
+        if future.done() or not future.set_running_or_notify_cancel() or kind == "error":
+            if slot >= 0 and ring is not None:
+                ring.release(slot)
+            if kind == "error" and not future.done():
+                future.set_exception(RuntimeError(f"嵌入计算失败: {message[2]}"))
+            return
+        self.stats["batches_observed"] += 1
+        self.stats["batch_size_sum"] += message[3]
+        if message[2] is not None:
+            # 随队列返回的结果（未分配槽位，或子进程重启后尚未附加共享内存、槽位未被写入）
+            if slot >= 0 and ring is not None:
+                ring.release(slot)
+            self.stats["queued_results"] += 1
+            future.set_result(VectorLease(message[2]) if lease else message[2])
+            return
+        self.stats["shared_memory_results"] += 1
+        if lease:
+            future.set_result(ring.lease(slot, rows))
+        else:
+            # 需要长期持有的结果：从槽位复制一份后立即归还
+            vectors = ring.view(slot, rows).copy()
+            ring.release(slot)
+            future.set_result(vectors)
+
+    # --- 请求 ---
+    def submit(self, texts: Sequence[str], lease: bool = False) -> Future:
+        """
+        提交一批文本，返回 Future：
+        - lease=False：结果为调用方独占的 float32 矩阵
+        - lease=True：结果为 VectorLease，其 array 直接指向共享内存槽位，用完必须 release()
+        """
+        if not self.alive or not self._ready.is_set():
+            # 重启期间等待新进程就绪：attach 在就绪之前发出，之后的请求才能使用共享内存槽位
+            self.start()
+        future: Future = Future()
+        texts = list(texts)
+        ring = self.ring
+        slot = -1
+        if ring is not None and len(texts) <= ring.slot_rows:
+            acquired = ring.acquire(timeout=RING_ACQUIRE_TIMEOUT)
+            slot = -1 if acquired is None else acquired
+        with self._lock:
+            req_id = next(self._ids)
+            self._pending[req_id] = (future, slot, len(texts), lease)
+            self.stats["requests"] += 1
+            self.stats["texts"] += len(texts)
+            request_q = self._request_q
+        request_q.put((req_id, texts, slot))
+        return future
+
+    @staticmethod
+    def _wait(future: Future, timeout: float):
+        """等待结果；超时时取消 Future，迟到的结果由 _resolve 归还槽位。"""
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            if not future.cancel():
+                # 结果恰好正在写入：借用视图无人使用，写入后立即归还
+                future.add_done_callback(
+                    lambda f: f.exception() is None and isinstance(f.result(), VectorLease) and f.result().release())
+            raise
+
+    def encode(self, texts: Sequence[str], timeout: float = REQUEST_TIMEOUT) -> np.ndarray:
+        return self._wait(self.submit(texts), timeout)
+
+    def borrow(self, texts: Sequence[str], timeout: float = REQUEST_TIMEOUT) -> VectorLease:
+        return self._wait(self.submit(texts, lease=True), timeout)
+
+    def describe(self) -> Dict[str, Any]:
+        observed = self.stats["batches_observed"]
+        info = {
+            "pid": self._process.pid if self._process else None,
+            "alive": self.alive,
+            "pending": len(self._pending),
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+            "mean_requests_per_batch": round(self.stats["batch_size_sum"] / observed, 2) if observed else None,
+            "ring": self.ring.describe() if self.ring is not None else None,
+            **self.stats,
+        }
+        return info
+
+
+class WorkerEmbeddingBackend(EmbeddingBackend):
+    """把嵌入工作进程包装为 EmbeddingBackend，供 create_embedding_function() 适配给 ChromaDB。"""
+
+    def __init__(self, worker: EmbeddingWorker):
+        self.worker = worker
+        worker.start()
+        super().__init__(worker.info.get("model", ""))
+        self.name = f"worker:{worker.info.get('backend', worker.backend_name)}"
+
+    @property
+    def dimension(self) -> int:
+        return int(self.worker.info["dimension"])
+
+    def encode(self, texts: Sequence[str], batch_size: int = 32) -> np.ndarray:
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        return self.worker.encode(texts)
+
+    def borrow(self, texts: Sequence[str]) -> VectorLease:
+        texts = list(texts)
+        if not texts:
+            return VectorLease(np.zeros((0, self.dimension), dtype=np.float32))
+        return self.worker.borrow(texts)
+
+    def footprint(self) -> Dict[str, Any]:
+        from MiraMate.modules.registry import _process_rss_bytes
+        info = super().footprint()
+        info["embedding_worker"] = self.worker.describe()
+        # 模型在子进程中，不计入主进程 RSS
+        info["embedding_worker_rss_bytes"] = _process_rss_bytes(self.worker.describe()["pid"])
+        return info
+
+
+_worker: Optional[EmbeddingWorker] = None
+_worker_lock = threading.Lock()
+
+
+def get_embedding_worker() -> EmbeddingWorker:
+    """进程内唯一的嵌入工作进程句柄（首次调用时启动子进程）。"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = EmbeddingWorker()
+            atexit.register(_worker.stop)
+    _worker.start()
+    return _worker
+
+
+def create_worker_backend() -> EmbeddingBackend:
+    return WorkerEmbeddingBackend(get_embedding_worker())
@@ -0,0 +1,454 @@
+"""
+可插拔的嵌入后端
+- EmbeddingBackend：统一的 encode(texts) -> float32 矩阵 接口，记忆系统通过 create_embedding_function() 接入 ChromaDB
+- torch：SentenceTransformer 全精度模型（原有实现，默认）
+- onnx-int8：导出并动态量化为 int8 的 ONNX 模型，用 onnxruntime + tokenizers 推理，不依赖 torch，
+  CPU 上延迟与常驻内存都明显更低
+- borrow(texts)：只在一次检索内使用的向量（查询向量 → 向量检索 / MMR 重排）以借用视图返回，
+  工作进程后端借此直接读取共享内存槽位，不做复制
+- 附带一致性检查（与 torch 后端在固定语料上的余弦一致度、检索排序一致度）与延迟 / RSS 基准
+
+命令行：
+    python -m MiraMate.modules.embeddings export      # 导出 int8 ONNX 模型
+    python -m MiraMate.modules.embeddings parity      # 与 torch 后端对比一致性
+    python -m MiraMate.modules.embeddings bench [--backend onnx-int8]
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from MiraMate.modules.settings import get_memory_dir
+from MiraMate.modules.vector_ring import VectorLease
+
+EMBEDDING_MODEL_NAME = "BAAI/bge-base-zh-v1.5"
+# 可选值：torch / onnx-int8
+EMBEDDING_BACKEND = os.getenv("MIRAMATE_EMBEDDING_BACKEND", "torch").strip().lower()
+ONNX_MODEL_DIR = os.getenv(
+    "MIRAMATE_ONNX_MODEL_DIR",
+    os.path.join(get_memory_dir(), "models", "bge-base-zh-v1.5-onnx-int8")
+)
+ONNX_MODEL_FILE = "model_int8.onnx"
+ONNX_CONFIG_FILE = "embedding_config.json"
+
+# 一致性检查与基准使用的固定语料（覆盖日常对话、人名日期、中英混排等记忆系统中的典型内容）
+PARITY_CORPUS = [
+    "今天下班路上下起了大雨，我没带伞，全身都湿透了。",
+    "我最喜欢的水果是芒果，不过对菠萝有点过敏。",
+    "下周三是我妈妈的生日，我想给她买一条围巾。",
+    "最近在准备考研，每天学习到很晚，感觉压力很大。",
+    "周末和小李一起去看了《流浪地球2》，特效很震撼。",
+    "我养了一只橘猫，名字叫土豆，已经三岁了。",
+    "明天上午十点有一个很重要的面试，有点紧张。",
+    "我不太喜欢吃辣的，火锅一般点鸳鸯锅。",
+    "这个月开始每天早上跑步五公里，想把体重减下来。",
+    "I have been learning Python for three months and just finished my first project.",
+    "我在杭州工作，老家是四川成都的。",
+    "昨晚失眠了，翻来覆去到凌晨三点才睡着。",
+    "我的电脑是 MacBook Pro M3，最近总是发热。",
+    "和女朋友吵架了，她说我总是不回消息。",
+    "2024年12月我要去日本旅游，计划去东京和大阪。",
+    "最近迷上了弹吉他，每天晚上练习半小时。",
+    "公司下个月要裁员，我担心自己会被波及。",
+    "我对咖啡因比较敏感，下午喝咖啡晚上就睡不着。",
+    "小时候最喜欢的动画片是《灌篮高手》。",
+    "周五晚上打算和朋友们去吃烧烤，顺便庆祝项目上线。",
+]
+PARITY_QUERIES = [
+    "用户的宠物叫什么",
+    "用户有什么饮食忌口",
+    "用户最近的睡眠情况",
+    "用户的旅行计划",
+    "用户的工作和城市",
+    "用户在学习什么",
+]
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def mmr_select(query_vector: np.ndarray, candidates: np.ndarray, k: int,
+               lambda_mult: float = 0.7) -> List[int]:
+    """
+    最大边际相关（MMR）重排：在与查询的相关度和与已选结果的冗余度之间折中，返回被选中候选的下标（按选中顺序）。
+    输入为 float32 向量 / 矩阵（可以是共享内存上的只读视图），按余弦相似度计算，不修改也不复制输入。
+    """
+    n = len(candidates)
+    k = min(k, n)
+    if k <= 0:
+        return []
+    query_norm = max(float(np.linalg.norm(query_vector)), 1e-12)
+    norms = np.maximum(np.linalg.norm(candidates, axis=1), 1e-12)
+    relevance = (candidates @ query_vector) / (norms * query_norm)
+    redundancy = np.zeros(n, dtype=np.float32)
+    chosen = np.zeros(n, dtype=bool)
+    selected: List[int] = []
+    for _ in range(k):
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * redundancy
+        scores[chosen] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        chosen[best] = True
+        similarity = (candidates @ candidates[best]) / (norms * norms[best])
+        np.maximum(redundancy, similarity, out=redundancy)
+    return selected
+
+
+def _rss_bytes() -> Optional[int]:
+    from MiraMate.modules.registry import _process_rss_bytes
+    return _process_rss_bytes()
+
+
+class EmbeddingBackend:
+    """嵌入后端基类：子类实现 encode，返回形状为 (n, dim) 的 float32 矩阵。"""
+
+    name = "base"
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME):
+        self.model_name = model_name
+
+    @property
+    def dimension(self) -> int:
+        raise NotImplementedError
+
+    def encode(self, texts: Sequence[str], batch_size: int = 32) -> np.ndarray:
+        raise NotImplementedError
+
+    def borrow(self, texts: Sequence[str]) -> VectorLease:
+        """以只读借用方式返回向量，用完须 release()（或使用 with 语句）。默认实现直接包装 encode() 的结果。"""
+        return VectorLease(self.encode(texts))
+
+    def footprint(self) -> Dict[str, Any]:
+        """供 MemorySystem.memory_footprint 汇总的占用估算。"""
+        return {"embedding_backend": self.name, "embedding_model": self.model_name}
+
+
+class TorchEmbeddingBackend(EmbeddingBackend):
+    """SentenceTransformer（PyTorch，全精度）后端。"""
+
+    name = "torch"
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME, device: str = "cpu"):
+        super().__init__(model_name)
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device=device)
+
+    @property
+    def dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts: Sequence[str], batch_size: int = 32) -> np.ndarray:
+        embeddings = self.model.encode(list(texts), batch_size=batch_size, convert_to_numpy=True)
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def footprint(self) -> Dict[str, Any]:
+        info = super().footprint()
+        try:
+            info["embedding_model_bytes"] = sum(p.numel() * p.element_size() for p in self.model.parameters())
+        except Exception:
+            pass
+        return info
+
+
+class OnnxInt8EmbeddingBackend(EmbeddingBackend):
+    """
+    int8 动态量化的 ONNX Runtime 后端。
+    模型需先通过 export_onnx_int8() 导出；池化方式、是否归一化、最大长度从导出时记录的配置读取，
+    与 SentenceTransformer 的处理流程保持一致。
+    """
+
+    name = "onnx-int8"
+
+    def __init__(self, model_dir: str = ONNX_MODEL_DIR, num_threads: Optional[int] = None):
+        config_path = os.path.join(model_dir, ONNX_CONFIG_FILE)
+        model_path = os.path.join(model_dir, ONNX_MODEL_FILE)
+        if not os.path.exists(model_path) or not os.path.exists(config_path):
+            raise FileNotFoundError(
+                f"未找到 ONNX 模型: {model_path}，请先运行 python -m MiraMate.modules.embeddings export"
+            )
+        with open(config_path, encoding="utf-8") as f:
+            self.config = json.load(f)
+        super().__init__(self.config.get("model_name", EMBEDDING_MODEL_NAME))
+
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        num_threads = num_threads or int(os.getenv("MIRAMATE_ONNX_THREADS", "0"))
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        self.model_path = model_path
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=int(self.config.get("max_seq_length", 512)))
+        self.tokenizer.enable_padding(pad_id=int(self.config.get("pad_token_id", 0)),
+                                      pad_token=self.config.get("pad_token", "[PAD]"))
+
+    @property
+    def dimension(self) -> int:
+        return int(self.config["dimension"])
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.asarray([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.asarray([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.asarray([e.type_ids for e in encodings], dtype=np.int64)
+        hidden = self.session.run(None, feeds)[0]
+
+        if self.config.get("pooling") == "mean":
+            mask = attention_mask[..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        else:
+            pooled = hidden[:, 0]
+        pooled = pooled.astype(np.float32, copy=False)
+        if self.config.get("normalize", True):
+            pooled = _normalize_rows(pooled)
+        return pooled
+
+    def encode(self, texts: Sequence[str], batch_size: int = 32) -> np.ndarray:
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        # 按长度排序后分批，减少 padding 浪费；输出时恢复原顺序
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        result = np.empty((len(texts), self.dimension), dtype=np.float32)
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            result[idx] = self._encode_batch([texts[i] for i in idx])
+        return result
+
+    def footprint(self) -> Dict[str, Any]:
+        info = super().footprint()
+        info["embedding_model_bytes"] = os.path.getsize(self.model_path)
+        return info
+
+
+BACKENDS = {
+    TorchEmbeddingBackend.name: TorchEmbeddingBackend,
+    OnnxInt8EmbeddingBackend.name: OnnxInt8EmbeddingBackend,
+}
+
+
+def create_backend(name: Optional[str] = None) -> EmbeddingBackend:
+    """
+    按名称创建嵌入后端（默认取 MIRAMATE_EMBEDDING_BACKEND）。
+    非 torch 后端不可用（未导出模型或缺少依赖）时回退到 torch 后端。
+    """
+    name = (name or EMBEDDING_BACKEND).strip().lower()
+    backend_cls = BACKENDS.get(name)
+    if backend_cls is None:
+        print(f"⚠️ 未知的嵌入后端 '{name}'，使用 torch 后端")
+        backend_cls = TorchEmbeddingBackend
+    if backend_cls is not TorchEmbeddingBackend:
+        try:
+            backend = backend_cls()
+            print(f"✅ 嵌入后端: {backend.name} ({backend.model_name})")
+            return backend
+        except Exception as e:
+            print(f"⚠️ 嵌入后端 '{name}' 不可用，回退到 torch 后端: {e}")
+    backend = TorchEmbeddingBackend()
+    print(f"✅ 嵌入后端: {backend.name} ({backend.model_name})")
+    return backend
+
+
+_embedding_function_cls = None
+_chroma_accepts_arrays: Optional[bool] = None
+
+
+def chroma_embeddings(matrix: np.ndarray):
+    """
+    把 float32 矩阵转换为 ChromaDB 接受的嵌入格式：支持 NumPy 输入的版本直接传递各行（不做 list 转换），
+    旧版本（只校验 list）才退回 tolist()。是否支持通过 chromadb 自身的校验函数探测一次。
+    """
+    global _chroma_accepts_arrays
+    if _chroma_accepts_arrays is None:
+        from chromadb.api import types as chroma_types
+        probe = [np.zeros(2, dtype=np.float32)]
+        try:
+            normalize = getattr(chroma_types, "normalize_embeddings", None)
+            chroma_types.validate_embeddings(normalize(probe) if normalize else probe)
+            _chroma_accepts_arrays = True
+        except Exception:
+            _chroma_accepts_arrays = False
+    return list(matrix) if _chroma_accepts_arrays else matrix.tolist()
+
+
+def create_embedding_function(backend: EmbeddingBackend):
+    """
+    把 EmbeddingBackend 适配为 ChromaDB 的 embedding_function。
+    适配类在首次调用时才定义，避免导入本模块时连带导入 chromadb。
+    """
+    global _embedding_function_cls
+    if _embedding_function_cls is None:
+        from chromadb.api.types import EmbeddingFunction
+
+        class BackendEmbeddingFunction(EmbeddingFunction):
+            def __init__(self, backend: EmbeddingBackend):
+                self.backend = backend
+
+            def __call__(self, input):
+                return chroma_embeddings(self.backend.encode(list(input)))
+
+        _embedding_function_cls = BackendEmbeddingFunction
+    return _embedding_function_cls(backend)
+
+
+# --- 导出 ---
+def export_onnx_int8(model_name: str = EMBEDDING_MODEL_NAME, output_dir: str = ONNX_MODEL_DIR) -> str:
+    """
+    将 SentenceTransformer 模型导出为 ONNX 并做 int8 动态量化（仅权重量化，激活保持 float）。
+    需要 torch、sentence_transformers、onnx、onnxruntime；导出只需执行一次，推理时不再依赖 torch。
+    返回量化模型路径。
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize, Pooling
+
+    os.makedirs(output_dir, exist_ok=True)
+    st_model = SentenceTransformer(model_name, device="cpu")
+    transformer = st_model[0].auto_model
+    tokenizer = st_model.tokenizer
+    pooling = next((m for m in st_model if isinstance(m, Pooling)), None)
+    pooling_mode = "cls" if pooling is None or pooling.pooling_mode_cls_token else "mean"
+
+    transformer.eval()
+    transformer.config.return_dict = False
+    sample = tokenizer(["导出用的示例文本"], return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+    fp32_path = os.path.join(output_dir, "model_fp32.onnx")
+    print(f"📦 正在导出 ONNX 模型: {model_name}")
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            tuple(sample[n] for n in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={**{n: {0: "batch", 1: "sequence"} for n in input_names},
+                          "last_hidden_state": {0: "batch", 1: "sequence"}},
+            opset_version=14,
+        )
+
+    int8_path = os.path.join(output_dir, ONNX_MODEL_FILE)
+    print("📦 正在进行 int8 动态量化...")
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    os.remove(fp32_path)
+
+    tokenizer.save_pretrained(output_dir)
+    config = {
+        "model_name": model_name,
+        "pooling": pooling_mode,
+        "normalize": any(isinstance(m, Normalize) for m in st_model),
+        "max_seq_length": st_model.max_seq_length,
+        "dimension": st_model.get_sentence_embedding_dimension(),
+        "pad_token": tokenizer.pad_token,
+        "pad_token_id": tokenizer.pad_token_id,
+    }
+    with open(os.path.join(output_dir, ONNX_CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    print(f"✅ 量化模型已导出: {int8_path} ({os.path.getsize(int8_path) / 1024 / 1024:.1f} MB)")
+    return int8_path
+
+
+# --- 一致性检查与基准 ---
+def parity_check(reference: EmbeddingBackend, candidate: EmbeddingBackend,
+                 corpus: Sequence[str] = PARITY_CORPUS, queries: Sequence[str] = PARITY_QUERIES,
+                 min_cosine: float = 0.98, top_k: int = 3) -> Dict[str, Any]:
+    """
+    比较两个后端在固定语料上的输出：
+    - 逐句余弦相似度（同一句在两个后端下的向量）
+    - 查询检索的 top-k 重合率与 top-1 一致率（衡量对召回结果的实际影响）
+    passed 要求最小逐句余弦 >= min_cosine 且 top-1 全部一致。
+    """
+    ref_docs = _normalize_rows(reference.encode(corpus))
+    cand_docs = _normalize_rows(candidate.encode(corpus))
+    cosines = np.sum(ref_docs * cand_docs, axis=1)
+
+    ref_rank = np.argsort(-(_normalize_rows(reference.encode(queries)) @ ref_docs.T), axis=1)[:, :top_k]
+    cand_rank = np.argsort(-(_normalize_rows(candidate.encode(queries)) @ cand_docs.T), axis=1)[:, :top_k]
+    overlap = [len(set(r) & set(c)) / top_k for r, c in zip(ref_rank, cand_rank)]
+    top1 = float(np.mean(ref_rank[:, 0] == cand_rank[:, 0]))
+
+    report = {
+        "reference": reference.name,
+        "candidate": candidate.name,
+        "cosine_mean": round(float(cosines.mean()), 5),
+        "cosine_min": round(float(cosines.min()), 5),
+        f"top{top_k}_overlap": round(float(np.mean(overlap)), 3),
+        "top1_agreement": round(top1, 3),
+    }
+    report["passed"] = report["cosine_min"] >= min_cosine and top1 == 1.0
+    return report
+
+
+def benchmark(backend_name: str, corpus: Sequence[str] = PARITY_CORPUS, runs: int = 20) -> Dict[str, Any]:
+    """
+    测量后端的加载耗时、RSS 增量与编码延迟（单条查询与整批语料各自的 p50 / p95）。
+    RSS 增量在同一进程内测得，需在未加载其他模型的新进程中运行才准确。
+    """
+    rss_before = _rss_bytes()
+    start = time.perf_counter()
+    backend = create_backend(backend_name)
+    load_seconds = time.perf_counter() - start
+    rss_after = _rss_bytes()
+
+    backend.encode(corpus[:2])  # 预热
+    single, batch = [], []
+    for i in range(runs):
+        t0 = time.perf_counter()
+        backend.encode([corpus[i % len(corpus)]])
+        single.append((time.perf_counter() - t0) * 1000)
+        t0 = time.perf_counter()
+        backend.encode(corpus)
+        batch.append((time.perf_counter() - t0) * 1000)
+
+    def _p(values: List[float], q: float) -> float:
+        return round(statistics.quantiles(values, n=100)[int(q) - 1], 2) if len(values) > 1 else round(values[0], 2)
+
+    return {
+        "backend": backend.name,
+        "load_seconds": round(load_seconds, 2),
+        "rss_delta_mb": round((rss_after - rss_before) / 1024 / 1024, 1) if rss_before and rss_after else None,
+        "single_p50_ms": _p(single, 50),
+        "single_p95_ms": _p(single, 95),
+        f"batch{len(corpus)}_p50_ms": _p(batch, 50),
+        f"batch{len(corpus)}_p95_ms": _p(batch, 95),
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="MiraMate 嵌入后端工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export_cmd = sub.add_parser("export", help="导出 int8 量化的 ONNX 模型")
+    export_cmd.add_argument("--output", default=ONNX_MODEL_DIR)
+    parity_cmd = sub.add_parser("parity", help="对比 torch 与 onnx-int8 后端的一致性")
+    parity_cmd.add_argument("--min-cosine", type=float, default=0.98)
+    bench_cmd = sub.add_parser("bench", help="测量加载耗时、RSS 与编码延迟")
+    bench_cmd.add_argument("--backend", default=EMBEDDING_BACKEND, choices=sorted(BACKENDS))
+    bench_cmd.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        export_onnx_int8(output_dir=args.output)
+    elif args.command == "parity":
+        report = parity_check(TorchEmbeddingBackend(), OnnxInt8EmbeddingBackend(), min_cosine=args.min_cosine)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        raise SystemExit(0 if report["passed"] else 1)
+    elif args.command == "bench":
+        print(json.dumps(benchmark(args.backend, runs=args.runs), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
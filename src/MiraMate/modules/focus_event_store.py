@@ -0,0 +1,285 @@
+"""
+临时关注事件的内存存储
+- 启动时从 temp_focus_events.json 加载一次，每个事件的 expire_time 只解析一次
+- 以过期时间为键的最小堆 + 后台清理线程：在最近一个事件到期时唤醒，移除过期事件并落盘
+- 持久化：JSON 文件整体原子替换；或 SQLite 后端下按事件行增删改（只写变化部分）
+- 读取路径（get_active_focus_events）只返回不可变快照，无文件 I/O、无时间解析、无需加锁
+- 多个 Web worker 共用 SQLite 时，写入后经 on_change 通知其他进程 reload()
+"""
+import heapq
+import json
+import math
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+
+def parse_iso_datetime(dt_str: str) -> Optional[datetime]:
+    """尽可能稳健地解析 ISO 时间戳，返回 UTC 时区的 datetime。
+    兼容示例：
+    - 2025-08-24T00:00:00Z
+    - 2025-08-24T00:00:00.123Z
+    - 2025-08-24T00:00:00+08:00
+    - 2025-08-24 00:00:00  （无时区，按 UTC 处理）
+    """
+    if not isinstance(dt_str, str):
+        return None
+    s = dt_str.strip().replace(' ', 'T')
+    # 兼容以 Z 结尾（UTC）
+    if s.endswith('Z'):
+        s = s[:-1] + '+00:00'
+    try:
+        dt = datetime.fromisoformat(s)
+    except ValueError:
+        return None
+
+    # 统一转为 UTC 有时区时间
+    if dt.tzinfo is None:
+        # 无时区信息时，按 UTC 处理
+        dt = dt.replace(tzinfo=timezone.utc)
+    else:
+        dt = dt.astimezone(timezone.utc)
+    return dt
+
+
+def _expire_epoch(event: Dict) -> float:
+    """将事件的 expire_time 转为 epoch 秒；解析失败视为永不过期，避免误删。"""
+    dt = parse_iso_datetime(event.get("expire_time"))
+    return dt.timestamp() if dt is not None else math.inf
+
+
+class FocusEventStore:
+    """带过期堆和定时清理的临时关注事件存储。"""
+
+    # 清理线程的最长休眠时间（秒），防止系统时间跳变后长时间不醒
+    MAX_SWEEP_INTERVAL = 3600
+
+    def __init__(self, path: str, on_expire: Optional[Callable[[List[str]], None]] = None,
+                 db=None, on_change: Optional[Callable[[], None]] = None):
+        """
+        :param path: 持久化文件路径（temp_focus_events.json），db 为 None 时使用。
+        :param on_expire: 事件因过期被移除后的回调，参数为被移除的事件ID列表。
+        :param db: 可选的 StateStore，提供时事件存放在其 focus_events 表中。
+        :param on_change: 变更落盘后的回调（多进程部署时用于通知其他进程 reload）。
+        """
+        self.path = path
+        self.on_expire = on_expire
+        self.db = db
+        self.on_change = on_change
+
+        # 事件表（保持插入顺序）: { event_id: event }
+        self._events: Dict[str, Dict] = {}
+        self._expiry: Dict[str, float] = {}
+        # 最小堆: [(expire_epoch, event_id)]，采用惰性删除
+        self._heap: List[Tuple[float, str]] = []
+        # 不可变快照：读取方直接引用，写入方整体替换
+        self._snapshot: Tuple[Dict, ...] = ()
+        self._next_expiry = math.inf
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+        self._load()
+
+    # --- 内部（调用方需持有锁） ---
+    def _read(self) -> Optional[List[Dict]]:
+        try:
+            if self.db is not None:
+                return self.db.focus_load()
+            if os.path.exists(self.path):
+                with open(self.path, encoding="utf-8") as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"❌ 加载近期关注事件失败: {e}")
+        return None
+
+    def _load(self):
+        events = self._read()
+        if events is None:
+            return
+
+        # 兼容历史数据：为缺少 id 的事件补齐
+        fixed = []
+        with self._lock:
+            for event in events:
+                if not event.get("id"):
+                    event["id"] = f"temp_{uuid4().hex}"
+                    fixed.append(event)
+                self._insert(event)
+            expired = self._pop_expired(time.time())
+            self._rebuild_snapshot()
+            if fixed or expired:
+                self._persist(upserts=[e for e in fixed if e["id"] in self._events], deletes=expired)
+        if expired:
+            print(f"🧹 已清理 {len(expired)} 个过期的关注事件")
+            self._notify_expired(expired)
+
+    def _insert(self, event: Dict):
+        expire_at = _expire_epoch(event)
+        self._events[event["id"]] = event
+        self._expiry[event["id"]] = expire_at
+        heapq.heappush(self._heap, (expire_at, event["id"]))
+
+    def _pop_expired(self, now: float) -> List[str]:
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            expire_at, event_id = heapq.heappop(self._heap)
+            # 惰性删除：跳过已被移除或过期时间已被修改的旧堆项
+            if self._expiry.get(event_id) != expire_at:
+                continue
+            self._events.pop(event_id, None)
+            self._expiry.pop(event_id, None)
+            expired.append(event_id)
+        return expired
+
+    def _rebuild_snapshot(self):
+        self._snapshot = tuple(self._events.values())
+        self._next_expiry = min(self._expiry.values(), default=math.inf)
+
+    def _persist(self, upserts: List[Dict] = (), deletes: List[str] = ()):
+        """
+        SQLite 后端只写入变化的事件行；JSON 后端原子写入整个文件（先写临时文件再替换）。
+        """
+        if self.db is not None:
+            try:
+                with self.db.transaction():
+                    self.db.focus_upsert(list(upserts))
+                    self.db.focus_delete(list(deletes))
+            except Exception as e:
+                print(f"❌ 保存近期关注事件失败: {e}")
+            self._changed()
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(list(self._events.values()), f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"❌ 保存近期关注事件失败: {e}")
+
+    def _commit(self, upserts: List[Dict] = (), deletes: List[str] = ()):
+        """快照重建 + 落盘 + 唤醒清理线程（以便按新的最早过期时间重新计时）。"""
+        self._rebuild_snapshot()
+        self._persist(upserts, deletes)
+        self._wakeup.notify_all()
+
+    def _changed(self):
+        if self.on_change is not None:
+            try:
+                self.on_change()
+            except Exception as e:
+                print(f"⚠️ 关注事件变更通知失败: {e}")
+
+    def _notify_expired(self, expired: List[str]):
+        if self.on_expire and expired:
+            try:
+                self.on_expire(expired)
+            except Exception as e:
+                print(f"⚠️ 关注事件过期回调失败: {e}")
+
+    # --- 后台清理 ---
+    def _sweeper_loop(self):
+        while True:
+            with self._lock:
+                if self._stopped:
+                    return
+                timeout = min(max(self._next_expiry - time.time(), 0.0), self.MAX_SWEEP_INTERVAL)
+                if timeout > 0:
+                    self._wakeup.wait(timeout)
+                    if self._stopped:
+                        return
+            self.sweep()
+
+    def start(self):
+        """启动后台清理线程（幂等）。"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._sweeper_loop, name="FocusEventSweeper", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    # --- 公共接口 ---
+    def reload(self):
+        """从持久化存储重新加载事件（其他进程修改了关注事件时调用），并让清理线程按新的最早过期时间计时。"""
+        events = self._read()
+        if events is None:
+            return
+        with self._lock:
+            self._events.clear()
+            self._expiry.clear()
+            self._heap = []
+            for event in events:
+                if event.get("id"):
+                    self._insert(event)
+            self._rebuild_snapshot()
+            self._wakeup.notify_all()
+
+    def snapshot(self) -> List[Dict]:
+        """
+        返回当前有效事件（只读）。
+        正常情况下直接返回快照；若清理线程尚未运行到期处理，则按预解析的过期时间就地过滤。
+        """
+        snapshot = self._snapshot
+        if time.time() < self._next_expiry:
+            return list(snapshot)
+        now = time.time()
+        expiry = self._expiry
+        return [e for e in snapshot if expiry.get(e["id"], math.inf) > now]
+
+    def add(self, event: Dict) -> Dict:
+        if not event.get("id"):
+            event["id"] = f"temp_{uuid4().hex}"
+        with self._lock:
+            self._insert(event)
+            self._commit(upserts=[event])
+        return event
+
+    def remove_many(self, ids: List[str]) -> int:
+        with self._lock:
+            removed = []
+            for event_id in ids:
+                if self._events.pop(event_id, None) is not None:
+                    self._expiry.pop(event_id, None)
+                    removed.append(event_id)
+            if removed:
+                self._commit(deletes=removed)
+            return len(removed)
+
+    def update_expire_time(self, event_id: str, new_expire_time: str) -> bool:
+        with self._lock:
+            event = self._events.get(event_id)
+            if event is None:
+                return False
+            event["expire_time"] = new_expire_time
+            expire_at = _expire_epoch(event)
+            self._expiry[event_id] = expire_at
+            heapq.heappush(self._heap, (expire_at, event_id))
+            self._commit(upserts=[event])
+            return True
+
+    def sweep(self) -> List[str]:
+        """立即移除所有已过期事件，返回被移除的事件ID。"""
+        with self._lock:
+            expired = self._pop_expired(time.time())
+            if expired:
+                self._commit(deletes=expired)
+            else:
+                self._next_expiry = min(self._expiry.values(), default=math.inf)
+        if expired:
+            print(f"🧹 已清理 {len(expired)} 个过期的关注事件")
+            self._notify_expired(expired)
+        return expired
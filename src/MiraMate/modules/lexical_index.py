@@ -0,0 +1,287 @@
+"""
+本地词法倒排索引（BM25）
+- 与每个 ChromaDB 集合并行维护，弥补向量检索对人名、日期、专有名词等精确匹配召回不足的问题
+- 分词采用字符 n-gram：中文连续片段切为二元组（单字片段保留单字），英文/数字按整词切分
+- 通过 add/remove 增量更新，并以追加写的 jsonl 日志持久化，启动时回放日志重建索引；
+  日志中被覆盖 / 删除的历史记录达到 compact_every 条后，以当前索引（词频表）重写日志
+- 多个 Web worker 共用同一日志时（传入跨进程锁 lock）：写入与压缩在跨进程锁内进行，
+  写入前先追上其他进程追加的记录；检索前按文件偏移读取新增的完整行，日志被压缩（文件被替换）时整体重新加载
+"""
+import json
+import math
+import os
+import re
+import threading
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Callable, ContextManager, Dict, Iterable, List, Optional, Tuple
+
+# 中文（含扩展区）连续片段 / 英文数字连续片段
+_TOKEN_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[a-z0-9]+")
+_CJK_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+
+
+def tokenize(text: str) -> List[str]:
+    """将文本切分为用于倒排索引的词元列表（保留重复，用于计算词频）。"""
+    if not text:
+        return []
+    tokens: List[str] = []
+    for run in _TOKEN_PATTERN.findall(text.lower()):
+        if _CJK_PATTERN.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def reciprocal_rank_fusion(ranked_lists: Iterable[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """
+    倒数排名融合（RRF）：score(d) = Σ 1 / (k + rank_i(d))，rank 从 1 开始。
+    返回按融合分数降序排列的 (id, score) 列表。
+    """
+    scores: Dict[str, float] = defaultdict(float)
+    for ranked in ranked_lists:
+        for rank, doc_id in enumerate(ranked, start=1):
+            scores[doc_id] += 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+
+class BM25Index:
+    """
+    一个线程安全的、可增量更新的 BM25 倒排索引。
+    仅保存词频与文档长度，文档正文由对应的 ChromaDB 集合负责存储。
+    """
+
+    def __init__(self, name: str, persist_path: Optional[str] = None,
+                 k1: float = 1.5, b: float = 0.75, compact_every: int = 500,
+                 lock: Optional[Callable[[], ContextManager]] = None):
+        """
+        :param name: 索引名称（通常与集合名一致）。
+        :param persist_path: jsonl 日志路径；为 None 时仅在内存中维护。
+        :param compact_every: 日志中失效记录（被覆盖或删除）达到多少条后重写日志。
+        :param lock: 跨进程锁的工厂（多个进程共用同一日志时提供），为 None 时日志只由本进程写入。
+        """
+        self.name = name
+        self.persist_path = persist_path
+        self.k1 = k1
+        self.b = b
+        self.compact_every = compact_every
+
+        # 倒排表结构: { token: { doc_id: tf } }
+        self._postings: Dict[str, Dict[str, int]] = defaultdict(dict)
+        # 正排表结构: { doc_id: { token: tf } }，用于删除时定位倒排项
+        self._doc_terms: Dict[str, Dict[str, int]] = {}
+        self._doc_len: Dict[str, int] = {}
+        self._total_len = 0
+        # 日志中的记录条数（自上次重写以来），减去现存文档数即为失效记录数
+        self._log_records = 0
+        # 已应用到的日志位置：(设备号, inode) 标识当前日志文件，_log_pos 为已读取的字节偏移
+        self._log_id: Optional[Tuple[int, int]] = None
+        self._log_pos = 0
+        self._process_lock = lock
+        self._lock = threading.Lock()
+
+        if self.persist_path:
+            os.makedirs(os.path.dirname(self.persist_path), exist_ok=True)
+            with self._exclusive():
+                self._maybe_compact()
+
+    def __len__(self) -> int:
+        return len(self._doc_len)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._doc_len
+
+    # --- 内部：索引结构维护（调用方需持有锁） ---
+    def _index_doc(self, doc_id: str, text: str):
+        term_freqs: Dict[str, int] = defaultdict(int)
+        for token in tokenize(text):
+            term_freqs[token] += 1
+        self._index_terms(doc_id, term_freqs)
+
+    def _index_terms(self, doc_id: str, term_freqs: Dict[str, int]):
+        if doc_id in self._doc_len:
+            self._unindex_doc(doc_id)
+        for token, tf in term_freqs.items():
+            self._postings[token][doc_id] = tf
+        self._doc_terms[doc_id] = dict(term_freqs)
+        length = sum(term_freqs.values())
+        self._doc_len[doc_id] = length
+        self._total_len += length
+
+    def _unindex_doc(self, doc_id: str) -> bool:
+        term_freqs = self._doc_terms.pop(doc_id, None)
+        if term_freqs is None:
+            return False
+        for token in term_freqs:
+            posting = self._postings.get(token)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self._postings[token]
+        self._total_len -= self._doc_len.pop(doc_id, 0)
+        return True
+
+    def _clear(self):
+        self._postings.clear()
+        self._doc_terms.clear()
+        self._doc_len.clear()
+        self._total_len = 0
+
+    # --- 内部：持久化 ---
+    @contextmanager
+    def _exclusive(self):
+        """写入边界：跨进程锁（若有）+ 线程锁，并先应用其他进程追加的日志记录。"""
+        with self._process_lock() if self._process_lock is not None else nullcontext():
+            with self._lock:
+                if self.persist_path:
+                    self._follow_log()
+                yield
+
+    def _apply_record(self, record: Dict):
+        self._log_records += 1
+        if record.get("op") == "del":
+            self._unindex_doc(record.get("id", ""))
+        elif record.get("id") and "terms" in record:
+            self._index_terms(record["id"], record["terms"])
+        elif record.get("id"):
+            self._index_doc(record["id"], record.get("text", ""))
+
+    def _follow_log(self):
+        """
+        （需持有线程锁）应用日志中尚未读取的完整行；损坏的行会被跳过。
+        首次调用即回放整个日志；日志文件被替换（其他进程压缩）或变短时清空后重新加载。
+        """
+        try:
+            stat = os.stat(self.persist_path)
+        except FileNotFoundError:
+            return
+        try:
+            file_id = (stat.st_dev, stat.st_ino)
+            if file_id != self._log_id or stat.st_size < self._log_pos:
+                self._clear()
+                self._log_id, self._log_pos, self._log_records = file_id, 0, 0
+            if stat.st_size == self._log_pos:
+                return
+            with open(self.persist_path, "rb") as f:
+                f.seek(self._log_pos)
+                data = f.read()
+            # 只应用以换行结尾的完整记录（其他进程可能正在追加）
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                try:
+                    record = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    continue
+                if isinstance(record, dict):
+                    self._apply_record(record)
+            self._log_pos += end
+        except Exception as e:
+            print(f"⚠️ 词法索引 '{self.name}' 日志加载失败: {e}")
+
+    def _append_log(self, records: List[Dict]):
+        if not self.persist_path or not records:
+            return
+        try:
+            with open(self.persist_path, "ab") as f:
+                # 上次异常退出留下的不完整行：另起一行，避免与新记录拼接成一条损坏的记录
+                prefix = b"\n" if f.tell() > self._log_pos else b""
+                f.write(prefix + "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8"))
+                self._log_pos = f.tell()
+            if self._log_id is None:
+                stat = os.stat(self.persist_path)
+                self._log_id = (stat.st_dev, stat.st_ino)
+            self._log_records += len(records)
+        except Exception as e:
+            print(f"❌ 词法索引 '{self.name}' 日志写入失败: {e}")
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        if self.persist_path and self._log_records - len(self._doc_len) >= self.compact_every:
+            self._rewrite_log()
+
+    def _rewrite_log(self):
+        """以当前索引的词频表重写日志，丢弃历史中的删除/覆盖记录。"""
+        if not self.persist_path:
+            return
+        tmp_path = self.persist_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for doc_id, term_freqs in self._doc_terms.items():
+                    f.write(json.dumps({"op": "add", "id": doc_id, "terms": term_freqs}, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.persist_path)
+            stat = os.stat(self.persist_path)
+            self._log_id, self._log_pos = (stat.st_dev, stat.st_ino), stat.st_size
+            self._log_records = len(self._doc_terms)
+        except Exception as e:
+            print(f"❌ 词法索引 '{self.name}' 日志压缩失败: {e}")
+
+    # --- 公共接口 ---
+    def add(self, doc_id: str, text: str):
+        """增量添加（或覆盖）一篇文档。"""
+        with self._exclusive():
+            self._index_doc(doc_id, text)
+            self._append_log([{"op": "add", "id": doc_id, "text": text}])
+
+    def remove(self, doc_id: str) -> bool:
+        """从索引中删除一篇文档，返回是否存在。"""
+        with self._exclusive():
+            removed = self._unindex_doc(doc_id)
+            if removed:
+                self._append_log([{"op": "del", "id": doc_id}])
+            return removed
+
+    def bulk_load(self, ids: List[str], documents: List[str]):
+        """用一批完整数据重建索引（例如首次从 ChromaDB 回填），并重写日志。"""
+        with self._exclusive():
+            self._clear()
+            for doc_id, text in zip(ids, documents):
+                self._index_doc(doc_id, text or "")
+            self._rewrite_log()
+
+    def search(self, query: str, n_results: int = 5,
+               min_idf_coverage: float = 0.3) -> List[Tuple[str, float]]:
+        """
+        BM25 检索，返回按分数降序的 (doc_id, score) 列表。
+
+        :param min_idf_coverage: 文档命中的查询词元 IDF 之和占查询（语料中出现过的）词元 IDF 总和的最小比例，
+                                 用于过滤仅命中常见字片段的噪声结果。
+        """
+        query_tokens = set(tokenize(query))
+        if not query_tokens:
+            return []
+
+        with self._lock:
+            if self._process_lock is not None:
+                self._follow_log()
+            n_docs = len(self._doc_len)
+            if n_docs == 0:
+                return []
+            avg_len = self._total_len / n_docs if n_docs else 0.0
+
+            scores: Dict[str, float] = defaultdict(float)
+            matched_idf: Dict[str, float] = defaultdict(float)
+            idf_total = 0.0
+            for token in query_tokens:
+                posting = self._postings.get(token)
+                if not posting:
+                    continue
+                df = len(posting)
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                idf_total += idf
+                for doc_id, tf in posting.items():
+                    norm = 1 - self.b + self.b * (self._doc_len[doc_id] / avg_len if avg_len else 0.0)
+                    scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+                    matched_idf[doc_id] += idf
+
+        if idf_total <= 0:
+            return []
+        hits = [
+            (doc_id, score) for doc_id, score in scores.items()
+            if matched_idf[doc_id] / idf_total >= min_idf_coverage
+        ]
+        hits.sort(key=lambda x: x[1], reverse=True)
+        return hits[:n_results]
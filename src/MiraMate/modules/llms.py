@@ -1,13 +1,14 @@
-from math import fabs
 import os
 import json
-from typing import Dict, Any
+import threading
+from typing import Dict, Any, Optional, Tuple
 
-from langchain_openai import ChatOpenAI
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.language_models import LanguageModelInput
 from langchain_core.language_models.chat_models import BaseChatModel
-from sympy import false
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import Runnable
 from MiraMate.modules.settings import get_project_root as _settings_project_root
+from MiraMate.modules.startup import components
 
 PROJECT_ROOT = str(_settings_project_root())
 LLM_CONFIG_PATH = os.path.join(PROJECT_ROOT, "configs", "llm_config.json")
@@ -33,8 +34,9 @@ def create_llm_from_config(config: Dict[str, Any], is_main_llm: bool = False, **
 
     print(f"正在创建模型实例: [Type: {api_type}, Model: {model_name}]")
 
-    # --- 根据 api_type 动态选择要实例化的类 ---
+    # --- 根据 api_type 动态选择要实例化的类（各提供方的 SDK 按需导入） ---
     if api_type == "openai":
+        from langchain_openai import ChatOpenAI
         return ChatOpenAI(
             model=model_name,
             api_key=api_key,
@@ -46,6 +48,7 @@ def create_llm_from_config(config: Dict[str, Any], is_main_llm: bool = False, **
     elif api_type == "gemini":
         # 对于 Gemini，构造函数中没有 streaming 参数。
         # LangChain 会在调用 .stream() 时自动处理流式请求。
+        from langchain_google_genai import ChatGoogleGenerativeAI
         return ChatGoogleGenerativeAI(
             model=model_name,
             google_api_key=api_key,
@@ -113,10 +116,73 @@ def load_llms_from_json(config_path: str) -> tuple[BaseChatModel, BaseChatModel]
 
     return main_llm_instance, small_llm_instance
 
-# --- 模块主逻辑：加载模型并导出 ---
-main_llm, small_llm = load_llms_from_json(LLM_CONFIG_PATH)
+# --- 惰性加载：导入本模块不再创建模型客户端，首次调用或启动预热时才加载 ---
+_llms: Optional[Tuple[Optional[BaseChatModel], Optional[BaseChatModel]]] = None
+_llms_lock = threading.Lock()
+components.register("llms")
 
-if main_llm is None or small_llm is None:
-    print("⚠️ 由于模型加载失败，应用可能无法正常运行。请检查配置文件。")
-else:
-    print("✅ 主模型和次模型已成功加载！")
\ No newline at end of file
+
+def get_llms() -> Tuple[Optional[BaseChatModel], Optional[BaseChatModel]]:
+    """返回 (main_llm, small_llm) 实例，首次调用时从配置文件加载（进程内只加载一次）。"""
+    global _llms
+    if _llms is None:
+        with _llms_lock:
+            if _llms is None:
+                try:
+                    with components.track("llms"):
+                        loaded = load_llms_from_json(LLM_CONFIG_PATH)
+                        if loaded[0] is None or loaded[1] is None:
+                            raise RuntimeError(f"LLM 配置无效: {LLM_CONFIG_PATH}")
+                    print("✅ 主模型和次模型已成功加载！")
+                except Exception as e:
+                    print(f"⚠️ 由于模型加载失败，应用可能无法正常运行。请检查配置文件。({e})")
+                    loaded = (None, None)
+                _llms = loaded
+    return _llms
+
+
+class LazyLLM(Runnable[LanguageModelInput, BaseMessage]):
+    """
+    LLM 的惰性代理，可直接用于 `prompt | llm | parser` 链中。
+    链在模块导入时即可组装，真正的模型客户端在第一次调用时才创建；调用全部转发给真实模型，
+    因此回调、流式输出与直接使用模型时一致。
+    """
+
+    def __init__(self, role: str):
+        self.role = role
+
+    def get_name(self, suffix: Optional[str] = None, *, name: Optional[str] = None) -> str:
+        llm = _llms[0 if self.role == "main" else 1] if _llms else None
+        if llm is not None:
+            return llm.get_name(suffix, name=name)
+        return super().get_name(suffix, name=name or f"LazyLLM[{self.role}]")
+
+    def _llm(self) -> BaseChatModel:
+        llm = get_llms()[0 if self.role == "main" else 1]
+        if llm is None:
+            raise RuntimeError(f"{self.role} LLM 未能加载，请检查配置文件: {LLM_CONFIG_PATH}")
+        return llm
+
+    def invoke(self, input, config=None, **kwargs):
+        return self._llm().invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        return await self._llm().ainvoke(input, config, **kwargs)
+
+    def batch(self, inputs, config=None, *, return_exceptions=False, **kwargs):
+        return self._llm().batch(inputs, config, return_exceptions=return_exceptions, **kwargs)
+
+    async def abatch(self, inputs, config=None, *, return_exceptions=False, **kwargs):
+        return await self._llm().abatch(inputs, config, return_exceptions=return_exceptions, **kwargs)
+
+    def stream(self, input, config=None, **kwargs):
+        yield from self._llm().stream(input, config, **kwargs)
+
+    async def astream(self, input, config=None, **kwargs):
+        async for chunk in self._llm().astream(input, config, **kwargs):
+            yield chunk
+
+
+# --- 模块导出：保持 `from MiraMate.modules.llms import main_llm, small_llm` 的用法不变 ---
+main_llm = LazyLLM("main")
+small_llm = LazyLLM("small")
\ No newline at end of file
@@ -0,0 +1,97 @@
+"""
+记忆缓存预去重（在调用模型整合之前于本地完成）
+- 完全重复：规范化文本（去空白与标点、小写）相同的条目只保留最新的一条
+- 近似重复：对缓存条目批量编码，余弦相似度不低于 MIRAMATE_DEDUP_SIMILARITY 的条目聚为一簇，
+  每簇保留最新的一条，并把簇内其他条目的标签并入
+- 已有记忆：以条目向量查询对应集合的近邻，取出近邻的原始内容重新编码后比较（存储的文档带有时间 / 来源等
+  包装文字，直接比较会低估相似度），与已有记忆近似重复的条目直接丢弃
+只有剩下的新内容才交给模型整合，既节省 token，也避免向量库被重复的事实不断撑大。
+"""
+import os
+import re
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+DEDUP_ENABLED = os.getenv("MIRAMATE_DEDUP_ENABLED", "1").strip().lower() in ("1", "true", "yes", "on")
+DEDUP_SIMILARITY = float(os.getenv("MIRAMATE_DEDUP_SIMILARITY", "0.95"))
+# 每个缓存条目比较的已有记忆近邻数
+DEDUP_NEIGHBORS = 3
+
+# 缓存类型 → 对应的记忆集合
+DEDUP_TARGETS = {
+    "fact": "facts",
+    "preference": "user_preferences",
+}
+# 集合 → 文档中原始内容前的标记，与 save_fact_memory / save_user_preference 的文档格式一致
+CONTENT_MARKERS = {
+    "facts": "事实内容：",
+    "user_preferences": "偏好内容：",
+}
+
+_PUNCTUATION = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def normalize_text(text: str) -> str:
+    return _PUNCTUATION.sub("", (text or "").lower())
+
+
+def extract_content(document: str, marker: str) -> str:
+    """从存储的文档中取出原始内容（marker 之后的部分）；找不到标记时返回整个文档。"""
+    _, found, content = (document or "").rpartition(marker)
+    return content if found else (document or "")
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def cluster_near_duplicates(vectors: np.ndarray, threshold: float) -> List[List[int]]:
+    """
+    贪心聚类：按输入顺序依次处理，与某个已有簇首的相似度不低于阈值即并入该簇，否则自成一簇。
+    调用方把希望保留的条目（例如最新的）排在前面，簇首即为保留项。返回各簇的下标列表（簇首在前）。
+    """
+    unit = normalize_rows(vectors)
+    similarity = unit @ unit.T
+    leaders: List[int] = []
+    clusters: Dict[int, List[int]] = {}
+    for i in range(len(unit)):
+        if leaders:
+            scores = similarity[i, leaders]
+            best = int(np.argmax(scores))
+            if scores[best] >= threshold:
+                clusters[leaders[best]].append(i)
+                continue
+        leaders.append(i)
+        clusters[i] = [i]
+    return [clusters[leader] for leader in leaders]
+
+
+def dedup_within(entries: Sequence[Dict], vectors: np.ndarray, threshold: float) -> Tuple[List[int], Dict[int, List[int]]]:
+    """
+    缓存内去重：先合并规范化文本相同的条目，再按向量聚类。
+    返回 (保留条目的下标, {保留下标: [被合并的下标]})；保留项为各簇中时间戳最新的条目。
+    """
+    order = sorted(range(len(entries)), key=lambda i: entries[i].get("timestamp") or "", reverse=True)
+    merged: Dict[int, List[int]] = {}
+    seen_text: Dict[str, int] = {}
+    candidates: List[int] = []
+    for i in order:
+        key = normalize_text(entries[i].get("content", ""))
+        if key and key in seen_text:
+            merged[seen_text[key]].append(i)
+            continue
+        if key:
+            seen_text[key] = i
+        merged[i] = []
+        candidates.append(i)
+    if len(candidates) > 1:
+        for cluster in cluster_near_duplicates(vectors[candidates], threshold):
+            leader = candidates[cluster[0]]
+            for member in cluster[1:]:
+                index = candidates[member]
+                merged[leader].extend([index, *merged.pop(index)])
+    kept = [i for i in candidates if i in merged]
+    return kept, {i: merged[i] for i in kept}
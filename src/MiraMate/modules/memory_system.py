@@ -6,15 +6,32 @@ import os
 os.environ["TRANSFORMERS_OFFLINE"] = "1"
 os.environ["HF_DATASETS_OFFLINE"] = "1"
 
-import chromadb
-from datetime import datetime, timezone
-from typing import List, Dict, Optional
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, List, Dict, Optional, Tuple
 from uuid import uuid4
-from chromadb.utils import embedding_functions
+
+import numpy as np
 from MiraMate.modules.settings import (
     get_project_root as _settings_project_root,
     get_memory_dir,
 )
+from MiraMate.modules.lexical_index import BM25Index, reciprocal_rank_fusion
+from MiraMate.modules.tag_index import TagIndex
+from MiraMate.modules.focus_event_store import FocusEventStore, parse_iso_datetime
+from MiraMate.modules.profile_store import ProfileStore
+from MiraMate.modules.consolidation_checkpoint import CheckpointStore
+from MiraMate.modules.memory_dedup import (
+    CONTENT_MARKERS, DEDUP_ENABLED, DEDUP_NEIGHBORS, DEDUP_SIMILARITY, DEDUP_TARGETS,
+    dedup_within, extract_content, normalize_rows, normalize_text,
+)
+from MiraMate.modules.state_store import get_state_store
+from MiraMate.modules.shared_state import get_shared_state
+from MiraMate.modules.startup import components, LazyProxy
+from MiraMate.modules import registry
+from MiraMate.modules.embeddings import chroma_embeddings, create_backend, create_embedding_function, mmr_select
+from MiraMate.modules.embedding_worker import EMBEDDING_WORKER_ENABLED, create_worker_backend
 
 # === 🧠 一、通用结构定义 ===
 
@@ -58,9 +75,46 @@ TEMP_FOCUS_EVENTS_PATH = os.path.join(BASE_DIR, "temp_focus_events.json")
 PREFERENCE_CACHE_PATH = os.path.join(BASE_DIR, "preference_cache.json")
 FACT_CACHE_PATH = os.path.join(BASE_DIR, "fact_cache.json")
 PROFILE_CACHE_PATH = os.path.join(BASE_DIR, "profile_cache.json")
+# 缓存类型 → JSON 文件（仅在 json 后端下使用）
+CACHE_FILE_PATHS = {
+    "preference": PREFERENCE_CACHE_PATH,
+    "fact": FACT_CACHE_PATH,
+    "profile": PROFILE_CACHE_PATH,
+}
+# 长期记忆的合并写入：新事实 / 偏好与已有记忆的内容相似度不低于该值时原地更新，而不是新增一条
+MEMORY_UPSERT = os.getenv("MIRAMATE_MEMORY_UPSERT", "1").strip().lower() in ("1", "true", "yes", "on")
+MEMORY_MERGE_SIMILARITY = float(os.getenv("MIRAMATE_MEMORY_MERGE_SIMILARITY", "0.9"))
+
+# 空闲整理检查点（仅在 json 后端下使用）
+CONSOLIDATION_CHECKPOINT_PATH = os.path.join(BASE_DIR, "consolidation_checkpoints.json")
 
 # ChromaDB 存储目录
 CHROMA_DB_DIR = os.path.join(BASE_DIR, "chroma_db")
+# 独立的 Chroma 服务（chroma run）；多个 Web worker 时必须设置，PersistentClient 不支持多进程同时打开同一目录
+CHROMA_HOST = os.getenv("MIRAMATE_CHROMA_HOST", "").strip()
+CHROMA_PORT = int(os.getenv("MIRAMATE_CHROMA_PORT", "8000"))
+
+# 多进程部署时通知其他 worker 重新加载画像 / 标签 / 关注事件的频道
+MEMORY_STATE_CHANNEL = "memory_state"
+
+# 词法倒排索引（BM25）目录，与各 ChromaDB 集合一一对应
+LEXICAL_INDEX_DIR = os.path.join(BASE_DIR, "lexical_index")
+
+# 混合检索时倒数排名融合（RRF）的平滑常数
+RRF_K = 60
+
+# MMR 多样性重排的 λ（越大越偏向相关度）；未设置时不做 MMR 重排
+MMR_LAMBDA = float(os.environ["MIRAMATE_MMR_LAMBDA"]) if os.getenv("MIRAMATE_MMR_LAMBDA") else None
+# 开启 MMR 时每个集合先取 n_results × MMR_FETCH_FACTOR 个候选再重排
+MMR_FETCH_FACTOR = 3
+
+# 词法检索命中时，用于补全记忆条目的各集合专有字段及默认值
+COLLECTION_EXTRA_FIELDS = {
+    "dialog_logs": {"topic": "", "sentiment": "", "importance": 0.0},
+    "facts": {"source": "", "confidence": 1.0},
+    "user_preferences": {"type": ""},
+    "important_events": {"event_type": "", "summary": ""},
+}
 
 # 创建必要的目录
 os.makedirs(BASE_DIR, exist_ok=True)
@@ -70,22 +124,43 @@ os.makedirs(CHROMA_DB_DIR, exist_ok=True)
 
 class MemorySystem:
     def __init__(self, persist_directory=None):
-        """初始化记忆系统"""
+        """
+        初始化记忆系统。进程内只应存在一个实例，请通过 get_memory_system() / memory_system 获取；
+        重复构造会在加载嵌入模型之前被注册表拒绝（DuplicateInstanceError）。
+        """
+        registry.claim("memory_system", self)
+        try:
+            self._initialize(persist_directory)
+        except BaseException:
+            registry.release("memory_system", self)
+            raise
+
+    def _initialize(self, persist_directory):
         if persist_directory is None:
             persist_directory = CHROMA_DB_DIR
         
         # 创建持久化目录
         os.makedirs(persist_directory, exist_ok=True)
         
-        # 初始化ChromaDB客户端
-        self.client = chromadb.PersistentClient(path=persist_directory)
-        print(f"✅ ChromaDB客户端已初始化，持久化目录: {persist_directory}")
-
-        # 配置嵌入函数
-        self.embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name="BAAI/bge-base-zh-v1.5",
-            device="cpu"
-        )
+        # ChromaDB 与嵌入模型较重，在构建实例时才导入（导入本模块本身不触发）
+        import chromadb
+
+        # 多个 Web worker 共用记忆时，向量库只能由一个 Chroma 服务进程持有
+        shared_state = get_shared_state()
+        if CHROMA_HOST:
+            self.client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+            print(f"✅ ChromaDB客户端已连接到服务: {CHROMA_HOST}:{CHROMA_PORT}")
+        elif shared_state.shared:
+            raise RuntimeError("多进程共享状态下必须通过 MIRAMATE_CHROMA_HOST 连接 Chroma 服务，"
+                               "PersistentClient 不支持多个进程同时打开同一目录")
+        else:
+            self.client = chromadb.PersistentClient(path=persist_directory)
+            print(f"✅ ChromaDB客户端已初始化，持久化目录: {persist_directory}")
+
+        # 配置嵌入函数：后端由 MIRAMATE_EMBEDDING_BACKEND 选择（torch / onnx-int8），同一模型 bge-base-zh-v1.5；
+        # MIRAMATE_EMBEDDING_WORKER=1 时模型放在独立的工作进程中，本进程只通过队列提交（微批）请求
+        self.embedding_backend = create_worker_backend() if EMBEDDING_WORKER_ENABLED else create_backend()
+        self.embedding_function = create_embedding_function(self.embedding_backend)
 
         # 定义HNSW索引参数
         self.hnsw_metadata_config = {
@@ -119,6 +194,228 @@ class MemorySystem:
             )
         }
 
+        # 为每个集合维护一个并行的 BM25 词法索引
+        self.lexical_indexes = self._init_lexical_indexes(shared_state)
+
+        # 画像、缓存、标签、关注事件统一存放在 SQLite（WAL）中；json 后端下为 None，沿用各自的 JSON 文件
+        self.state_store = get_state_store()
+        if shared_state.shared and self.state_store is None:
+            raise RuntimeError("多进程共享状态下不支持 MIRAMATE_STATE_BACKEND=json，请使用 sqlite 状态存储")
+        # 多进程部署时，本进程写入后通知其他 worker 从 SQLite 重新加载
+        publish = self._publish_state_change if shared_state.shared else None
+
+        # 用户画像常驻内存，供对话链与空闲整理共享同一对象
+        self.profile_store = ProfileStore(PROFILE_PATH, db=self.state_store)
+        if publish:
+            self.profile_store.subscribe(lambda *_: publish("profile"))
+
+        # 跨所有记忆存储的标签倒排索引
+        self.tag_index = TagIndex(ACTIVE_TAGS_PATH, db=self.state_store,
+                                  on_change=(lambda: publish("tags")) if publish else None)
+
+        # 临时关注事件常驻内存，并由后台线程在最近的过期时间点清理
+        self.focus_events = FocusEventStore(TEMP_FOCUS_EVENTS_PATH, on_expire=self._on_focus_events_expired,
+                                            db=self.state_store,
+                                            on_change=(lambda: publish("focus_events")) if publish else None)
+        self.focus_events.start()
+
+        if publish:
+            self._state_reloaded_at: Dict[str, float] = {}
+            shared_state.subscribe(MEMORY_STATE_CHANNEL, self._on_state_changed)
+
+        # 空闲整理的检查点（模型输出与已提交进度），整理被打断或崩溃后从检查点继续
+        self.consolidation_checkpoints = CheckpointStore(CONSOLIDATION_CHECKPOINT_PATH, db=self.state_store)
+
+        # 缓存写入通知（IdleProcessor 据此按缓存条目数触发整理，无需轮询）
+        self._cache_listeners: List[Callable[[str], None]] = []
+
+        if not self.tag_index.has_members:
+            self._backfill_tag_index()
+
+    # --- 内部：多进程同步 ---
+    def _publish_state_change(self, store: str):
+        try:
+            get_shared_state().publish(MEMORY_STATE_CHANNEL,
+                                       {"origin": os.getpid(), "store": store, "ts": time.time()})
+        except Exception as e:
+            print(f"⚠️ 通知其他进程记忆变更失败: {e}")
+
+    def _on_state_changed(self, message: Dict):
+        """其他 worker 修改了画像 / 标签 / 关注事件：从 SQLite 重新加载本进程的内存副本。"""
+        if message.get("origin") == os.getpid():
+            return
+        name = message.get("store")
+        store = {"profile": self.profile_store, "tags": self.tag_index, "focus_events": self.focus_events}.get(name)
+        # 同一批到达的多条通知只需重新加载一次：变更早于上次开始加载的时间时已包含在内
+        if store is None or message.get("ts", 0) < self._state_reloaded_at.get(name, 0):
+            return
+        self._state_reloaded_at[name] = time.time()
+        store.reload()
+
+    # --- 内部：标签索引 ---
+    def _backfill_tag_index(self):
+        """旧版 active_tags.json 只有计数，首次加载时从各集合元数据和关注事件回填成员关系。"""
+        linked = 0
+        for collection_key, coll in self.collections.items():
+            try:
+                data = coll.get(include=["metadatas"])
+                for memory_id, metadata in zip(data.get("ids", []) or [], data.get("metadatas", []) or []):
+                    tags = json.loads((metadata or {}).get("tags", "[]"))
+                    if tags:
+                        self.tag_index.link(memory_id, tags, store=collection_key, persist=False)
+                        linked += 1
+            except Exception as e:
+                print(f"⚠️ 回填集合 '{collection_key}' 的标签索引失败: {e}")
+        for event in self.load_temp_focus_events():
+            if event.get("tags"):
+                self.tag_index.link(event["id"], event["tags"], store="focus_events", persist=False)
+                linked += 1
+        self.tag_index.flush()
+        print(f"[MemorySystem] 标签索引回填完成，共关联 {linked} 条记忆")
+
+    # --- 内部：词法索引 ---
+    def _init_lexical_indexes(self, shared_state) -> Dict[str, BM25Index]:
+        """
+        加载各集合对应的 BM25 索引；若索引的文档数与集合不一致（首次升级，或进程在两次写入之间退出导致漂移），
+        则从 ChromaDB 重建一次。
+        """
+        indexes = {}
+        for collection_key, coll in self.collections.items():
+            index = BM25Index(
+                name=collection_key,
+                persist_path=os.path.join(LEXICAL_INDEX_DIR, f"{collection_key}.jsonl"),
+                # 多个 worker 共用同一日志：写入与压缩在跨进程锁内进行
+                lock=(lambda key=collection_key: shared_state.lock(f"lexical-{key}")) if shared_state.shared else None
+            )
+            try:
+                stored = coll.count()
+                if len(index) != stored:
+                    indexed = len(index)
+                    data = coll.get(include=["documents"])
+                    index.bulk_load(data.get("ids", []) or [], data.get("documents", []) or [])
+                    print(f"[MemorySystem] 词法索引 '{collection_key}' 与集合不一致（{indexed} / {stored}），"
+                          f"已从集合重建 {len(index)} 条记录")
+            except Exception as e:
+                print(f"⚠️ 回填集合 '{collection_key}' 的词法索引失败: {e}")
+            indexes[collection_key] = index
+        return indexes
+
+    def _index_document(self, collection_key: str, doc_id: str, document: str):
+        """写入 ChromaDB 成功后，同步更新对应的词法索引。"""
+        try:
+            self.lexical_indexes[collection_key].add(doc_id, document)
+        except Exception as e:
+            print(f"⚠️ 更新集合 '{collection_key}' 的词法索引失败: {e}")
+
+    def _write_memory(self, collection_key: str, memory_id: str, document: str,
+                      metadata: Dict, tags: List[str], idempotent: bool = False):
+        """
+        写入一条记忆并同步词法 / 标签索引。
+        idempotent=True（调用方给定了确定性 ID）时以 upsert 写入：重放同一 ID 覆盖原记录，
+        不会产生重复向量，也不会重复累加标签计数。
+        """
+        coll = self.collections[collection_key]
+        exists = idempotent and bool(coll.get(ids=[memory_id], include=[]).get("ids"))
+        if idempotent:
+            coll.upsert(ids=[memory_id], metadatas=[metadata], documents=[document])
+        else:
+            coll.add(ids=[memory_id], metadatas=[metadata], documents=[document])
+        self._index_document(collection_key, memory_id, document)
+        if exists:
+            # 覆盖已有记忆（重放或合并）：只为新增的标签计数
+            added = [t for t in tags if t and t not in self.tag_index.tags_of(memory_id)]
+            if added:
+                self.tag_index.add(added, store=collection_key)
+            self.tag_index.link(memory_id, tags, store=collection_key)
+        else:
+            self.update_active_tags(tags, memory_id=memory_id, store=collection_key)
+
+    def _build_memory_item(self, collection_key: str, memory_id: str, document: str,
+                           metadata: Dict, similarity: Optional[float]) -> Dict:
+        """按各 search_* 方法的返回格式构造记忆条目。"""
+        metadata = metadata or {}
+        item = {
+            "id": memory_id,
+            "content": document,
+            "metadata": metadata,
+            "tags": json.loads(metadata.get("tags", "[]")),
+            "similarity": similarity,
+            "timestamp": metadata.get("timestamp", "")
+        }
+        for field, default in COLLECTION_EXTRA_FIELDS.get(collection_key, {}).items():
+            item[field] = metadata.get(field, default)
+        return item
+
+    def _fuse_with_lexical(self, collection_key: str, query: str,
+                           vector_hits: List[Dict], n_results: int) -> List[Dict]:
+        """
+        将向量检索结果与 BM25 词法检索结果按 RRF 融合，返回前 n_results 条。
+        仅由词法检索命中的记忆通过 ID 从 ChromaDB 直接读取（不触发嵌入计算），其 similarity 为 None。
+        """
+        try:
+            lexical_hits = self.lexical_indexes[collection_key].search(query, n_results)
+        except Exception as e:
+            print(f"⚠️ 集合 '{collection_key}' 词法检索失败，仅使用向量结果: {e}")
+            return vector_hits
+        if not lexical_hits:
+            return vector_hits
+
+        by_id = {hit["id"]: hit for hit in vector_hits}
+        lexical_scores = dict(lexical_hits)
+        fused = reciprocal_rank_fusion(
+            [[hit["id"] for hit in vector_hits], [doc_id for doc_id, _ in lexical_hits]],
+            k=RRF_K
+        )[:n_results]
+
+        missing_ids = [doc_id for doc_id, _ in fused if doc_id not in by_id]
+        if missing_ids:
+            try:
+                data = self.collections[collection_key].get(ids=missing_ids, include=["documents", "metadatas"])
+                for i, doc_id in enumerate(data.get("ids", []) or []):
+                    by_id[doc_id] = self._build_memory_item(
+                        collection_key, doc_id, data["documents"][i], data["metadatas"][i], None
+                    )
+            except Exception as e:
+                print(f"⚠️ 读取集合 '{collection_key}' 的词法命中记录失败: {e}")
+
+        results = []
+        for doc_id, rrf_score in fused:
+            item = by_id.get(doc_id)
+            if item is None:
+                continue
+            item["rrf_score"] = rrf_score
+            if doc_id in lexical_scores:
+                item["lexical_score"] = lexical_scores[doc_id]
+            results.append(item)
+        return results
+
+    def _query_params(self, query: str, n_results: int, query_embedding: Optional[np.ndarray] = None) -> Dict:
+        """构造集合查询参数：已有查询向量时直接使用，避免同一查询在每个集合上重复编码。"""
+        if query_embedding is not None:
+            return {"query_embeddings": chroma_embeddings(query_embedding[np.newaxis, :]), "n_results": n_results}
+        return {"query_texts": [query], "n_results": n_results}
+
+    def _mmr_rerank(self, collection_key: str, query_vector: np.ndarray, memories: List[Dict],
+                    n_results: int, lambda_mult: float) -> List[Dict]:
+        """
+        对一个集合的候选记忆做 MMR 多样性重排。候选向量按 ID 从 ChromaDB 读取（覆盖仅由词法检索命中的条目），
+        查询向量直接使用借用的共享内存视图。
+        """
+        if len(memories) <= 1:
+            return memories[:n_results]
+        try:
+            data = self.collections[collection_key].get(ids=[m["id"] for m in memories], include=["embeddings"])
+            vectors = dict(zip(data.get("ids", []) or [], data.get("embeddings")))
+        except Exception as e:
+            print(f"⚠️ 读取集合 '{collection_key}' 的候选向量失败，跳过 MMR 重排: {e}")
+            return memories[:n_results]
+        candidates = [m for m in memories if m["id"] in vectors]
+        if not candidates:
+            return memories[:n_results]
+        matrix = np.asarray([vectors[m["id"]] for m in candidates], dtype=np.float32)
+        order = mmr_select(query_vector, matrix, n_results, lambda_mult)
+        return [candidates[i] for i in order]
+
     # --- 内部：安全查询 + 索引自修复 ---
     def _safe_query(self, collection_key: str, search_params: Dict):
         """
@@ -205,53 +502,25 @@ class MemorySystem:
             print(f"❌ 重建集合 '{collection_key}' 索引失败: {e}")
 
     def _parse_iso_datetime(self, dt_str: str) -> Optional[datetime]:
-        """尽可能稳健地解析 ISO 时间戳，返回 UTC 时区的 datetime。
-        兼容示例：
-        - 2025-08-24T00:00:00Z
-        - 2025-08-24T00:00:00.123Z
-        - 2025-08-24T00:00:00+08:00
-        - 2025-08-24 00:00:00  （无时区，按 UTC 处理）
-        """
-        if not isinstance(dt_str, str):
-            return None
-        s = dt_str.strip().replace(' ', 'T')
-        # 兼容以 Z 结尾（UTC）
-        if s.endswith('Z'):
-            s = s[:-1] + '+00:00'
-        try:
-            dt = datetime.fromisoformat(s)
-        except ValueError:
-            return None
-
-        # 统一转为 UTC 有时区时间
-        if dt.tzinfo is None:
-            # 无时区信息时，按 UTC 处理
-            dt = dt.replace(tzinfo=timezone.utc)
-        else:
-            dt = dt.astimezone(timezone.utc)
-        return dt
+        """尽可能稳健地解析 ISO 时间戳，返回 UTC 时区的 datetime（见 focus_event_store.parse_iso_datetime）。"""
+        return parse_iso_datetime(dt_str)
 
     # === 🧍‍♂️ 用户画像 ===
     # 更新策略，每次对话后都异步保存用户画像，避免阻塞主线程，且在智能体空闲时调用模型处理合并重复字段
+    # 画像常驻内存（ProfileStore），读取不触盘，更新在锁内合并并原子落盘
     def save_user_profile(self, profile: Dict):
-        """保存用户画像"""
-        profile["last_updated"] = get_timestamp()
-        with open(PROFILE_PATH, "w", encoding="utf-8") as f:
-            json.dump(profile, f, ensure_ascii=False, indent=2)
-        print(f"✅ 用户画像已保存")
+        """保存用户画像（整体替换）"""
+        version = self.profile_store.replace(profile)
+        print(f"✅ 用户画像已保存 (版本: {version})")
 
     def load_user_profile(self) -> Optional[Dict]:
-        """加载用户画像"""
-        if not os.path.exists(PROFILE_PATH):
-            return None
-        with open(PROFILE_PATH, encoding="utf-8") as f:
-            return json.load(f)
+        """加载用户画像（内存快照，只读）"""
+        return self.profile_store.get()
 
     def update_user_profile(self, **updates):
         """更新用户画像（部分更新）"""
-        profile = self.load_user_profile() or {}
-        profile.update(updates)
-        self.save_user_profile(profile)
+        version = self.profile_store.update(updates)
+        print(f"✅ 用户画像已更新 (版本: {version})")
 
     # === 💬 对话记录记忆 ===
     def save_dialog_log(self, user_input: str, ai_response: str, topic: str, 
@@ -289,7 +558,8 @@ class MemorySystem:
                 documents=[dialog_content]
             )
             print(f"✅ 对话记录已保存: {topic} (重要性: {importance})")
-            self.update_active_tags(tags)
+            self._index_document("dialog_logs", dialog_id, dialog_content)
+            self.update_active_tags(tags, memory_id=dialog_id, store="dialog_logs")
             return dialog_id
         except Exception as e:
             print(f"❌ 保存对话记录失败: {e}")
@@ -297,13 +567,11 @@ class MemorySystem:
 
     def search_dialog_logs(self, query: str, n_results: int = 5, 
                           where_filter: Optional[Dict] = None, 
-                          threshold: float = 0.5) -> List[Dict]:
+                          threshold: float = 0.5,
+                          query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
         """搜索对话记录"""
         try:
-            search_params = {
-                "query_texts": [query],
-                "n_results": n_results
-            }
+            search_params = self._query_params(query, n_results, query_embedding)
             
             if where_filter:
                 search_params["where"] = where_filter
@@ -380,9 +648,10 @@ class MemorySystem:
     # 先存到缓冲文件（持久化），然后在空闲时经过模型处理后保存到ChromaDB
     def save_fact_memory(self, content: str, tags: List[str], 
                         source: str = "dialog", confidence: float = 1.0,
-                        additional_metadata: Optional[Dict] = None):
-        """保存事实记忆到ChromaDB"""
-        fact_id = f"fact_{uuid4().hex}"
+                        additional_metadata: Optional[Dict] = None,
+                        memory_id: Optional[str] = None):
+        """保存事实记忆到ChromaDB（给定 memory_id 时按该 ID 幂等写入）"""
+        fact_id = memory_id or f"fact_{uuid4().hex}"
         timestamp = get_iso_timestamp()
         natural_time = format_natural_time(datetime.now())
         tags_str = "、".join(tags) if tags else "无"
@@ -394,20 +663,16 @@ class MemorySystem:
             "timestamp": timestamp,
             "source": source,
             "confidence": confidence,
-            "tags": json.dumps(tags, ensure_ascii=False)
+            "tags": json.dumps(tags, ensure_ascii=False),
+            "version": 1
         }
         
         if additional_metadata:
             metadata.update(additional_metadata)
         
         try:
-            self.collections["facts"].add(
-                ids=[fact_id],
-                metadatas=[metadata],
-                documents=[fact_content]
-            )
+            self._write_memory("facts", fact_id, fact_content, metadata, tags, idempotent=memory_id is not None)
             print(f"✅ 事实记忆已保存: {content[:30]}... (置信度: {confidence})")
-            self.update_active_tags(tags)
             return fact_id
         except Exception as e:
             print(f"❌ 保存事实记忆失败: {e}")
@@ -415,13 +680,11 @@ class MemorySystem:
 
     def search_fact_memory(self, query: str, n_results: int = 3,
                           where_filter: Optional[Dict] = None,
-                          threshold: float = 0.5) -> List[Dict]:
+                          threshold: float = 0.5,
+                          query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
         """搜索事实记忆"""
         try:
-            search_params = {
-                "query_texts": [query],
-                "n_results": n_results
-            }
+            search_params = self._query_params(query, n_results, query_embedding)
             
             if where_filter:
                 search_params["where"] = where_filter
@@ -463,21 +726,25 @@ class MemorySystem:
             print(f"❌ 搜索事实记忆失败: {e}")
             return []
 
-    def update_fact_confidence(self, fact_id: str, new_confidence: float):
-        """更新事实记忆的置信度"""
+    def _touch_memory(self, collection_key: str, memory_id: str, updates: Dict) -> bool:
+        """只更新记忆的元数据（不重新编码），同时递增版本号并记录更新时间。"""
+        result = self.collections[collection_key].get(ids=[memory_id], include=["metadatas"])
+        if not (result and result["metadatas"]):
+            return False
+        metadata = result["metadatas"][0]
+        metadata.update(updates)
+        metadata["version"] = int(metadata.get("version", 1) or 1) + 1
+        metadata["last_updated"] = get_timestamp()
+        self.collections[collection_key].update(ids=[memory_id], metadatas=[metadata])
+        return True
+
+    def update_fact_confidence(self, fact_id: str, new_confidence: float, merge_key: Optional[str] = None):
+        """更新事实记忆的置信度（版本号随之递增；merge_key 供合并写入判断重放）"""
         try:
-            # 获取现有记忆
-            result = self.collections["facts"].get(ids=[fact_id])
-            if result and result["metadatas"]:
-                metadata = result["metadatas"][0]
-                metadata["confidence"] = new_confidence
-                metadata["last_updated"] = get_timestamp()
-                
-                # 更新记忆
-                self.collections["facts"].update(
-                    ids=[fact_id],
-                    metadatas=[metadata]
-                )
+            updates = {"confidence": new_confidence}
+            if merge_key:
+                updates["merge_key"] = merge_key
+            if self._touch_memory("facts", fact_id, updates):
                 print(f"✅ 事实记忆置信度已更新: {new_confidence}")
                 return True
         except Exception as e:
@@ -488,7 +755,7 @@ class MemorySystem:
     
     def cache_user_preference(self, content: str, preference_type: str, 
                              tags: List[str], confidence: float = 1.0):
-        """缓存用户偏好信息到本地JSON文件"""
+        """缓存用户偏好信息（SQLite 状态库或本地JSON文件）"""
         
         # 创建缓存条目
         cache_entry = {
@@ -501,21 +768,14 @@ class MemorySystem:
             "natural_time": format_natural_time(datetime.now())
         }
         
-        # 读取现有缓存
-        preferences_cache = self._load_cache_file(PREFERENCE_CACHE_PATH)
-        
-        # 添加新条目
-        preferences_cache.append(cache_entry)
-        
-        # 保存缓存
-        self._save_cache_file(PREFERENCE_CACHE_PATH, preferences_cache)
+        self._append_cache("preference", cache_entry)
         
         print(f"✅ 用户偏好已缓存: {preference_type} - {content[:30]}...")
         return cache_entry["id"]
     
     def cache_fact_memory(self, content: str, tags: List[str], 
                          source: str = "dialog", confidence: float = 1.0):
-        """缓存事实记忆到本地JSON文件"""
+        """缓存事实记忆（SQLite 状态库或本地JSON文件）"""
         cache_entry = {
             "id": f"fact_cache_{uuid4().hex}",
             "content": content,
@@ -527,15 +787,13 @@ class MemorySystem:
             "content_length": len(content)
         }
         
-        facts_cache = self._load_cache_file(FACT_CACHE_PATH)
-        facts_cache.append(cache_entry)
-        self._save_cache_file(FACT_CACHE_PATH, facts_cache)
+        self._append_cache("fact", cache_entry)
         
         print(f"✅ 事实记忆已缓存: {content[:30]}... (置信度: {confidence})")
         return cache_entry["id"]
     
     def cache_profile_update(self, profile_data: Dict, source: str = "dialog"):
-        """缓存用户画像更新信息到本地JSON文件"""
+        """缓存用户画像更新信息（SQLite 状态库或本地JSON文件）"""
         
         # 创建缓存条目
         cache_entry = {
@@ -546,18 +804,242 @@ class MemorySystem:
             "natural_time": format_natural_time(datetime.now())
         }
         
-        # 读取现有缓存
-        profile_cache = self._load_cache_file(PROFILE_CACHE_PATH)
-        
-        # 添加新条目
-        profile_cache.append(cache_entry)
-        
-        # 保存缓存
-        self._save_cache_file(PROFILE_CACHE_PATH, profile_cache)
+        self._append_cache("profile", cache_entry)
         
         print(f"✅ 用户画像信息已缓存: {list(profile_data.keys())}")
         return cache_entry["id"]
     
+    def add_cache_listener(self, listener: Callable[[str], None]):
+        """注册缓存写入回调（参数为缓存类型 preference / fact / profile），在写入缓存的线程中调用。"""
+        self._cache_listeners.append(listener)
+
+    def remove_cache_listener(self, listener: Callable[[str], None]):
+        try:
+            self._cache_listeners.remove(listener)
+        except ValueError:
+            pass
+
+    def _append_cache(self, kind: str, cache_entry: Dict):
+        """追加一条缓存：SQLite 后端插入单行，json 后端读改写整个文件"""
+        if self.state_store is not None:
+            try:
+                self.state_store.cache_append(kind, cache_entry)
+            except Exception as e:
+                print(f"❌ 保存缓存失败: {e}")
+                return
+        else:
+            cache_data = self._load_cache_file(CACHE_FILE_PATHS[kind])
+            cache_data.append(cache_entry)
+            self._save_cache_file(CACHE_FILE_PATHS[kind], cache_data)
+        for listener in list(self._cache_listeners):
+            try:
+                listener(kind)
+            except Exception as e:
+                print(f"⚠️ 缓存写入通知失败: {e}")
+
+    def _load_cache(self, kind: str) -> List[Dict]:
+        if self.state_store is not None:
+            return self.state_store.cache_load(kind)
+        return self._load_cache_file(CACHE_FILE_PATHS[kind])
+
+    def _clear_cache(self, kind: str, ids: Optional[List[str]] = None):
+        """清空某类缓存；给定 ids 时只删除这些条目（其余条目、包括期间新写入的条目保留）。"""
+        if self.state_store is not None:
+            self.state_store.cache_clear(kind, ids)
+        elif ids is None:
+            self._save_cache_file(CACHE_FILE_PATHS[kind], [])
+        else:
+            drop = set(ids)
+            cache_data = self._load_cache_file(CACHE_FILE_PATHS[kind])
+            self._save_cache_file(CACHE_FILE_PATHS[kind], [e for e in cache_data if e.get("id") not in drop])
+
+    def _nearest_by_content(self, collection_key: str, vectors: np.ndarray, contents: List[str]) -> List[Optional[Dict]]:
+        """
+        为每个（已归一化的）内容向量找出集合中原始内容最相似的已有记忆：先以向量查询近邻，再取出近邻文档中的
+        原始内容重新编码后比较（文档带有时间 / 来源等包装文字，直接用检索距离会低估相似度）；规范化文本相同视为 1.0。
+        返回与输入等长的列表，元素为 {"id", "similarity", "content", "metadata"}，集合为空时为 None。
+        """
+        coll = self.collections[collection_key]
+        stored = coll.count() if len(contents) else 0
+        if not stored:
+            return [None] * len(contents)
+        marker = CONTENT_MARKERS[collection_key]
+        result = coll.query(
+            query_embeddings=chroma_embeddings(vectors),
+            n_results=min(DEDUP_NEIGHBORS, stored),
+            include=["documents", "metadatas"],
+        )
+        rows = [
+            [(memory_id, extract_content(doc, marker), metadata or {}) for memory_id, doc, metadata in zip(ids, docs, metas)]
+            for ids, docs, metas in zip(result.get("ids") or [], result.get("documents") or [], result.get("metadatas") or [])
+        ]
+        texts = list(dict.fromkeys(text for row in rows for _, text, _ in row))
+        text_vectors = dict(zip(texts, normalize_rows(self.embedding_backend.encode(texts)))) if texts else {}
+        nearest: List[Optional[Dict]] = []
+        for vector, content, row in zip(vectors, contents, rows):
+            key = normalize_text(content)
+            best = None
+            for memory_id, text, metadata in row:
+                similarity = 1.0 if key and normalize_text(text) == key else float(vector @ text_vectors[text])
+                if best is None or similarity > best["similarity"]:
+                    best = {"id": memory_id, "similarity": similarity, "content": text, "metadata": metadata}
+            nearest.append(best)
+        return nearest
+
+    def _merge_target(self, collection_key: str, content: str, memory_id: Optional[str]) -> Optional[Dict]:
+        """合并写入的目标：与 content 最相似且不低于 MEMORY_MERGE_SIMILARITY 的已有记忆，没有时返回 None。"""
+        if not MEMORY_UPSERT:
+            return None
+        if memory_id and self.collections[collection_key].get(ids=[memory_id], include=[]).get("ids"):
+            # 该幂等键上次已作为新记忆写入（重放），按原 ID 覆盖即可
+            return None
+        vector = normalize_rows(self.embedding_backend.encode([content]))
+        match = self._nearest_by_content(collection_key, vector, [content])[0]
+        if match is not None and match["similarity"] >= MEMORY_MERGE_SIMILARITY:
+            return match
+        return None
+
+    @staticmethod
+    def _merged_metadata(metadata: Dict, merge_key: Optional[str]) -> Dict:
+        """合并更新后需要保留 / 递增的元数据：版本号 +1，首次记录时间沿用原记忆。"""
+        merged = {
+            "version": int(metadata.get("version", 1) or 1) + 1,
+            "created_at": metadata.get("created_at") or metadata.get("timestamp", ""),
+            "last_updated": get_timestamp(),
+        }
+        if merge_key:
+            merged["merge_key"] = merge_key
+        return merged
+
+    def upsert_fact_memory(self, content: str, tags: List[str], source: str = "dialog",
+                           confidence: float = 1.0, memory_id: Optional[str] = None) -> Optional[str]:
+        """
+        合并写入事实记忆：与已有事实的内容相似度不低于 MEMORY_MERGE_SIMILARITY 时原地更新那条记忆
+        （内容以新为准、标签取并集、置信度取较高者、版本号 +1），否则新增。
+        memory_id 为本次写入的幂等键（新增时即为记忆 ID），重放同一键不会重复合并。返回最终写入的记忆 ID。
+        """
+        try:
+            target = self._merge_target("facts", content, memory_id)
+        except Exception as e:
+            print(f"⚠️ 查找可合并的事实记忆失败，按新增处理: {e}")
+            target = None
+        if target is None:
+            return self.save_fact_memory(content, tags, source=source, confidence=confidence, memory_id=memory_id)
+
+        metadata = target["metadata"]
+        if memory_id and metadata.get("merge_key") == memory_id:
+            return target["id"]
+        old_tags = json.loads(metadata.get("tags", "[]"))
+        merged_tags = list(dict.fromkeys([*old_tags, *(tags or [])]))
+        merged_confidence = max(float(metadata.get("confidence", 1.0)), confidence)
+        if normalize_text(target["content"]) == normalize_text(content) and len(merged_tags) == len(old_tags):
+            # 内容与标签都没有变化：只更新置信度与版本号，不重新编码
+            if self.update_fact_confidence(target["id"], merged_confidence, merge_key=memory_id):
+                return target["id"]
+            return None
+        saved = self.save_fact_memory(content, merged_tags, source=source, confidence=merged_confidence,
+                                      additional_metadata=self._merged_metadata(metadata, memory_id),
+                                      memory_id=target["id"])
+        if saved:
+            print(f"🔁 事实记忆已合并到 {saved}（相似度 {target['similarity']:.2f}）")
+        return saved
+
+    def upsert_user_preference(self, content: str, preference_type: str, tags: List[str],
+                               memory_id: Optional[str] = None) -> Optional[str]:
+        """合并写入用户偏好，规则同 upsert_fact_memory（偏好类型以新为准）。"""
+        try:
+            target = self._merge_target("user_preferences", content, memory_id)
+        except Exception as e:
+            print(f"⚠️ 查找可合并的用户偏好失败，按新增处理: {e}")
+            target = None
+        if target is None:
+            return self.save_user_preference(content, preference_type, tags, memory_id=memory_id)
+
+        metadata = target["metadata"]
+        if memory_id and metadata.get("merge_key") == memory_id:
+            return target["id"]
+        old_tags = json.loads(metadata.get("tags", "[]"))
+        merged_tags = list(dict.fromkeys([*old_tags, *(tags or [])]))
+        if (normalize_text(target["content"]) == normalize_text(content) and len(merged_tags) == len(old_tags)
+                and metadata.get("preference_type") == preference_type):
+            if self._touch_memory("user_preferences", target["id"], {"merge_key": memory_id} if memory_id else {}):
+                return target["id"]
+            return None
+        saved = self.save_user_preference(content, preference_type, merged_tags,
+                                          additional_metadata=self._merged_metadata(metadata, memory_id),
+                                          memory_id=target["id"])
+        if saved:
+            print(f"🔁 用户偏好已合并到 {saved}（相似度 {target['similarity']:.2f}）")
+        return saved
+
+    def dedup_cache_entries(self, kind: str, entries: List[Dict]) -> Tuple[List[Dict], Dict[str, Any]]:
+        """
+        整合前的本地预去重（见 memory_dedup）：返回 (需要交给模型整合的条目, 报告)。
+        报告中的 dropped_ids 为与其他缓存条目或已有记忆重复、无需整合即可从缓存删除的条目；
+        缓存内的重复项会把标签并入保留的条目。编码或查询失败时原样返回。
+        """
+        report: Dict[str, Any] = {"input": len(entries), "within_cache": 0, "existing": 0,
+                                  "dropped_ids": [], "duplicates": {}}
+        collection_key = DEDUP_TARGETS.get(kind)
+        if not DEDUP_ENABLED or collection_key is None or not entries:
+            return list(entries), report
+        try:
+            vectors = normalize_rows(self.embedding_backend.encode([e.get("content", "") for e in entries]))
+        except Exception as e:
+            print(f"⚠️ 缓存预去重编码失败，跳过: {e}")
+            return list(entries), report
+
+        # 1. 缓存内的完全重复与近似重复
+        kept, merged = dedup_within(entries, vectors, DEDUP_SIMILARITY)
+        survivors: List[Tuple[int, Dict]] = []
+        for i in kept:
+            entry = entries[i]
+            if merged[i]:
+                tags = [*(entry.get("tags") or []), *(t for j in merged[i] for t in entries[j].get("tags") or [])]
+                entry = {**entry, "tags": list(dict.fromkeys(tags))}
+                report["within_cache"] += len(merged[i])
+                for j in merged[i]:
+                    report["dropped_ids"].append(entries[j].get("id"))
+                    report["duplicates"][entries[j].get("id")] = entry.get("id")
+            survivors.append((i, entry))
+
+        # 2. 与已有记忆重复
+        try:
+            nearest = self._nearest_by_content(collection_key, vectors[[i for i, _ in survivors]],
+                                               [entry.get("content", "") for _, entry in survivors])
+            novel = []
+            for (i, entry), match in zip(survivors, nearest):
+                if match is None or match["similarity"] < DEDUP_SIMILARITY:
+                    novel.append((i, entry))
+                    continue
+                report["existing"] += 1
+                report["dropped_ids"].append(entry.get("id"))
+                report["duplicates"][entry.get("id")] = match["id"]
+                # 与该条合并进来的缓存重复项一并视为已有记忆
+                for j in merged[i]:
+                    report["duplicates"][entries[j].get("id")] = match["id"]
+            survivors = novel
+        except Exception as e:
+            print(f"⚠️ 与已有记忆比较失败，仅做缓存内去重: {e}")
+
+        report["dropped_ids"] = [i for i in report["dropped_ids"] if i]
+        return [entry for _, entry in survivors], report
+
+    def finish_consolidation(self, stage: str, kind: Optional[str] = None, ids: Optional[List[str]] = None):
+        """
+        整理阶段提交完成：删除本批处理过的缓存条目并移除检查点。
+        SQLite 后端下两者在同一事务中完成；json 后端下先清缓存再删检查点，中途崩溃时重放也是幂等的。
+        """
+        if self.state_store is not None:
+            with self.state_store.transaction():
+                if kind is not None and ids:
+                    self._clear_cache(kind, ids)
+                self.consolidation_checkpoints.delete(stage)
+            return
+        if kind is not None and ids:
+            self._clear_cache(kind, ids)
+        self.consolidation_checkpoints.delete(stage)
+
     def _load_cache_file(self, file_path: str) -> List[Dict]:
         """加载缓存文件"""
         if not os.path.exists(file_path):
@@ -580,39 +1062,45 @@ class MemorySystem:
     
     def load_preference_cache(self) -> List[Dict]:
         """读取用户偏好缓存"""
-        return self._load_cache_file(PREFERENCE_CACHE_PATH)
+        return self._load_cache("preference")
     
     def load_fact_cache(self) -> List[Dict]:
         """读取事实记忆缓存"""
-        return self._load_cache_file(FACT_CACHE_PATH)
+        return self._load_cache("fact")
     
     def load_profile_cache(self) -> List[Dict]:
         """读取用户画像缓存"""
-        return self._load_cache_file(PROFILE_CACHE_PATH)
+        return self._load_cache("profile")
     
     def clear_preference_cache(self):
         """清空用户偏好缓存"""
-        self._save_cache_file(PREFERENCE_CACHE_PATH, [])
+        self._clear_cache("preference")
         print("🗑️ 用户偏好缓存已清空")
     
     def clear_fact_cache(self):
         """清空事实记忆缓存"""
-        self._save_cache_file(FACT_CACHE_PATH, [])
+        self._clear_cache("fact")
         print("�️ 事实记忆缓存已清空")
     
     def clear_profile_cache(self):
         """清空用户画像缓存"""
-        self._save_cache_file(PROFILE_CACHE_PATH, [])
+        self._clear_cache("profile")
         print("🗑️ 用户画像缓存已清空")
     
-    def get_cache_status(self) -> Dict[str, int]:
-        """获取各缓存文件的状态"""
+    def get_cache_status(self, verbose: bool = True) -> Dict[str, int]:
+        """获取各缓存的条目数（SQLite 后端下为一次 COUNT 查询，不加载内容）；verbose=False 时不打印"""
+        if self.state_store is not None:
+            counts = self.state_store.cache_counts()
+        else:
+            counts = {kind: len(self._load_cache_file(path)) for kind, path in CACHE_FILE_PATHS.items()}
         status = {
-            "preferences_cache": len(self._load_cache_file(PREFERENCE_CACHE_PATH)),
-            "facts_cache": len(self._load_cache_file(FACT_CACHE_PATH)),
-            "profile_cache": len(self._load_cache_file(PROFILE_CACHE_PATH))
+            "preferences_cache": counts.get("preference", 0),
+            "facts_cache": counts.get("fact", 0),
+            "profile_cache": counts.get("profile", 0)
         }
         
+        if not verbose:
+            return status
         total = sum(status.values())
         print(f"📊 缓存状态: 偏好 {status['preferences_cache']} 条，事实 {status['facts_cache']} 条，画像 {status['profile_cache']} 条，总计 {total} 条")
         
@@ -628,9 +1116,10 @@ class MemorySystem:
     # === 用户偏好信息 ===
     # 先存到缓冲文件（持久化），然后在空闲时经过模型处理后保存到ChromaDB
     def save_user_preference(self, content: str, preference_type: str, 
-                            tags: List[str], additional_metadata: Optional[Dict] = None):
-        """保存用户偏好信息到ChromaDB"""
-        preference_id = f"preference_{uuid4().hex}"
+                            tags: List[str], additional_metadata: Optional[Dict] = None,
+                            memory_id: Optional[str] = None):
+        """保存用户偏好信息到ChromaDB（给定 memory_id 时按该 ID 幂等写入）"""
+        preference_id = memory_id or f"preference_{uuid4().hex}"
         timestamp = get_iso_timestamp()
         natural_time = format_natural_time(datetime.now())
         tags_str = "、".join(tags) if tags else "无"
@@ -641,20 +1130,17 @@ class MemorySystem:
             "type": "preference",
             "preference_type": preference_type,
             "tags": json.dumps(tags, ensure_ascii=False),
-            "timestamp": timestamp
+            "timestamp": timestamp,
+            "version": 1
         }
         
         if additional_metadata:
             metadata.update(additional_metadata)
         
         try:
-            self.collections["user_preferences"].add(
-                ids=[preference_id],
-                metadatas=[metadata],
-                documents=[preference_content]
-            )
+            self._write_memory("user_preferences", preference_id, preference_content, metadata, tags,
+                               idempotent=memory_id is not None)
             print(f"✅ 用户偏好已保存: {preference_type} - {content[:30]}...")
-            self.update_active_tags(tags)
             return preference_id
         except Exception as e:
             print(f"❌ 保存用户偏好失败: {e}")
@@ -662,13 +1148,11 @@ class MemorySystem:
 
     def search_user_preferences(self, query: str, n_results: int = 5,
                                where_filter: Optional[Dict] = None,
-                               threshold: float = 0.5) -> List[Dict]:
+                               threshold: float = 0.5,
+                               query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
         """搜索用户偏好信息"""
         try:
-            search_params = {
-                "query_texts": [query],
-                "n_results": n_results
-            }
+            search_params = self._query_params(query, n_results, query_embedding)
             
             if where_filter:
                 search_params["where"] = where_filter
@@ -719,9 +1203,10 @@ class MemorySystem:
 
     # === 重大事件管理 ===
     def save_important_event(self, content: str, event_type: str, summary: str,
-                            tags: List[str], additional_metadata: Optional[Dict] = None):
-        """保存重大事件到ChromaDB"""
-        event_id = f"event_{uuid4().hex}"
+                            tags: List[str], additional_metadata: Optional[Dict] = None,
+                            memory_id: Optional[str] = None):
+        """保存重大事件到ChromaDB（给定 memory_id 时按该 ID 幂等写入）"""
+        event_id = memory_id or f"event_{uuid4().hex}"
         timestamp = get_iso_timestamp()
         natural_time = format_natural_time(datetime.now())
         tags_str = "、".join(tags) if tags else "无"
@@ -740,13 +1225,9 @@ class MemorySystem:
             metadata.update(additional_metadata)
         
         try:
-            self.collections["important_events"].add(
-                ids=[event_id],
-                metadatas=[metadata],
-                documents=[event_content]
-            )
+            self._write_memory("important_events", event_id, event_content, metadata, tags,
+                               idempotent=memory_id is not None)
             print(f"✅ 重大事件已保存: {event_type} - {summary}")
-            self.update_active_tags(tags)
             return event_id
         except Exception as e:
             print(f"❌ 保存重大事件失败: {e}")
@@ -754,13 +1235,11 @@ class MemorySystem:
 
     def search_important_events(self, query: str, n_results: int = 5,
                                where_filter: Optional[Dict] = None,
-                               threshold: float = 0.5) -> List[Dict]:
+                               threshold: float = 0.5,
+                               query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
         """搜索重大事件"""
         try:
-            search_params = {
-                "query_texts": [query],
-                "n_results": n_results
-            }
+            search_params = self._query_params(query, n_results, query_embedding)
             
             if where_filter:
                 search_params["where"] = where_filter
@@ -811,6 +1290,7 @@ class MemorySystem:
         )
 
     # === ⏰ 近期关注事件管理 ===
+    # 事件常驻内存（FocusEventStore），过期由后台清理线程按最小堆调度处理
     def save_temp_focus_event(self, content: str, event_time: str, 
                              expire_time: str, tags: List[str]):
         """保存近期关注事件"""
@@ -823,20 +1303,12 @@ class MemorySystem:
             "tags": tags
         }
         
-        # 读取现有事件
-        temp_events = self.load_temp_focus_events()
-        
-        # 添加新事件
-        temp_events.append(temp_event)
-        
-        # 保存更新后的事件列表
         try:
-            with open(TEMP_FOCUS_EVENTS_PATH, "w", encoding="utf-8") as f:
-                json.dump(temp_events, f, ensure_ascii=False, indent=2)
+            self.focus_events.add(temp_event)
             print(f"✅ 近期关注事件已保存: {content[:30]}...")
             
             # 更新活跃标签
-            self.update_active_tags(tags)
+            self.update_active_tags(tags, memory_id=temp_event["id"], store="focus_events")
             
             return True
         except Exception as e:
@@ -844,152 +1316,106 @@ class MemorySystem:
             return False
 
     def load_temp_focus_events(self) -> List[Dict]:
-        """加载近期关注事件（自动清理过期事件）"""
-        if not os.path.exists(TEMP_FOCUS_EVENTS_PATH):
-            return []
-        
-        try:
-            with open(TEMP_FOCUS_EVENTS_PATH, encoding="utf-8") as f:
-                events = json.load(f)
-            # 兼容历史数据：为缺少 id 的事件补齐并落盘
-            updated_for_ids = False
-            for e in events:
-                if "id" not in e or not e.get("id"):
-                    e["id"] = f"temp_{uuid4().hex}"
-                    updated_for_ids = True
-            if updated_for_ids:
-                with open(TEMP_FOCUS_EVENTS_PATH, "w", encoding="utf-8") as f:
-                    json.dump(events, f, ensure_ascii=False, indent=2)
-            
-            # 过滤掉过期事件（统一使用 UTC 比较）
-            now_utc = datetime.now(timezone.utc)
-            valid_events = []
-            
-            for event in events:
-                expire_raw = event.get("expire_time")
-                expire_dt = self._parse_iso_datetime(expire_raw)
-                if expire_dt is None:
-                    # 解析失败则保留，避免误删
-                    valid_events.append(event)
-                else:
-                    if now_utc < expire_dt:
-                        valid_events.append(event)
-                    # 否则丢弃（已过期）
-
-            # 如果有事件被清理，更新文件
-            if len(valid_events) != len(events):
-                with open(TEMP_FOCUS_EVENTS_PATH, "w", encoding="utf-8") as f:
-                    json.dump(valid_events, f, ensure_ascii=False, indent=2)
-                print(f"🧹 已清理 {len(events) - len(valid_events)} 个过期的关注事件")
-            
-            return valid_events
-        except Exception as e:
-            print(f"❌ 加载近期关注事件失败: {e}")
-            return []
+        """加载近期关注事件（内存快照，已排除过期事件）"""
+        return self.focus_events.snapshot()
 
     def update_temp_focus_event_expire_time(self, event_index: int, new_expire_time: str):
         """更新近期关注事件的过期时间"""
-        events = self.load_temp_focus_events()
+        events = self.focus_events.snapshot()
         
         if 0 <= event_index < len(events):
-            events[event_index]["expire_time"] = new_expire_time
-            
-            try:
-                with open(TEMP_FOCUS_EVENTS_PATH, "w", encoding="utf-8") as f:
-                    json.dump(events, f, ensure_ascii=False, indent=2)
+            if self.focus_events.update_expire_time(events[event_index]["id"], new_expire_time):
                 print(f"✅ 事件过期时间已更新: {new_expire_time}")
                 return True
-            except Exception as e:
-                print(f"❌ 更新事件过期时间失败: {e}")
+            print(f"❌ 更新事件过期时间失败: 事件已不存在")
         else:
             print(f"❌ 事件索引 {event_index} 超出范围")
         
         return False
 
     def get_active_focus_events(self) -> List[Dict]:
-        """获取当前有效的关注事件"""
-        return self.load_temp_focus_events()
+        """获取当前有效的关注事件（无文件I/O与时间解析的快照读取）"""
+        return self.focus_events.snapshot()
 
     def clear_expired_focus_events(self):
         """手动清理过期的关注事件"""
-        # 根据过期机制自动清理
-        valid_events = self.load_temp_focus_events()
-        return len(valid_events)
+        self.focus_events.sweep()
+        return len(self.focus_events.snapshot())
 
     def delete_temp_focus_events_by_ids(self, ids: List[str]) -> int:
         """按 ID 删除临时关注事件，返回删除数量。"""
         if not ids:
             return 0
         try:
-            events = self.load_temp_focus_events()
-            before = len(events)
-            id_set = set(ids)
-            remaining = [e for e in events if e.get("id") not in id_set]
-            if len(remaining) != before:
-                with open(TEMP_FOCUS_EVENTS_PATH, "w", encoding="utf-8") as f:
-                    json.dump(remaining, f, ensure_ascii=False, indent=2)
-                removed = before - len(remaining)
+            removed = self.focus_events.remove_many(ids)
+            if removed:
+                for event_id in ids:
+                    self._untag_memory(event_id)
                 print(f"🧹 已按ID删除 {removed} 条临时关注事件")
-                return removed
-            return 0
+            return removed
         except Exception as e:
             print(f"❌ 按ID删除临时关注事件失败: {e}")
             return 0
 
+    def _on_focus_events_expired(self, event_ids: List[str]):
+        """过期清理回调：解除过期事件的标签成员关系。"""
+        for event_id in event_ids:
+            self._untag_memory(event_id)
+
     # === 🔖 活跃标签 ===
-    def update_active_tags(self, new_tags: List[str]):
-        """更新活跃标签统计"""
-        tags = {}
-        if os.path.exists(ACTIVE_TAGS_PATH):
-            try:
-                with open(ACTIVE_TAGS_PATH, encoding="utf-8") as f:
-                    data = json.load(f)
-                    tags = data.get("tags", {})
-            except:
-                tags = {}
-        
-        # 更新标签计数
-        for tag in new_tags:
-            tags[tag] = tags.get(tag, 0) + 1
-        
-        # 保存标签数据
-        data = {
-            "type": "active_tags", 
-            "tags": tags, 
-            "last_update": get_timestamp(),
-            "total_tags": len(tags),
-            "most_frequent": max(tags.items(), key=lambda x: x[1]) if tags else None
-        }
-        
-        with open(ACTIVE_TAGS_PATH, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+    def update_active_tags(self, new_tags: List[str], memory_id: Optional[str] = None,
+                           store: str = ""):
+        """更新活跃标签统计（内存索引 + 增量日志，不再整文件读写）"""
+        try:
+            self.tag_index.add(new_tags, memory_id=memory_id, store=store)
+        except Exception as e:
+            print(f"⚠️ 更新活跃标签失败: {e}")
+
+    def _untag_memory(self, memory_id: str):
+        """记忆被删除时解除其标签成员关系。"""
+        try:
+            self.tag_index.remove(memory_id)
+        except Exception as e:
+            print(f"⚠️ 移除记忆标签失败: {e}")
 
     def get_active_tags(self, top_n: int = 10) -> Dict:
         """获取最活跃的标签"""
-        if not os.path.exists(ACTIVE_TAGS_PATH):
-            return {"tags": {}, "top_tags": []}
-        
-        with open(ACTIVE_TAGS_PATH, encoding="utf-8") as f:
-            data = json.load(f)
-            tags = data.get("tags", {})
-            
-            # 按频率排序
-            sorted_tags = sorted(tags.items(), key=lambda x: x[1], reverse=True)
-            top_tags = sorted_tags[:top_n]
-            
-            return {
-                "tags": tags,
-                "top_tags": top_tags,
-                "total_count": sum(tags.values()),
-                "unique_count": len(tags),
-                "last_update": data.get("last_update", "")
-            }
+        return self.tag_index.snapshot(top_n)
+
+    def get_memory_ids_by_tags(self, tags: List[str], store: Optional[str] = None,
+                               match_all: bool = False) -> List[str]:
+        """按标签查找记忆ID（store 可为集合名或 "focus_events"）"""
+        return sorted(self.tag_index.ids_for_tags(tags, store=store, match_all=match_all))
+
+    def search_by_tags(self, tags: List[str], collection_key: str,
+                       match_all: bool = False, limit: int = 10) -> List[Dict]:
+        """按标签直接读取某个集合中的记忆（通过ID读取，不触发嵌入计算）"""
+        ids = self.get_memory_ids_by_tags(tags, store=collection_key, match_all=match_all)[:limit]
+        if not ids:
+            return []
+        try:
+            data = self.collections[collection_key].get(ids=ids, include=["documents", "metadatas"])
+            return [
+                self._build_memory_item(collection_key, memory_id, data["documents"][i], data["metadatas"][i], None)
+                for i, memory_id in enumerate(data.get("ids", []) or [])
+            ]
+        except Exception as e:
+            print(f"❌ 按标签读取记忆失败: {e}")
+            return []
 
     # === 🔍 综合搜索功能 ===
     def comprehensive_search(self, query: str, search_dialogs: bool = True, 
                            search_facts: bool = True, search_preferences: bool = True,
-                           search_events: bool = True, n_results: int = 5) -> Dict:
-        """综合搜索所有类型的记忆"""
+                           search_events: bool = True, n_results: int = 5,
+                           hybrid: bool = True, tags: Optional[List[str]] = None,
+                           mmr_lambda: Optional[float] = MMR_LAMBDA) -> Dict:
+        """
+        综合搜索所有类型的记忆
+
+        :param hybrid: 是否将向量检索结果与 BM25 词法检索结果做 RRF 融合（提升人名、日期等精确匹配召回）
+        :param tags: 若提供，则只保留带有其中任一标签的记忆（基于标签索引过滤）
+        :param mmr_lambda: 若提供，则先多取候选，再按 MMR 做多样性重排（默认取 MIRAMATE_MMR_LAMBDA）
+        """
         results = {
             "query": query,
             "timestamp": get_timestamp(),
@@ -1000,30 +1426,63 @@ class MemorySystem:
             "focus_events": []
         }
         
-        if search_dialogs:
-            results["dialog_memories"] = self.search_dialog_logs(query, n_results)
-        
-        if search_facts:
-            results["fact_memories"] = self.search_fact_memory(query, n_results)
-            
-        if search_preferences:
-            results["preference_memories"] = self.search_user_preferences(query, n_results)
-            
-        if search_events:
-            results["event_memories"] = self.search_important_events(query, n_results)
-        
-        # 检查是否有相关的关注事件
-        focus_events = self.get_active_focus_events()
+        # 查询只编码一次：四个集合的向量检索与 MMR 重排共用同一个借用的查询向量
+        try:
+            query_lease = self.embedding_backend.borrow([query])
+        except Exception as e:
+            print(f"⚠️ 查询向量编码失败，改由各集合各自编码: {e}")
+            query_lease = None
+        query_vector = query_lease.array[0] if query_lease is not None else None
+        fetch_n = n_results * MMR_FETCH_FACTOR if mmr_lambda is not None and query_vector is not None else n_results
+
+        searches = [
+            (search_dialogs, "dialog_memories", "dialog_logs", self.search_dialog_logs),
+            (search_facts, "fact_memories", "facts", self.search_fact_memory),
+            (search_preferences, "preference_memories", "user_preferences", self.search_user_preferences),
+            (search_events, "event_memories", "important_events", self.search_important_events),
+        ]
+        try:
+            for enabled, result_key, collection_key, search in searches:
+                if not enabled:
+                    continue
+                memories = search(query, fetch_n, query_embedding=query_vector)
+                if hybrid:
+                    memories = self._fuse_with_lexical(collection_key, query, memories, fetch_n)
+                if fetch_n != n_results:
+                    memories = self._mmr_rerank(collection_key, query_vector, memories, n_results, mmr_lambda)
+                results[result_key] = memories
+        finally:
+            if query_lease is not None:
+                query_lease.release()
+
+        if tags:
+            allowed_ids = self.tag_index.ids_for_tags(tags)
+            for key in ("dialog_memories", "fact_memories", "preference_memories", "event_memories"):
+                results[key] = [m for m in results[key] if m["id"] in allowed_ids]
+
+        # 检查是否有相关的关注事件：标签命中走标签索引，内容命中仍按子串判断
+        matched_ids = self.tag_index.ids_matching_text(query, store="focus_events")
+        allowed_focus_ids = self.tag_index.ids_for_tags(tags, store="focus_events") if tags else None
+        query_lower = query.lower()
         relevant_focus_events = []
-        for event in focus_events:
-            if (query.lower() in event["content"].lower() or 
-                any(tag.lower() in query.lower() for tag in event["tags"])):
+        for event in self.get_active_focus_events():
+            if allowed_focus_ids is not None and event["id"] not in allowed_focus_ids:
+                continue
+            if event["id"] in matched_ids or query_lower in event["content"].lower():
                 relevant_focus_events.append(event)
         results["focus_events"] = relevant_focus_events
         
         return results
 
     # === 📊 统计和管理功能 ===
+    def memory_footprint(self) -> Dict:
+        """估算本实例主要的内存占用，供 registry.footprint_report() 汇总"""
+        return {
+            **self.embedding_backend.footprint(),
+            "lexical_index_docs": {key: len(index) for key, index in self.lexical_indexes.items()},
+            "focus_events": len(self.focus_events.snapshot()),
+        }
+
     def get_memory_statistics(self) -> Dict:
         """获取记忆系统统计信息"""
         stats = {
@@ -1033,7 +1492,7 @@ class MemorySystem:
             "preference_count": 0,
             "event_count": 0,
             "focus_event_count": 0,
-            "user_profile_exists": os.path.exists(PROFILE_PATH),
+            "user_profile_exists": self.profile_store.get() is not None,
             "active_tags": self.get_active_tags(5)
         }
         
@@ -1083,8 +1542,25 @@ class MemorySystem:
 
 # === 🧩 全局实例和便捷函数 ===
 
-# 创建全局记忆系统实例
-memory_system = MemorySystem()
+# 全局记忆系统为惰性单例：首次使用（或 Web 服务启动预热）时才打开 ChromaDB 并加载嵌入模型。
+# memory_system 是它的代理，保持 `from MiraMate.modules.memory_system import memory_system` 的写法不变；
+# 下方的便捷函数也都经由 get_memory_system()，全进程共用同一个实例（同时由 registry 防止重复构造）。
+_global_memory_system = None
+_global_memory_system_lock = threading.Lock()
+components.register("memory_system")
+
+def get_memory_system():
+    """获取全局记忆系统实例（进程内唯一）"""
+    global _global_memory_system
+    if _global_memory_system is None:
+        with _global_memory_system_lock:
+            if _global_memory_system is None:
+                with components.track("memory_system"):
+                    # 若已有实例通过其他途径注册（例如脚本直接构造），直接复用
+                    _global_memory_system = registry.get("memory_system") or MemorySystem()
+    return _global_memory_system
+
+memory_system = LazyProxy(get_memory_system, "memory_system")
 
 # 便捷函数
 def save_dialog_log(user_input: str, ai_response: str, topic: str, 
@@ -1115,16 +1591,6 @@ def search_memories(query: str, n_results: int = 5):
 
 # === 🎯 全局便捷函数（缓存版本）===
 
-# 实例化全局记忆系统
-_global_memory_system = None
-
-def get_memory_system():
-    """获取全局记忆系统实例"""
-    global _global_memory_system
-    if _global_memory_system is None:
-        _global_memory_system = MemorySystem()
-    return _global_memory_system
-
 # 缓存相关便捷函数
 def cache_user_preference(content: str, preference_type: str, tags: List[str], 
                          confidence: float = 1.0):
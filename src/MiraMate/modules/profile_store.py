@@ -0,0 +1,132 @@
+"""
+用户画像存储
+- 画像常驻内存，启动时从 user_profile.json 读取一次，之后每轮对话不再读盘
+- 部分更新在锁内完成，采用写时复制：读取方拿到的快照不会被并发修改
+- 每次变更递增版本号并原子落盘（临时文件 + os.replace；SQLite 后端下只写变更的字段行），同时通知订阅者
+- 多个 Web worker 共用 SQLite 时，其他进程写入后通过 reload() 重新读取
+"""
+import copy
+import json
+import os
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+# 由存储维护的元字段，不接受来自更新请求（例如 LLM 输出）的覆盖
+META_KEYS = ("version", "last_updated")
+
+ProfileListener = Callable[[Dict[str, Any], int, List[str]], None]
+
+
+def _get_timestamp() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class ProfileStore:
+    """线程安全、带版本号和变更通知的用户画像存储。"""
+
+    def __init__(self, path: str, db=None):
+        """
+        :param path: JSON 持久化路径（db 为 None 时使用）。
+        :param db: 可选的 StateStore，提供时画像以 kv 命名空间 "profile" 按字段存储。
+        """
+        self.path = path
+        self.db = db
+        self._profile: Optional[Dict[str, Any]] = None
+        self._version = 0
+        self._listeners: List[ProfileListener] = []
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def _load(self):
+        try:
+            if self.db is not None:
+                profile = self.db.kv_get_all("profile") or None
+            elif os.path.exists(self.path):
+                with open(self.path, encoding="utf-8") as f:
+                    profile = json.load(f)
+            else:
+                return
+            if isinstance(profile, dict):
+                self._profile = profile
+                self._version = int(profile.get("version", 0) or 0)
+        except Exception as e:
+            print(f"❌ 加载用户画像失败: {e}")
+
+    def _persist(self, profile: Dict[str, Any], changed_keys: Optional[List[str]]):
+        if self.db is not None:
+            if changed_keys is None:
+                self.db.kv_replace("profile", profile)
+            else:
+                self.db.kv_set("profile", {k: profile[k] for k in [*changed_keys, *META_KEYS]})
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(profile, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def _commit(self, profile: Dict[str, Any], changed_keys: Optional[List[str]] = None) -> int:
+        """（需持有锁）落盘成功后才切换到新版本，返回新版本号。changed_keys 为 None 表示整体替换。"""
+        version = self._version + 1
+        profile["version"] = version
+        profile["last_updated"] = _get_timestamp()
+        self._persist(profile, changed_keys)
+        self._profile = profile
+        self._version = version
+        return version
+
+    def _notify(self, profile: Dict[str, Any], version: int, changed_keys: List[str]):
+        for listener in list(self._listeners):
+            try:
+                listener(profile, version, changed_keys)
+            except Exception as e:
+                print(f"⚠️ 用户画像变更通知失败: {e}")
+
+    # --- 公共接口 ---
+    def get(self) -> Optional[Dict[str, Any]]:
+        """返回当前画像快照（只读，请勿就地修改）；尚无画像时返回 None。"""
+        return self._profile
+
+    def replace(self, profile: Dict[str, Any]) -> int:
+        """整体替换画像，返回新版本号。"""
+        new_profile = copy.deepcopy(profile)
+        with self._lock:
+            old_keys = set(self._profile or {})
+            changed = sorted((set(new_profile) | old_keys) - set(META_KEYS))
+            version = self._commit(new_profile)
+        self._notify(new_profile, version, changed)
+        return version
+
+    def update(self, updates: Dict[str, Any]) -> int:
+        """部分更新画像（顶层键合并），返回新版本号；无实际变化时不落盘。"""
+        updates = {k: v for k, v in updates.items() if k not in META_KEYS}
+        with self._lock:
+            current = self._profile or {}
+            changed = [k for k, v in updates.items() if current.get(k) != v]
+            if not changed:
+                return self._version
+            new_profile = copy.deepcopy(current)
+            new_profile.update(copy.deepcopy(updates))
+            version = self._commit(new_profile, changed)
+        self._notify(new_profile, version, changed)
+        return version
+
+    def reload(self):
+        """从持久化存储重新读取画像（其他进程修改了画像时调用），不通知订阅者。"""
+        with self._lock:
+            self._profile = None
+            self._version = 0
+            self._load()
+
+    def subscribe(self, listener: ProfileListener) -> Callable[[], None]:
+        """订阅画像变更，回调参数为 (新画像, 版本号, 变更的键)；返回取消订阅函数。"""
+        self._listeners.append(listener)
+
+        def _unsubscribe():
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+        return _unsubscribe
@@ -0,0 +1,115 @@
+"""
+重量级组件注册表
+- 记忆系统（ChromaDB 客户端 + 嵌入模型 + 各内存索引）等组件在进程内只允许存在一个实例
+- 组件在构造之初向注册表声明自己，若已有同类存活实例则拒绝构造（避免重复加载约 400MB 的嵌入模型）
+- 提供进程内存占用报告：进程 RSS 以及各已注册组件自报的占用估算
+"""
+import os
+import sys
+import threading
+import weakref
+from typing import Any, Dict, Optional
+
+# 设置为 1 时允许同类重量级组件存在多个实例（例如离线脚本需要打开另一个持久化目录）
+ALLOW_DUPLICATES = os.getenv("MIRAMATE_ALLOW_DUPLICATE_BACKENDS", "0") == "1"
+
+
+class DuplicateInstanceError(RuntimeError):
+    """试图创建第二个同类重量级组件实例时抛出。"""
+
+
+_instances: Dict[str, "weakref.ReferenceType"] = {}
+_lock = threading.Lock()
+
+
+def claim(kind: str, instance: Any):
+    """
+    声明一个重量级组件实例。应在构造函数开头、分配大块内存之前调用。
+    若同类实例仍存活且未允许重复，抛出 DuplicateInstanceError。
+    """
+    with _lock:
+        ref = _instances.get(kind)
+        existing = ref() if ref is not None else None
+        if existing is not None and existing is not instance:
+            if not ALLOW_DUPLICATES:
+                raise DuplicateInstanceError(
+                    f"{kind} 已存在实例 (0x{id(existing):x})，请通过对应的 get_*() 获取共享实例；"
+                    f"如确需多个实例，请设置 MIRAMATE_ALLOW_DUPLICATE_BACKENDS=1"
+                )
+            print(f"⚠️ 正在创建第二个 {kind} 实例，内存占用将成倍增加")
+            return
+        _instances[kind] = weakref.ref(instance)
+
+
+def release(kind: str, instance: Any):
+    """撤销声明（构造失败或显式关闭时调用）。"""
+    with _lock:
+        ref = _instances.get(kind)
+        if ref is not None and ref() in (instance, None):
+            del _instances[kind]
+
+
+def get(kind: str) -> Optional[Any]:
+    """返回已注册的存活实例，不存在时返回 None（不会触发构造）。"""
+    with _lock:
+        ref = _instances.get(kind)
+    return ref() if ref is not None else None
+
+
+def _process_rss_bytes(pid: Optional[int] = None) -> Optional[int]:
+    """进程常驻内存（字节），默认为当前进程。优先 /proc（Linux），其次 psutil（可选依赖）。"""
+    try:
+        with open(f"/proc/{pid or 'self'}/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except Exception:
+        return None
+
+
+def _peak_rss_bytes() -> Optional[int]:
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 以字节为单位，Linux 以 KB 为单位
+        return peak if sys.platform == "darwin" else peak * 1024
+    except Exception:
+        return None
+
+
+def footprint_report() -> Dict[str, Any]:
+    """
+    进程内存占用报告：
+    - process: 当前 RSS 与峰值 RSS（MB）
+    - components: 各已注册组件的 memory_footprint() 结果（字节估算转换为 MB）
+    """
+    def _mb(value: Optional[int]) -> Optional[float]:
+        return round(value / (1024 * 1024), 1) if value is not None else None
+
+    report: Dict[str, Any] = {
+        "process": {"rss_mb": _mb(_process_rss_bytes()), "peak_rss_mb": _mb(_peak_rss_bytes())},
+        "components": {},
+    }
+    with _lock:
+        live = {kind: ref() for kind, ref in _instances.items()}
+    for kind, instance in live.items():
+        if instance is None:
+            continue
+        entry: Dict[str, Any] = {"instance": f"0x{id(instance):x}"}
+        footprint = getattr(instance, "memory_footprint", None)
+        if callable(footprint):
+            try:
+                for key, value in footprint().items():
+                    if key.endswith("_bytes"):
+                        entry[key[:-len("_bytes")] + "_mb"] = _mb(value)
+                    else:
+                        entry[key] = value
+            except Exception as e:
+                entry["error"] = str(e)
+        report["components"][kind] = entry
+    return report
@@ -0,0 +1,475 @@
+"""
+跨 Web 工作进程共享的运行时状态
+- 原先保存在模块全局变量中的运行时状态（聊天记录、会话对话历史与检索缓存、WebSocket 广播、后台任务归属）
+  统一经由 SharedStateBackend 访问
+- memory（默认）：进程内实现，单个 uvicorn 进程时使用，行为与原先一致
+- sqlite：本机多进程实现，多个 uvicorn worker 共用一个 SQLite（WAL）文件；跨进程互斥使用文件锁，
+  WebSocket 广播通过数据库中的事件表做轻量发布 / 订阅（各进程的订阅线程轮询新事件）
+- 由 MIRAMATE_SHARED_STATE 选择；MIRAMATE_WEB_WORKERS > 1 时启动脚本会自动切换到 sqlite
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from MiraMate.modules.settings import get_memory_dir
+
+SHARED_STATE_BACKEND = os.getenv("MIRAMATE_SHARED_STATE", "memory").strip().lower()
+SHARED_STATE_DB_PATH = os.getenv("MIRAMATE_SHARED_STATE_DB", os.path.join(get_memory_dir(), "shared_state.sqlite3"))
+# 订阅线程轮询事件表的间隔（秒）与事件保留时长（秒）
+PUBSUB_POLL_INTERVAL = float(os.getenv("MIRAMATE_PUBSUB_POLL_MS", "50")) / 1000.0
+PUBSUB_RETENTION = 300
+
+Subscriber = Callable[[Any], None]
+
+
+class SharedStateBackend:
+    """
+    共享状态后端接口：
+    - 键值：kv_get / kv_set / kv_delete / kv_items（值为可 JSON 序列化的对象）
+    - 有界列表：list_append / list_range / list_len / list_clear（超过 max_len 时丢弃最旧的元素）
+    - 互斥：lock(name)（同步）/ alock(name)（异步）；try_acquire_leadership(name) 在进程存活期间独占某项职责
+    - 发布订阅：publish(channel, message) 投递给所有进程中的订阅者（含本进程）
+    """
+
+    name = "base"
+    # 是否跨进程共享（为 False 时调用方可以省略跨进程同步）
+    shared = False
+
+    def kv_get(self, namespace: str, key: str, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    def kv_set(self, namespace: str, key: str, value: Any):
+        raise NotImplementedError
+
+    def kv_delete(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    def kv_items(self, namespace: str) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def list_append(self, name: str, item: Any, max_len: int):
+        raise NotImplementedError
+
+    def list_range(self, name: str, offset: int = 0, limit: int = 50, reverse: bool = True) -> List[Any]:
+        raise NotImplementedError
+
+    def list_len(self, name: str) -> int:
+        raise NotImplementedError
+
+    def list_clear(self, name: str):
+        raise NotImplementedError
+
+    def lock(self, name: str):
+        raise NotImplementedError
+
+    @asynccontextmanager
+    async def alock(self, name: str):
+        """异步获取跨进程锁（默认实现：在线程中阻塞获取）。"""
+        cm = self.lock(name)
+        await asyncio.to_thread(cm.__enter__)
+        try:
+            yield
+        finally:
+            cm.__exit__(None, None, None)
+
+    def try_acquire_leadership(self, name: str) -> bool:
+        raise NotImplementedError
+
+    def publish(self, channel: str, message: Any):
+        raise NotImplementedError
+
+    def subscribe(self, channel: str, callback: Subscriber):
+        raise NotImplementedError
+
+    def subscribe_async(self, channel: str, handler: Callable[[Any], Awaitable[None]]):
+        """订阅并在当前事件循环中执行异步处理函数（必须在事件循环内调用）。"""
+        loop = asyncio.get_running_loop()
+
+        def _dispatch(message):
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is loop:
+                loop.create_task(handler(message))
+            elif not loop.is_closed():
+                # 来自订阅轮询线程
+                asyncio.run_coroutine_threadsafe(handler(message), loop)
+
+        self.subscribe(channel, _dispatch)
+
+    def describe(self) -> Dict[str, Any]:
+        return {"backend": self.name, "shared": self.shared, "pid": os.getpid()}
+
+    def close(self):
+        pass
+
+
+class InProcessStateBackend(SharedStateBackend):
+    """单进程实现：全部状态保存在内存中。"""
+
+    name = "memory"
+    shared = False
+
+    def __init__(self):
+        self._kv: Dict[str, Dict[str, Any]] = defaultdict(dict)
+        self._lists: Dict[str, deque] = {}
+        self._locks: Dict[str, threading.RLock] = defaultdict(threading.RLock)
+        self._subscribers: Dict[str, List[Subscriber]] = defaultdict(list)
+        self._guard = threading.Lock()
+
+    def kv_get(self, namespace, key, default=None):
+        return self._kv[namespace].get(key, default)
+
+    def kv_set(self, namespace, key, value):
+        self._kv[namespace][key] = value
+
+    def kv_delete(self, namespace, key):
+        self._kv[namespace].pop(key, None)
+
+    def kv_items(self, namespace):
+        return dict(self._kv[namespace])
+
+    def list_append(self, name, item, max_len):
+        with self._guard:
+            items = self._lists.get(name)
+            if items is None or items.maxlen != max_len:
+                items = self._lists[name] = deque(items or (), maxlen=max_len)
+            items.append(item)
+
+    def list_range(self, name, offset=0, limit=50, reverse=True):
+        with self._guard:
+            items = list(self._lists.get(name, ()))
+        if reverse:
+            items.reverse()
+        return items[offset:offset + limit]
+
+    def list_len(self, name):
+        return len(self._lists.get(name, ()))
+
+    def list_clear(self, name):
+        with self._guard:
+            self._lists.pop(name, None)
+
+    @contextmanager
+    def lock(self, name: str) -> Iterator[None]:
+        with self._guard:
+            lock = self._locks[name]
+        with lock:
+            yield
+
+    @asynccontextmanager
+    async def alock(self, name: str):
+        # 单进程内的会话互斥已由调用方的 asyncio.Lock 保证
+        yield
+
+    def try_acquire_leadership(self, name):
+        return True
+
+    def publish(self, channel, message):
+        for callback in list(self._subscribers[channel]):
+            try:
+                callback(message)
+            except Exception as e:
+                print(f"⚠️ 处理频道 '{channel}' 的消息失败: {e}")
+
+    def subscribe(self, channel, callback):
+        self._subscribers[channel].append(callback)
+
+
+class _FileLock:
+    """基于文件的跨进程互斥锁（POSIX flock / Windows msvcrt）。同一进程内的多个线程另由线程锁串行化。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._fd: Optional[int] = None
+
+    def _lock_fd(self, fd: int, blocking: bool) -> bool:
+        try:
+            import fcntl
+            flags = fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB)
+            try:
+                fcntl.flock(fd, flags)
+                return True
+            except BlockingIOError:
+                return False
+        except ImportError:
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                    return True
+                except OSError:
+                    if not blocking:
+                        return False
+                    time.sleep(0.01)
+
+    def _unlock_fd(self, fd: int):
+        try:
+            import fcntl
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        except ImportError:
+            import msvcrt
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if not self._thread_lock.acquire(blocking):
+            return False
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if not self._lock_fd(fd, blocking):
+            os.close(fd)
+            self._thread_lock.release()
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            try:
+                self._unlock_fd(fd)
+            finally:
+                os.close(fd)
+        self._thread_lock.release()
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shared_kv (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS shared_lists (
+    name TEXT NOT NULL,
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    item TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_shared_lists_name ON shared_lists (name, seq);
+CREATE TABLE IF NOT EXISTS shared_events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,
+    origin INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+
+class SqliteStateBackend(SharedStateBackend):
+    """本机多进程实现：SQLite（WAL）保存状态，文件锁做跨进程互斥，事件表做发布订阅。"""
+
+    name = "sqlite"
+    shared = True
+
+    def __init__(self, db_path: str = SHARED_STATE_DB_PATH):
+        self.db_path = db_path
+        self.lock_dir = os.path.join(os.path.dirname(db_path), "locks")
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self._local = threading.local()
+        self._file_locks: Dict[str, _FileLock] = {}
+        self._leaderships: Dict[str, _FileLock] = {}
+        self._subscribers: Dict[str, List[Subscriber]] = defaultdict(list)
+        self._guard = threading.Lock()
+        self._poller: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._connection().executescript(SQLITE_SCHEMA)
+        # 只投递订阅之后产生的事件
+        row = self._connection().execute("SELECT COALESCE(MAX(seq), 0) FROM shared_events").fetchone()
+        self._last_seq = row[0]
+        self.stats = {"published": 0, "delivered": 0}
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    # --- 键值 ---
+    def kv_get(self, namespace, key, default=None):
+        row = self._connection().execute(
+            "SELECT value FROM shared_kv WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def kv_set(self, namespace, key, value):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO shared_kv (namespace, key, value) VALUES (?, ?, ?)",
+            (namespace, key, json.dumps(value, ensure_ascii=False))
+        )
+
+    def kv_delete(self, namespace, key):
+        self._connection().execute("DELETE FROM shared_kv WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def kv_items(self, namespace):
+        rows = self._connection().execute(
+            "SELECT key, value FROM shared_kv WHERE namespace = ?", (namespace,)
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    # --- 有界列表 ---
+    def list_append(self, name, item, max_len):
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO shared_lists (name, item) VALUES (?, ?)",
+                         (name, json.dumps(item, ensure_ascii=False)))
+            conn.execute(
+                "DELETE FROM shared_lists WHERE name = ? AND seq <= "
+                "(SELECT seq FROM shared_lists WHERE name = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                (name, name, max_len)
+            )
+
+    def list_range(self, name, offset=0, limit=50, reverse=True):
+        order = "DESC" if reverse else "ASC"
+        rows = self._connection().execute(
+            f"SELECT item FROM shared_lists WHERE name = ? ORDER BY seq {order} LIMIT ? OFFSET ?",
+            (name, limit, offset)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def list_len(self, name):
+        return self._connection().execute("SELECT COUNT(*) FROM shared_lists WHERE name = ?", (name,)).fetchone()[0]
+
+    def list_clear(self, name):
+        self._connection().execute("DELETE FROM shared_lists WHERE name = ?", (name,))
+
+    # --- 互斥 ---
+    def _file_lock(self, name: str) -> _FileLock:
+        with self._guard:
+            lock = self._file_locks.get(name)
+            if lock is None:
+                safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+                lock = self._file_locks[name] = _FileLock(os.path.join(self.lock_dir, f"{safe}.lock"))
+            return lock
+
+    @contextmanager
+    def lock(self, name: str) -> Iterator[None]:
+        lock = self._file_lock(name)
+        lock.acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+
+    @asynccontextmanager
+    async def alock(self, name: str):
+        """非阻塞地轮询获取文件锁，等待期间不占用事件循环。"""
+        lock = self._file_lock(name)
+        delay = 0.005
+        while not lock.acquire(blocking=False):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def try_acquire_leadership(self, name):
+        """非阻塞地获取某项职责的独占权，成功后在进程存活期间一直持有（进程退出时由系统释放）。"""
+        with self._guard:
+            if name in self._leaderships:
+                return True
+        lock = _FileLock(os.path.join(self.lock_dir, f"leader-{name}.lock"))
+        if not lock.acquire(blocking=False):
+            return False
+        with self._guard:
+            self._leaderships[name] = lock
+        return True
+
+    # --- 发布订阅 ---
+    def publish(self, channel, message):
+        self._connection().execute(
+            "INSERT INTO shared_events (channel, origin, payload, created_at) VALUES (?, ?, ?, ?)",
+            (channel, os.getpid(), json.dumps(message, ensure_ascii=False), time.time())
+        )
+        self.stats["published"] += 1
+        # 本进程的订阅者直接投递，不等待轮询
+        self._deliver(channel, message)
+
+    def subscribe(self, channel, callback):
+        with self._guard:
+            self._subscribers[channel].append(callback)
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll_loop, name="SharedStatePubSub", daemon=True)
+                self._poller.start()
+
+    def _deliver(self, channel: str, message: Any):
+        for callback in list(self._subscribers.get(channel, ())):
+            try:
+                callback(message)
+                self.stats["delivered"] += 1
+            except Exception as e:
+                print(f"⚠️ 处理频道 '{channel}' 的消息失败: {e}")
+
+    def _poll_loop(self):
+        pid = os.getpid()
+        last_prune = 0.0
+        while not self._stop.wait(PUBSUB_POLL_INTERVAL):
+            try:
+                rows = self._connection().execute(
+                    "SELECT seq, channel, origin, payload FROM shared_events WHERE seq > ? ORDER BY seq",
+                    (self._last_seq,)
+                ).fetchall()
+                for seq, channel, origin, payload in rows:
+                    self._last_seq = seq
+                    if origin != pid:
+                        self._deliver(channel, json.loads(payload))
+                now = time.time()
+                if now - last_prune > 30:
+                    last_prune = now
+                    self._connection().execute("DELETE FROM shared_events WHERE created_at < ?",
+                                               (now - PUBSUB_RETENTION,))
+            except Exception as e:
+                print(f"⚠️ 共享状态订阅轮询失败: {e}")
+
+    def describe(self):
+        return {**super().describe(), "db_path": self.db_path,
+                "leaderships": sorted(self._leaderships), **self.stats}
+
+    def close(self):
+        self._stop.set()
+
+
+BACKENDS = {
+    InProcessStateBackend.name: InProcessStateBackend,
+    SqliteStateBackend.name: SqliteStateBackend,
+}
+
+_backend: Optional[SharedStateBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_shared_state() -> SharedStateBackend:
+    """进程内唯一的共享状态后端（由 MIRAMATE_SHARED_STATE 选择，未知取值回退到 memory）。"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                backend_cls = BACKENDS.get(SHARED_STATE_BACKEND)
+                if backend_cls is None:
+                    print(f"⚠️ 未知的共享状态后端 '{SHARED_STATE_BACKEND}'，使用进程内实现")
+                    backend_cls = InProcessStateBackend
+                _backend = backend_cls()
+    return _backend
@@ -0,0 +1,88 @@
+"""
+启动预热与组件就绪状态
+- 重量级组件（ChromaDB + 嵌入模型、LLM 客户端、对话管线）均为惰性单例：导入模块时不再构建，
+  首次使用或由 Web 服务的预热任务在后台构建
+- 每个组件的加载状态、耗时与错误集中记录在这里，供 /api/health 按组件报告就绪情况
+"""
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, Optional
+
+PENDING = "pending"
+LOADING = "loading"
+READY = "ready"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class ComponentTracker:
+    """线程安全的组件就绪状态登记表。"""
+
+    def __init__(self):
+        self._components: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _set(self, name: str, **fields):
+        with self._lock:
+            entry = self._components.setdefault(name, {"status": PENDING})
+            entry.update(fields)
+
+    def register(self, *names: str):
+        """登记组件（已存在的保持原状态）。"""
+        with self._lock:
+            for name in names:
+                self._components.setdefault(name, {"status": PENDING})
+
+    @contextmanager
+    def track(self, name: str) -> Iterator[None]:
+        """包裹一次组件构建：记录 loading → ready / failed 以及耗时。"""
+        start = time.perf_counter()
+        self._set(name, status=LOADING, started_at=datetime.now().isoformat(), error=None)
+        try:
+            yield
+        except BaseException as e:
+            self._set(name, status=FAILED, error=str(e), seconds=round(time.perf_counter() - start, 3))
+            raise
+        self._set(name, status=READY, seconds=round(time.perf_counter() - start, 3))
+
+    def mark(self, name: str, status: str, error: Optional[str] = None):
+        self._set(name, status=status, error=error)
+
+    def status(self, name: str) -> str:
+        with self._lock:
+            return self._components.get(name, {}).get("status", PENDING)
+
+    def is_ready(self, *names: str) -> bool:
+        return all(self.status(name) == READY for name in names)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {name: dict(entry) for name, entry in self._components.items()}
+
+
+# 全局组件状态表
+components = ComponentTracker()
+
+
+class LazyProxy:
+    """
+    惰性代理：对外表现为目标对象，首次访问属性时才调用工厂函数构建目标。
+    用于保持 `from ... import memory_system` 这类模块级导入的写法不变。
+    """
+
+    __slots__ = ("_factory", "_name")
+
+    def __init__(self, factory: Callable[[], Any], name: str):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_name", name)
+
+    def __getattr__(self, item):
+        return getattr(self._factory(), item)
+
+    def __setattr__(self, key, value):
+        setattr(self._factory(), key, value)
+
+    def __repr__(self):
+        return f"<LazyProxy {self._name} ({components.status(self._name)})>"
@@ -0,0 +1,376 @@
+"""
+嵌入式事务状态存储（SQLite, WAL 模式）
+- 统一承载原先分散在多个小 JSON 文件中的状态：状态/关系历史/用户画像/活跃标签/临时关注事件/三类记忆缓存
+- 行级更新 + 事务，IdleProcessor 线程与 asyncio 任务并发写入时不再互相覆盖
+- 首次打开时自动从旧 JSON 文件迁移（原文件保留作为备份），也可手动执行：
+      python -m MiraMate.modules.state_store migrate [--force]
+- 通过环境变量 MIRAMATE_STATE_BACKEND=json 可退回旧的 JSON 文件存储
+"""
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from MiraMate.modules.settings import get_memory_dir
+
+STATE_BACKEND = os.getenv("MIRAMATE_STATE_BACKEND", "sqlite").strip().lower()
+STATE_DB_PATH = os.path.join(get_memory_dir(), "state.sqlite3")
+
+# 旧版 JSON 文件位置（与 status_system / memory_system 中的路径一致），仅用于迁移
+LEGACY_STATUS_DIR = os.path.join(get_memory_dir(), "status_storage")
+LEGACY_MEMORY_DIR = os.path.join(get_memory_dir(), "memory_storage")
+LEGACY_FILES = {
+    "status": os.path.join(LEGACY_STATUS_DIR, "status.json"),
+    "relationship_history": os.path.join(LEGACY_STATUS_DIR, "relationship_history.json"),
+    "user_profile": os.path.join(LEGACY_MEMORY_DIR, "user_profile.json"),
+    "active_tags": os.path.join(LEGACY_MEMORY_DIR, "active_tags.json"),
+    "temp_focus_events": os.path.join(LEGACY_MEMORY_DIR, "temp_focus_events.json"),
+    "fact_cache": os.path.join(LEGACY_MEMORY_DIR, "fact_cache.json"),
+    "preference_cache": os.path.join(LEGACY_MEMORY_DIR, "preference_cache.json"),
+    "profile_cache": os.path.join(LEGACY_MEMORY_DIR, "profile_cache.json"),
+}
+
+# 缓存种类 → 旧文件键
+CACHE_KINDS = {"fact": "fact_cache", "preference": "preference_cache", "profile": "profile_cache"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS kv (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS cache_entries (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cache_entries_kind ON cache_entries (kind);
+CREATE TABLE IF NOT EXISTS focus_events (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS relationship_history (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tag_counts (
+    tag TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tag_members (
+    memory_id TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    store TEXT NOT NULL,
+    PRIMARY KEY (memory_id, tag)
+);
+CREATE INDEX IF NOT EXISTS idx_tag_members_tag ON tag_members (tag);
+"""
+
+
+def _now() -> str:
+    return datetime.now().isoformat()
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+
+class StateStore:
+    """SQLite 状态存储：每个线程独立连接，写操作在 BEGIN IMMEDIATE 事务中执行。"""
+
+    def __init__(self, db_path: str = STATE_DB_PATH):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._local = threading.local()
+        # executescript 会隐式提交，因此建表不放在事务中执行
+        self._connection().executescript(SCHEMA)
+
+    # --- 连接与事务 ---
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None：由本类显式管理事务
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """写事务（可嵌套，嵌套时并入最外层事务）。"""
+        conn = self._connection()
+        if self._local.depth > 0:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.depth = 0
+
+    def _query(self, sql: str, params: Iterable = ()) -> List[Tuple]:
+        return self._connection().execute(sql, tuple(params)).fetchall()
+
+    # --- 元信息 ---
+    def get_meta(self, key: str) -> Optional[str]:
+        rows = self._query("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def set_meta(self, key: str, value: str):
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    # --- 通用键值（按命名空间分组，一个顶层字段一行） ---
+    def kv_get_all(self, namespace: str) -> Dict[str, Any]:
+        rows = self._query("SELECT key, value FROM kv WHERE namespace = ? ORDER BY rowid", (namespace,))
+        return {key: json.loads(value) for key, value in rows}
+
+    def kv_set(self, namespace: str, items: Dict[str, Any]):
+        """逐行写入（仅触及给定的键）。"""
+        if not items:
+            return
+        now = _now()
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO kv (namespace, key, value, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                [(namespace, key, _dumps(value), now) for key, value in items.items()]
+            )
+
+    def kv_replace(self, namespace: str, items: Dict[str, Any]):
+        """整体替换命名空间内容。"""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM kv WHERE namespace = ?", (namespace,))
+            self.kv_set(namespace, items)
+
+    def kv_delete(self, namespace: str, keys: Iterable[str]):
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM kv WHERE namespace = ? AND key = ?", [(namespace, key) for key in keys])
+
+    # --- 记忆缓存 ---
+    def cache_append(self, kind: str, entry: Dict):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (id, kind, payload, created_at) VALUES (?, ?, ?, ?)",
+                (entry["id"], kind, _dumps(entry), entry.get("timestamp") or _now())
+            )
+
+    def cache_load(self, kind: str) -> List[Dict]:
+        rows = self._query("SELECT payload FROM cache_entries WHERE kind = ? ORDER BY rowid", (kind,))
+        return [json.loads(payload) for (payload,) in rows]
+
+    def cache_clear(self, kind: str, ids: Optional[List[str]] = None) -> int:
+        """清空某类缓存；给定 ids 时只删除这些条目。"""
+        with self.transaction() as conn:
+            if ids is None:
+                cur = conn.execute("DELETE FROM cache_entries WHERE kind = ?", (kind,))
+            else:
+                cur = conn.executemany(
+                    "DELETE FROM cache_entries WHERE kind = ? AND id = ?", [(kind, i) for i in ids]
+                )
+            return cur.rowcount
+
+    def cache_counts(self) -> Dict[str, int]:
+        counts = {kind: 0 for kind in CACHE_KINDS}
+        for kind, count in self._query("SELECT kind, COUNT(*) FROM cache_entries GROUP BY kind"):
+            counts[kind] = count
+        return counts
+
+    # --- 临时关注事件 ---
+    def focus_load(self) -> List[Dict]:
+        rows = self._query("SELECT payload FROM focus_events ORDER BY rowid")
+        return [json.loads(payload) for (payload,) in rows]
+
+    def focus_upsert(self, events: List[Dict]):
+        if not events:
+            return
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO focus_events (id, payload) VALUES (?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET payload = excluded.payload",
+                [(e["id"], _dumps(e)) for e in events]
+            )
+
+    def focus_delete(self, ids: List[str]):
+        if not ids:
+            return
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM focus_events WHERE id = ?", [(i,) for i in ids])
+
+    # --- 关系变化历史 ---
+    def history_append(self, record: Dict, keep: int = 50):
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO relationship_history (payload) VALUES (?)", (_dumps(record),))
+            conn.execute(
+                "DELETE FROM relationship_history WHERE seq NOT IN "
+                "(SELECT seq FROM relationship_history ORDER BY seq DESC LIMIT ?)", (keep,)
+            )
+
+    def history_tail(self, limit: int) -> List[Dict]:
+        rows = self._query(
+            "SELECT payload FROM (SELECT seq, payload FROM relationship_history ORDER BY seq DESC LIMIT ?) "
+            "ORDER BY seq", (limit,)
+        )
+        return [json.loads(payload) for (payload,) in rows]
+
+    # --- 标签 ---
+    def tags_load(self) -> Tuple[Dict[str, int], Dict[str, Tuple[str, List[str]]]]:
+        counts = {tag: count for tag, count in self._query("SELECT tag, count FROM tag_counts")}
+        members: Dict[str, Tuple[str, List[str]]] = {}
+        for memory_id, tag, store in self._query("SELECT memory_id, tag, store FROM tag_members ORDER BY rowid"):
+            members.setdefault(memory_id, (store, []))[1].append(tag)
+        return counts, members
+
+    def tags_increment(self, tags: List[str]):
+        if not tags:
+            return
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO tag_counts (tag, count) VALUES (?, 1) "
+                "ON CONFLICT(tag) DO UPDATE SET count = count + 1",
+                [(t,) for t in tags]
+            )
+
+    def tag_members_set(self, memory_id: str, store: str, tags: List[str]):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM tag_members WHERE memory_id = ?", (memory_id,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO tag_members (memory_id, tag, store) VALUES (?, ?, ?)",
+                [(memory_id, t, store) for t in tags]
+            )
+
+    def tag_members_delete(self, memory_id: str):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM tag_members WHERE memory_id = ?", (memory_id,))
+
+    # --- 迁移 ---
+    def migrate_from_json(self, files: Optional[Dict[str, str]] = None, force: bool = False) -> Dict[str, int]:
+        """
+        将旧版 JSON 文件导入数据库（单个事务内完成）。默认只执行一次，force=True 时覆盖导入。
+        返回各数据源导入的条目数。
+        """
+        if self.get_meta("migrated_from_json") and not force:
+            return {}
+        files = files or LEGACY_FILES
+
+        def _read(key):
+            path = files.get(key)
+            if not path or not os.path.exists(path):
+                return None
+            try:
+                with open(path, encoding="utf-8") as f:
+                    return json.load(f)
+            except Exception as e:
+                print(f"⚠️ 迁移时读取 {path} 失败，已跳过: {e}")
+                return None
+
+        report: Dict[str, int] = {}
+        with self.transaction() as conn:
+            status = _read("status")
+            if isinstance(status, dict):
+                self.kv_replace("status", status)
+                report["status"] = len(status)
+
+            history = _read("relationship_history")
+            if isinstance(history, list):
+                conn.execute("DELETE FROM relationship_history")
+                conn.executemany("INSERT INTO relationship_history (payload) VALUES (?)",
+                                 [(_dumps(r),) for r in history])
+                report["relationship_history"] = len(history)
+
+            profile = _read("user_profile")
+            if isinstance(profile, dict):
+                self.kv_replace("profile", profile)
+                report["user_profile"] = len(profile)
+
+            tags = _read("active_tags")
+            if isinstance(tags, dict):
+                conn.execute("DELETE FROM tag_counts")
+                conn.execute("DELETE FROM tag_members")
+                conn.executemany("INSERT INTO tag_counts (tag, count) VALUES (?, ?)",
+                                 list((tags.get("tags") or {}).items()))
+                for memory_id, entry in (tags.get("members") or {}).items():
+                    self.tag_members_set(memory_id, entry.get("store", ""), entry.get("tags", []))
+                if isinstance(tags.get("members"), dict):
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                 ("tag_members_ready", _now()))
+                report["active_tags"] = len(tags.get("tags") or {})
+
+            events = _read("temp_focus_events")
+            if isinstance(events, list):
+                conn.execute("DELETE FROM focus_events")
+                self.focus_upsert([e for e in events if e.get("id")])
+                report["temp_focus_events"] = len(events)
+
+            for kind, file_key in CACHE_KINDS.items():
+                entries = _read(file_key)
+                if isinstance(entries, list):
+                    conn.execute("DELETE FROM cache_entries WHERE kind = ?", (kind,))
+                    for entry in entries:
+                        if entry.get("id"):
+                            self.cache_append(kind, entry)
+                    report[file_key] = len(entries)
+
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", ("migrated_from_json", _now()))
+        return report
+
+
+_state_store: Optional[StateStore] = None
+_state_store_lock = threading.Lock()
+
+
+def get_state_store() -> Optional[StateStore]:
+    """
+    获取进程内唯一的状态存储实例；后端为 json 时返回 None（调用方走旧的文件逻辑）。
+    首次创建时自动执行一次 JSON → SQLite 迁移。
+    """
+    global _state_store
+    if STATE_BACKEND != "sqlite":
+        return None
+    if _state_store is None:
+        with _state_store_lock:
+            if _state_store is None:
+                store = StateStore()
+                report = store.migrate_from_json()
+                if report:
+                    print(f"✅ 已将旧版 JSON 状态迁移到 SQLite: {report}")
+                _state_store = store
+    return _state_store
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="MiraMate 状态存储工具")
+    parser.add_argument("command", choices=["migrate"], help="migrate: 从旧版 JSON 文件导入到 SQLite")
+    parser.add_argument("--force", action="store_true", help="即使已迁移过也重新导入（覆盖数据库中的对应数据）")
+    parser.add_argument("--db", default=STATE_DB_PATH, help="数据库路径")
+    args = parser.parse_args()
+
+    result = StateStore(args.db).migrate_from_json(force=args.force)
+    if result:
+        print(f"✅ 迁移完成: {result}")
+    else:
+        print("ℹ️ 数据库已迁移过，如需重新导入请加 --force")
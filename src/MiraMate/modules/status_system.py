@@ -1,8 +1,11 @@
 import json
 import os
+from contextlib import nullcontext
 from datetime import datetime
 from typing import Dict, Any, List
 
+from MiraMate.modules.state_store import get_state_store
+
 # TODO: 目前状态模块存在一些冗余函数以及记录了一些暂时没用到的数据，未来可以考虑精简或在自主决策时用到
 
 # 路径配置
@@ -15,6 +18,13 @@ RELATIONSHIP_HISTORY_FILE = os.path.join(STATUS_DIR, "relationship_history.json"
 # 创建必要的目录
 os.makedirs(STATUS_DIR, exist_ok=True)
 
+# 状态存储后端：SQLite（默认，行级更新 + 事务）或旧版 JSON 文件（state_store 返回 None 时）
+_store = get_state_store()
+
+def _state_transaction():
+    """读-改-写操作的事务边界；JSON 后端下无事务语义。"""
+    return _store.transaction() if _store is not None else nullcontext()
+
 # 获取当前时间戳
 def get_timestamp() -> str:
     return datetime.now().isoformat()
@@ -24,92 +34,116 @@ def get_readable_timestamp() -> str:
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 # 加载状态
+def _default_status() -> Dict[str, Any]:
+    return {
+        "timestamp": get_timestamp(),
+        "ai_status": {
+            "emotion": {"mood": "平静", "strength": 0.5},
+            "user_attitude": {"emotional_feeling": "中立", "intimacy": 0.5},
+            "relationship_level": 1.0, 
+            "recent_topic_tags": []
+        },
+        "user_status": {
+            "last_emotion": "未知",
+            "last_topic": "无",
+            "current_mood": "未知",
+            "energy_level": 0.5 
+        },
+        "context_notes": {
+            "thinking_focus": "无",
+            "intent": "无",
+            "conversation_style": "正常",  
+            "session_context": "" 
+        },
+        "session_stats": {  
+            "message_count": 0,
+            "session_start": get_timestamp(),
+            "last_interaction": get_timestamp()
+        }
+    }
+
 def load_status() -> Dict[str, Any]:
+    if _store is not None:
+        return _store.kv_get_all("status") or _default_status()
     if not os.path.exists(STATUS_FILE):
-        return {
-            "timestamp": get_timestamp(),
-            "ai_status": {
-                "emotion": {"mood": "平静", "strength": 0.5},
-                "user_attitude": {"emotional_feeling": "中立", "intimacy": 0.5},
-                "relationship_level": 1.0, 
-                "recent_topic_tags": []
-            },
-            "user_status": {
-                "last_emotion": "未知",
-                "last_topic": "无",
-                "current_mood": "未知",
-                "energy_level": 0.5 
-            },
-            "context_notes": {
-                "thinking_focus": "无",
-                "intent": "无",
-                "conversation_style": "正常",  
-                "session_context": "" 
-            },
-            "session_stats": {  
-                "message_count": 0,
-                "session_start": get_timestamp(),
-                "last_interaction": get_timestamp()
-            }
-        }
+        return _default_status()
     with open(STATUS_FILE, "r", encoding="utf-8") as f:
         return json.load(f)
 
 # 保存状态
-def save_status(status: Dict[str, Any]):
+def save_status(status: Dict[str, Any], changed_keys: List[str] = None):
+    """
+    保存状态。SQLite 后端下每个顶层字段是一行，给定 changed_keys 时只写这些行。
+    """
     status["timestamp"] = get_timestamp()
     if "session_stats" in status:
         status["session_stats"]["last_interaction"] = get_timestamp()
+    if _store is not None:
+        keys = set(status) if changed_keys is None else set(changed_keys) | {"timestamp", "session_stats"}
+        _store.kv_set("status", {k: status[k] for k in keys if k in status})
+        return
     with open(STATUS_FILE, "w", encoding="utf-8") as f:
         json.dump(status, f, ensure_ascii=False, indent=2)
 
+def _is_new_status() -> bool:
+    """SQLite 后端下状态尚未写入过：此时需要整体写入默认状态，而不能只写变更的行。"""
+    return _store is not None and not _store.kv_get_all("status")
+
 # 部分更新状态（自动合并）
 def update_status(**kwargs):
-    status = load_status()
-    for key, value in kwargs.items():
-        if isinstance(value, dict) and key in status:
-            status[key].update(value)
-        else:
-            status[key] = value
-    save_status(status)
+    with _state_transaction():
+        is_new = _is_new_status()
+        status = load_status()
+        for key, value in kwargs.items():
+            if isinstance(value, dict) and key in status:
+                status[key].update(value)
+            else:
+                status[key] = value
+        save_status(status, changed_keys=None if is_new else list(kwargs))
 
 # 添加标签（带时间戳，避免重复）
 def add_tag(tag: str):
-    status = load_status()
-    tags = status.get("ai_status", {}).get("recent_topic_tags", [])
-    if not any(t["name"] == tag for t in tags):
-        tags.append({"name": tag, "timestamp": get_timestamp()})
-        status["ai_status"]["recent_topic_tags"] = tags
-        save_status(status)
-        print(f"✅ 标签已添加: {tag}")
-    else:
-        print(f"⚠️ 标签已存在: {tag}")
+    with _state_transaction():
+        is_new = _is_new_status()
+        status = load_status()
+        tags = status.get("ai_status", {}).get("recent_topic_tags", [])
+        if not any(t["name"] == tag for t in tags):
+            tags.append({"name": tag, "timestamp": get_timestamp()})
+            status["ai_status"]["recent_topic_tags"] = tags
+            save_status(status, changed_keys=None if is_new else ["ai_status"])
+            print(f"✅ 标签已添加: {tag}")
+        else:
+            print(f"⚠️ 标签已存在: {tag}")
 
 # 删除标签
 def remove_tag(tag: str):
-    status = load_status()
-    tags = status.get("ai_status", {}).get("recent_topic_tags", [])
-    original_count = len(tags)
-    tags = [t for t in tags if t["name"] != tag]
-    
-    if len(tags) < original_count:
-        status["ai_status"]["recent_topic_tags"] = tags
-        save_status(status)
-        print(f"✅ 标签已删除: {tag}")
-    else:
-        print(f"⚠️ 标签不存在: {tag}")
+    with _state_transaction():
+        is_new = _is_new_status()
+        status = load_status()
+        tags = status.get("ai_status", {}).get("recent_topic_tags", [])
+        original_count = len(tags)
+        tags = [t for t in tags if t["name"] != tag]
+
+        if len(tags) < original_count:
+            status["ai_status"]["recent_topic_tags"] = tags
+            save_status(status, changed_keys=None if is_new else ["ai_status"])
+            print(f"✅ 标签已删除: {tag}")
+        else:
+            print(f"⚠️ 标签不存在: {tag}")
 
 # 修改标签（保持时间戳不变）
 def edit_tag(old_tag: str, new_tag: str):
-    status = load_status()
-    tags = status.get("ai_status", {}).get("recent_topic_tags", [])
-    for t in tags:
-        if t["name"] == old_tag:
-            t["name"] = new_tag
-            save_status(status)
-            print(f"✅ 标签已修改: {old_tag} → {new_tag}")
-            return
-    print(f"⚠️ 未找到标签: {old_tag}")
+    with _state_transaction():
+        is_new = _is_new_status()
+        status = load_status()
+        tags = status.get("ai_status", {}).get("recent_topic_tags", [])
+        for t in tags:
+            if t["name"] == old_tag:
+                t["name"] = new_tag
+                save_status(status, changed_keys=None if is_new else ["ai_status"])
+                print(f"✅ 标签已修改: {old_tag} → {new_tag}")
+                return
+        print(f"⚠️ 未找到标签: {old_tag}")
 
 # 更新AI情绪状态
 def update_ai_emotion(mood: str, strength: float):
@@ -122,6 +156,10 @@ def update_ai_emotion(mood: str, strength: float):
 # 更新对用户的态度
 def update_user_attitude(emotional_feeling: str, intimacy_change: float = 0.0):
     """更新对用户的情感态度"""
+    with _state_transaction():
+        _update_user_attitude(emotional_feeling, intimacy_change)
+
+def _update_user_attitude(emotional_feeling: str, intimacy_change: float):
     status = load_status()
     current_intimacy = status["ai_status"]["user_attitude"]["intimacy"]
     
@@ -151,6 +189,10 @@ def update_user_attitude(emotional_feeling: str, intimacy_change: float = 0.0):
 # 更新关系等级
 def update_relationship_level(change: float):
     """更新关系亲密度等级 (1-10)"""
+    with _state_transaction():
+        return _update_relationship_level(change)
+
+def _update_relationship_level(change: float):
     status = load_status()
     current_level = status["ai_status"].get("relationship_level", 1.0)
     
@@ -174,12 +216,6 @@ def update_relationship_level(change: float):
 # 记录关系变化历史
 def save_relationship_change(reason: str, old_value: float, new_value: float, change: float):
     """保存关系变化记录"""
-    if not os.path.exists(RELATIONSHIP_HISTORY_FILE):
-        history = []
-    else:
-        with open(RELATIONSHIP_HISTORY_FILE, "r", encoding="utf-8") as f:
-            history = json.load(f)
-    
     change_record = {
         "timestamp": get_timestamp(),
         "readable_time": get_readable_timestamp(),
@@ -189,6 +225,17 @@ def save_relationship_change(reason: str, old_value: float, new_value: float, ch
         "change": change,
         "magnitude": abs(change)
     }
+
+    if _store is not None:
+        # 追加一行并裁剪，不再整文件读写
+        _store.history_append(change_record, keep=50)
+        return
+
+    if not os.path.exists(RELATIONSHIP_HISTORY_FILE):
+        history = []
+    else:
+        with open(RELATIONSHIP_HISTORY_FILE, "r", encoding="utf-8") as f:
+            history = json.load(f)
     
     history.append(change_record)
     
@@ -202,6 +249,9 @@ def save_relationship_change(reason: str, old_value: float, new_value: float, ch
 # 获取关系变化历史
 def get_relationship_history(limit: int = 10) -> List[Dict]:
     """获取最近的关系变化记录"""
+    if _store is not None:
+        return _store.history_tail(limit)
+
     if not os.path.exists(RELATIONSHIP_HISTORY_FILE):
         return []
     
@@ -249,9 +299,10 @@ def update_context_notes(thinking_focus: str = None, intent: str = None,
 # 增加会话计数
 def increment_message_count():
     """增加消息计数"""
-    status = load_status()
-    current_count = status.get("session_stats", {}).get("message_count", 0)
-    update_status(session_stats={"message_count": current_count + 1})
+    with _state_transaction():
+        status = load_status()
+        current_count = status.get("session_stats", {}).get("message_count", 0)
+        update_status(session_stats={"message_count": current_count + 1})
 
 def get_status_summary() -> Dict[str, Any]:
     """获取状态系统摘要，用于AI上下文"""
@@ -0,0 +1,326 @@
+"""
+标签倒排索引
+- 在内存中维护 标签 → 记忆ID 集合 以及 标签 → 累计计数，覆盖所有记忆存储（各 ChromaDB 集合与临时关注事件）
+- 取代每次保存都对 active_tags.json 进行整文件读写、以及对关注事件逐条子串扫描的做法
+- 持久化方式：active_tags.json 快照（兼容原有字段） + 追加写的增量日志，日志累积到一定条数后合并进快照；
+  或 SQLite 后端下直接按行更新 tag_counts / tag_members 表
+"""
+import heapq
+import json
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+
+def _get_timestamp() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class TagIndex:
+    """线程安全的标签倒排索引。"""
+
+    def __init__(self, snapshot_path: str, log_path: Optional[str] = None,
+                 compact_every: int = 200, db=None, on_change: Optional[Callable[[], None]] = None):
+        """
+        :param snapshot_path: 快照文件路径（即 active_tags.json）。
+        :param log_path: 增量日志路径，默认为快照同目录下的 active_tags.log.jsonl。
+        :param compact_every: 增量日志达到多少条后合并进快照。
+        :param db: 可选的 StateStore，提供时不再使用快照与日志文件。
+        :param on_change: 变更落盘后的回调（多进程部署时用于通知其他进程 reload）。
+        """
+        self.db = db
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path or os.path.splitext(snapshot_path)[0] + ".log.jsonl"
+        self.compact_every = compact_every
+        self.on_change = on_change
+
+        self._counts: Dict[str, int] = defaultdict(int)
+        # 倒排表结构: { tag: { memory_id } }
+        self._members: Dict[str, Set[str]] = defaultdict(set)
+        # 正排表结构: { memory_id: (store, [tags]) }
+        self._memory_tags: Dict[str, Tuple[str, List[str]]] = {}
+        # 小写标签 → 原始标签集合，用于大小写无关的文本匹配
+        self._lower_tags: Dict[str, Set[str]] = defaultdict(set)
+        self._max_tag_len = 0
+        self._last_update = ""
+        self._pending_log = 0
+        self._has_members = False
+        self._lock = threading.RLock()
+
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        self._load()
+
+    @property
+    def has_members(self) -> bool:
+        """快照中是否已包含成员关系（旧版 active_tags.json 只有计数，需要回填）。"""
+        return self._has_members
+
+    # --- 内部：结构维护（调用方需持有锁） ---
+    def _link(self, memory_id: str, store: str, tags: List[str]):
+        self._unlink(memory_id)
+        unique_tags = list(dict.fromkeys(t for t in tags if t))
+        for tag in unique_tags:
+            self._members[tag].add(memory_id)
+            self._register_tag(tag)
+        self._memory_tags[memory_id] = (store, unique_tags)
+
+    def _unlink(self, memory_id: str) -> bool:
+        entry = self._memory_tags.pop(memory_id, None)
+        if entry is None:
+            return False
+        for tag in entry[1]:
+            members = self._members.get(tag)
+            if members is not None:
+                members.discard(memory_id)
+                if not members:
+                    del self._members[tag]
+        return True
+
+    def _register_tag(self, tag: str):
+        lowered = tag.lower()
+        self._lower_tags[lowered].add(tag)
+        if len(lowered) > self._max_tag_len:
+            self._max_tag_len = len(lowered)
+
+    def _apply(self, record: Dict):
+        op = record.get("op")
+        if op == "add":
+            for tag in record.get("tags", []):
+                if tag:
+                    self._counts[tag] += 1
+                    self._register_tag(tag)
+            if record.get("id"):
+                self._link(record["id"], record.get("store", ""), record.get("tags", []))
+        elif op == "link":
+            self._link(record["id"], record.get("store", ""), record.get("tags", []))
+        elif op == "remove":
+            self._unlink(record.get("id", ""))
+        if record.get("ts"):
+            self._last_update = record["ts"]
+
+    # --- 内部：持久化 ---
+    def _load(self):
+        if self.db is not None:
+            try:
+                counts, members = self.db.tags_load()
+                for tag, count in counts.items():
+                    self._counts[tag] = count
+                    self._register_tag(tag)
+                for memory_id, (store, tags) in members.items():
+                    self._link(memory_id, store, tags)
+                self._has_members = bool(members) or bool(self.db.get_meta("tag_members_ready"))
+            except Exception as e:
+                print(f"⚠️ 标签索引加载失败，将从空索引开始: {e}")
+            return
+
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, encoding="utf-8") as f:
+                    data = json.load(f)
+                for tag, count in (data.get("tags") or {}).items():
+                    self._counts[tag] = count
+                    self._register_tag(tag)
+                members = data.get("members")
+                if isinstance(members, dict):
+                    self._has_members = True
+                    for memory_id, entry in members.items():
+                        self._link(memory_id, entry.get("store", ""), entry.get("tags", []))
+                self._last_update = data.get("last_update", "")
+            except Exception as e:
+                print(f"⚠️ 标签快照加载失败，将从空索引开始: {e}")
+
+        if os.path.exists(self.log_path):
+            try:
+                with open(self.log_path, encoding="utf-8") as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            self._apply(json.loads(line))
+                        except json.JSONDecodeError:
+                            continue
+                        self._pending_log += 1
+            except Exception as e:
+                print(f"⚠️ 标签增量日志加载失败: {e}")
+
+    def _reset(self):
+        self._counts.clear()
+        self._members.clear()
+        self._memory_tags.clear()
+        self._lower_tags.clear()
+        self._max_tag_len = 0
+        self._last_update = ""
+        self._pending_log = 0
+
+    def _changed(self):
+        if self.on_change is not None:
+            try:
+                self.on_change()
+            except Exception as e:
+                print(f"⚠️ 标签索引变更通知失败: {e}")
+
+    def _persist_record(self, record: Dict):
+        """SQLite 后端按行写入单条变更。"""
+        op = record.get("op")
+        try:
+            with self.db.transaction():
+                if op == "add":
+                    self.db.tags_increment(record.get("tags", []))
+                if op in ("add", "link") and record.get("id"):
+                    entry = self._memory_tags.get(record["id"], (record.get("store", ""), []))
+                    self.db.tag_members_set(record["id"], entry[0], entry[1])
+                elif op == "remove":
+                    self.db.tag_members_delete(record.get("id", ""))
+        except Exception as e:
+            print(f"❌ 标签索引写入失败: {e}")
+
+    def _append_log(self, record: Dict):
+        if self.db is not None:
+            self._persist_record(record)
+            self._changed()
+            return
+        try:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._pending_log += 1
+        except Exception as e:
+            print(f"❌ 标签增量日志写入失败: {e}")
+        if self._pending_log >= self.compact_every:
+            self.flush()
+
+    def flush(self):
+        """将当前索引写入快照（原子替换）并清空增量日志；SQLite 后端下整体重写成员表。"""
+        with self._lock:
+            if self.db is not None:
+                try:
+                    with self.db.transaction() as conn:
+                        conn.execute("DELETE FROM tag_members")
+                        for memory_id, (store, tags) in self._memory_tags.items():
+                            self.db.tag_members_set(memory_id, store, tags)
+                        self.db.set_meta("tag_members_ready", _get_timestamp())
+                    self._has_members = True
+                except Exception as e:
+                    print(f"❌ 标签索引写入失败: {e}")
+                self._changed()
+                return
+            counts = dict(self._counts)
+            data = {
+                "type": "active_tags",
+                "tags": counts,
+                "last_update": self._last_update or _get_timestamp(),
+                "total_tags": len(counts),
+                "most_frequent": max(counts.items(), key=lambda x: x[1]) if counts else None,
+                "members": {
+                    memory_id: {"store": store, "tags": tags}
+                    for memory_id, (store, tags) in self._memory_tags.items()
+                }
+            }
+            tmp_path = self.snapshot_path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, self.snapshot_path)
+                if os.path.exists(self.log_path):
+                    os.remove(self.log_path)
+                self._pending_log = 0
+                self._has_members = True
+            except Exception as e:
+                print(f"❌ 标签快照写入失败: {e}")
+
+    # --- 公共接口 ---
+    def reload(self):
+        """丢弃内存索引并从持久化存储重新加载（其他进程修改了标签时调用）。"""
+        with self._lock:
+            self._reset()
+            self._load()
+
+    def add(self, tags: Iterable[str], memory_id: Optional[str] = None, store: str = ""):
+        """记录一次标签使用（计数 +1），若提供 memory_id 则同时建立成员关系。"""
+        tags = [t for t in tags or [] if t]
+        if not tags and not memory_id:
+            return
+        record = {"op": "add", "tags": tags, "ts": _get_timestamp()}
+        if memory_id:
+            record["id"] = memory_id
+            record["store"] = store
+        with self._lock:
+            self._apply(record)
+            self._append_log(record)
+
+    def link(self, memory_id: str, tags: Iterable[str], store: str = "", persist: bool = True):
+        """仅建立/覆盖成员关系而不改变计数（用于回填或记忆更新）。"""
+        record = {"op": "link", "id": memory_id, "store": store, "tags": [t for t in tags or [] if t]}
+        with self._lock:
+            self._apply(record)
+            if persist:
+                self._append_log(record)
+
+    def remove(self, memory_id: str) -> bool:
+        """移除一条记忆的成员关系（历史计数保留，反映标签的累计活跃度）。"""
+        with self._lock:
+            if memory_id not in self._memory_tags:
+                return False
+            record = {"op": "remove", "id": memory_id, "ts": _get_timestamp()}
+            self._apply(record)
+            self._append_log(record)
+            return True
+
+    def count(self, tag: str) -> int:
+        return self._counts.get(tag, 0)
+
+    def tags_of(self, memory_id: str) -> List[str]:
+        entry = self._memory_tags.get(memory_id)
+        return list(entry[1]) if entry else []
+
+    def ids_for_tags(self, tags: Iterable[str], store: Optional[str] = None,
+                     match_all: bool = False) -> Set[str]:
+        """返回带有给定标签（任一或全部）的记忆ID集合，可按存储过滤。"""
+        with self._lock:
+            sets = [self._members.get(tag, set()) for tag in tags if tag]
+            if not sets:
+                return set()
+            ids = set.intersection(*sets) if match_all else set().union(*sets)
+            if store is not None:
+                ids = {i for i in ids if self._memory_tags.get(i, ("", []))[0] == store}
+            return ids
+
+    def tags_in_text(self, text: str) -> Set[str]:
+        """
+        找出作为子串出现在文本中的所有已知标签（大小写无关）。
+        通过枚举文本中长度不超过最长标签的子串进行哈希查找，耗时与标签/记忆总数无关。
+        """
+        if not text:
+            return set()
+        lowered = text.lower()
+        found: Set[str] = set()
+        with self._lock:
+            max_len = self._max_tag_len
+            for start in range(len(lowered)):
+                for end in range(start + 1, min(len(lowered), start + max_len) + 1):
+                    originals = self._lower_tags.get(lowered[start:end])
+                    if originals:
+                        found.update(originals)
+        return found
+
+    def ids_matching_text(self, text: str, store: Optional[str] = None) -> Set[str]:
+        """返回其任一标签出现在文本中的记忆ID集合。"""
+        return self.ids_for_tags(self.tags_in_text(text), store=store)
+
+    def top(self, top_n: int = 10) -> List[Tuple[str, int]]:
+        with self._lock:
+            return heapq.nlargest(top_n, self._counts.items(), key=lambda x: x[1])
+
+    def snapshot(self, top_n: int = 10) -> Dict:
+        """返回与原 get_active_tags 相同结构的统计信息。"""
+        with self._lock:
+            counts = dict(self._counts)
+            return {
+                "tags": counts,
+                "top_tags": self.top(top_n),
+                "total_count": sum(counts.values()),
+                "unique_count": len(counts),
+                "last_update": self._last_update
+            }
@@ -0,0 +1,286 @@
+"""
+聊天记录持久化：分段追加日志 + 稀疏偏移索引
+- 记录按写入顺序分配连续递增的序号 seq，以 JSON Lines 追加写入段文件 segment-<起始序号>.jsonl，
+  段文件超过 segment_bytes 后封存并开启新段
+- 每段每隔 index_interval 条记录登记一个稀疏索引项 (seq, 文件偏移, 写入时间)，同时追加到同名 .idx 文件；
+  定位任意 seq 只需二分查找索引再顺序读取不超过 index_interval 行，读取成本与日志总量无关
+- 写入时间 ts 单调不减（时钟回拨时沿用上一条的时间），因此同样可以按时间二分定位
+- 启动时封存段直接加载 .idx，只重新扫描最后一个（活动）段，并截掉上次写入中断留下的残行
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+SEGMENT_PREFIX = "segment-"
+
+# 日志行中附加的内部字段
+SEQ_FIELD = "_seq"
+TS_FIELD = "_ts"
+
+
+class _Segment:
+    """一个段文件及其稀疏索引。"""
+
+    __slots__ = ("base_seq", "path", "idx_path", "count", "size", "index_seq", "index_offset", "index_ts")
+
+    def __init__(self, directory: str, base_seq: int):
+        self.base_seq = base_seq
+        self.path = os.path.join(directory, f"{SEGMENT_PREFIX}{base_seq:012d}.jsonl")
+        self.idx_path = self.path[:-len(".jsonl")] + ".idx"
+        self.count = 0
+        self.size = 0
+        # 稀疏索引按列保存，便于 bisect
+        self.index_seq: List[int] = []
+        self.index_offset: List[int] = []
+        self.index_ts: List[float] = []
+
+    @property
+    def end_seq(self) -> int:
+        return self.base_seq + self.count
+
+    def add_index(self, seq: int, offset: int, ts: float):
+        self.index_seq.append(seq)
+        self.index_offset.append(offset)
+        self.index_ts.append(ts)
+
+    def locate(self, seq: int) -> Tuple[int, int]:
+        """不晚于 seq 的最近索引项，返回 (索引项 seq, 文件偏移)。"""
+        i = bisect.bisect_right(self.index_seq, seq) - 1
+        return self.index_seq[i], self.index_offset[i]
+
+
+class TranscriptLog:
+    """分段追加日志。append 由调用方串行化；读取可在其他线程并发进行（每次读取使用独立的文件句柄）。"""
+
+    def __init__(self, directory: str, segment_bytes: int = 4 * 1024 * 1024, index_interval: int = 64):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = max(1, index_interval)
+        self._segments: List[_Segment] = []
+        self._writer = None
+        self._idx_writer = None
+        self._last_ts = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    # --- 启动恢复 ---
+    def _load(self):
+        bases = sorted(
+            int(name[len(SEGMENT_PREFIX):-len(".jsonl")])
+            for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(".jsonl")
+        )
+        for i, base in enumerate(bases):
+            segment = _Segment(self.directory, base)
+            sealed = i + 1 < len(bases)
+            if not (sealed and self._load_index(segment, bases[i + 1] - base)):
+                self._scan(segment)
+            self._segments.append(segment)
+        if not self._segments:
+            self._segments.append(_Segment(self.directory, 0))
+        self._open_writer()
+        if len(self):
+            # 新记录的写入时间不早于日志中的最后一条
+            self._last_ts = self.read(self.next_seq - 1)[0]
+
+    def _load_index(self, segment: _Segment, count: int) -> bool:
+        """加载封存段的 .idx 文件；文件缺失或损坏时返回 False（改为重新扫描）。"""
+        try:
+            with open(segment.idx_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    seq, offset, ts = line.split()
+                    segment.add_index(int(seq), int(offset), float(ts))
+        except (OSError, ValueError):
+            segment.index_seq, segment.index_offset, segment.index_ts = [], [], []
+            return False
+        if not segment.index_seq or segment.index_seq[0] != segment.base_seq:
+            segment.index_seq, segment.index_offset, segment.index_ts = [], [], []
+            return False
+        segment.count = count
+        segment.size = os.path.getsize(segment.path)
+        return True
+
+    def _scan(self, segment: _Segment):
+        """顺序扫描段文件重建索引，截掉末尾不完整的行，并重写 .idx 文件。"""
+        position = 0
+        with open(segment.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                if segment.count % self.index_interval == 0:
+                    try:
+                        ts = float(json.loads(line).get(TS_FIELD, 0.0))
+                    except ValueError:
+                        break
+                    segment.add_index(segment.base_seq + segment.count, position, ts)
+                segment.count += 1
+                position += len(line)
+        if position < os.path.getsize(segment.path):
+            with open(segment.path, "r+b") as f:
+                f.truncate(position)
+        segment.size = position
+        with open(segment.idx_path, "w", encoding="utf-8") as f:
+            for seq, offset, ts in zip(segment.index_seq, segment.index_offset, segment.index_ts):
+                f.write(f"{seq} {offset} {ts}\n")
+
+    def _open_writer(self):
+        segment = self._segments[-1]
+        self._writer = open(segment.path, "ab")
+        self._idx_writer = open(segment.idx_path, "a", encoding="utf-8")
+
+    # --- 写入 ---
+    @property
+    def first_seq(self) -> int:
+        return self._segments[0].base_seq
+
+    @property
+    def next_seq(self) -> int:
+        return self._segments[-1].end_seq
+
+    def __len__(self) -> int:
+        return self.next_seq - self.first_seq
+
+    def append(self, record: Dict[str, Any]) -> Tuple[int, float]:
+        """追加一条记录，返回 (seq, 写入时间)。"""
+        with self._lock:
+            segment = self._segments[-1]
+            if segment.size >= self.segment_bytes and segment.count:
+                segment = self._roll()
+            seq = segment.end_seq
+            ts = max(time.time(), self._last_ts)
+            self._last_ts = ts
+            line = json.dumps({**record, SEQ_FIELD: seq, TS_FIELD: ts}, ensure_ascii=False).encode("utf-8") + b"\n"
+            if segment.count % self.index_interval == 0:
+                segment.add_index(seq, segment.size, ts)
+                self._idx_writer.write(f"{seq} {segment.size} {ts}\n")
+                self._idx_writer.flush()
+            self._writer.write(line)
+            self._writer.flush()
+            segment.size += len(line)
+            segment.count += 1
+            return seq, ts
+
+    def _roll(self) -> _Segment:
+        self._close_writers()
+        segment = _Segment(self.directory, self.next_seq)
+        self._segments.append(segment)
+        self._open_writer()
+        return segment
+
+    def clear(self):
+        """删除全部段文件；序号继续递增，旧游标不会指向新记录。"""
+        with self._lock:
+            next_seq = self.next_seq
+            self._close_writers()
+            for segment in self._segments:
+                for path in (segment.path, segment.idx_path):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            self._segments = [_Segment(self.directory, next_seq)]
+            self._open_writer()
+
+    def _close_writers(self):
+        for handle in (self._writer, self._idx_writer):
+            if handle is not None:
+                handle.close()
+        self._writer = self._idx_writer = None
+
+    def close(self):
+        with self._lock:
+            self._close_writers()
+
+    # --- 读取 ---
+    def _segment_for(self, seq: int) -> Optional[_Segment]:
+        segments = self._segments
+        i = bisect.bisect_right([s.base_seq for s in segments], seq) - 1
+        if i < 0 or seq >= segments[i].end_seq:
+            return None
+        return segments[i]
+
+    def _read_range(self, segment: _Segment, start: int, stop: int) -> List[Tuple[int, float, Dict[str, Any]]]:
+        """读取段内 [start, stop) 的记录：从不晚于 start 的索引项开始顺序读取。"""
+        index_seq, offset = segment.locate(start)
+        results = []
+        with open(segment.path, "rb") as f:
+            f.seek(offset)
+            seq = index_seq
+            while seq < stop:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break
+                if seq >= start:
+                    record = json.loads(line)
+                    record.pop(SEQ_FIELD, None)
+                    results.append((seq, record.pop(TS_FIELD, 0.0), record))
+                seq += 1
+        return results
+
+    def read(self, seq: int) -> Optional[Tuple[float, Dict[str, Any]]]:
+        segment = self._segment_for(seq)
+        if segment is None:
+            return None
+        rows = self._read_range(segment, seq, seq + 1)
+        return (rows[0][1], rows[0][2]) if rows else None
+
+    def iterate(self, start: int, reverse: bool = False, stop: Optional[int] = None) -> Iterator[Tuple[int, float, Dict[str, Any]]]:
+        """
+        从 start（含）开始逐条产出 (seq, ts, record)。正序读到 stop（不含，默认为当前末尾）为止；
+        倒序按索引块向前读取，每块最多 index_interval 行。
+        """
+        first, end = self.first_seq, self.next_seq
+        if reverse:
+            seq = min(start, end - 1)
+            floor = first if stop is None else max(first, stop)
+            while seq >= floor:
+                segment = self._segment_for(seq)
+                if segment is None:
+                    return
+                block_start, _ = segment.locate(seq)
+                block_start = max(block_start, floor)
+                for row in reversed(self._read_range(segment, block_start, seq + 1)):
+                    yield row
+                seq = block_start - 1
+        else:
+            seq = max(start, first)
+            limit = end if stop is None else min(stop, end)
+            while seq < limit:
+                segment = self._segment_for(seq)
+                if segment is None:
+                    return
+                # 每次最多读取一个索引块，调用方提前结束迭代时不会多读
+                block_end = min(limit, segment.end_seq, seq + self.index_interval)
+                yield from self._read_range(segment, seq, block_end)
+                seq = block_end
+
+    def seq_at_time(self, ts: float) -> int:
+        """第一条写入时间 >= ts 的记录的序号（不存在时返回 next_seq）。"""
+        segments = self._segments
+        # 最后一个首条时间 < ts 的段
+        i = bisect.bisect_left([s.index_ts[0] if s.index_ts else float("inf") for s in segments], ts) - 1
+        if i < 0:
+            return self.first_seq
+        segment = segments[i]
+        # 目标位于首个时间 >= ts 的索引项之前的那一块中（或恰为该索引项），最多读取一块多一点
+        k = bisect.bisect_left(segment.index_ts, ts)
+        for seq, row_ts, _ in self.iterate(segment.index_seq[k - 1], stop=segment.end_seq):
+            if row_ts >= ts:
+                return seq
+        # 该段内没有满足条件的记录：下一段的首条即是（其首条时间 >= ts）
+        return segment.end_seq
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "directory": self.directory,
+            "segments": len(self._segments),
+            "records": len(self),
+            "first_seq": self.first_seq,
+            "next_seq": self.next_seq,
+            "bytes": sum(s.size for s in self._segments),
+            "index_entries": sum(len(s.index_seq) for s in self._segments),
+        }
@@ -0,0 +1,148 @@
+"""
+共享内存向量环形缓冲
+- 嵌入工作进程与主进程之间传递向量时不再经由队列 pickle：主进程预先分配一块
+  multiprocessing.shared_memory，划分为固定数量的槽位（每槽 slot_rows × dim 个 float32）
+- 主进程在提交请求前占用一个槽位，子进程把编码结果直接写入该槽位，队列上只传递 (req_id, slot)
+- 主进程侧以 NumPy 视图读取槽位内容；需要长期持有向量的调用方（写入 ChromaDB）复制一份后立即归还槽位，
+  只在一次检索内使用向量的调用方（查询向量 → 向量检索 / MMR 重排）通过 VectorLease 直接借用视图，用完归还
+- 槽位分配只发生在主进程（单一分配者），子进程只写入主进程指定的槽位，因此不需要跨进程锁
+"""
+import threading
+from collections import deque
+from multiprocessing import shared_memory
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+DTYPE = np.float32
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """以非所有者身份附加到已存在的共享内存块（不登记到 resource_tracker，避免子进程退出时误删）。"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 没有 track 参数：spawn 子进程与主进程共用同一个 resource_tracker，
+        # 重复登记同名共享内存无副作用，删除仍由主进程 unlink() 完成
+        return shared_memory.SharedMemory(name=name)
+
+
+class VectorLease:
+    """
+    借用的只读向量矩阵。array 可能直接指向共享内存槽位，release() 之后不得再访问。
+    支持 with 语句；对于普通 ndarray（非共享内存）release() 为空操作。
+    """
+
+    __slots__ = ("array", "_release")
+
+    def __init__(self, array: np.ndarray, release: Optional[Callable[[], None]] = None):
+        self.array = array
+        self._release = release
+
+    def release(self):
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    def __enter__(self) -> np.ndarray:
+        return self.array
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def __del__(self):
+        # 兜底：调用方忘记归还时，随对象回收归还槽位
+        try:
+            self.release()
+        except Exception:
+            pass
+
+
+class VectorRing:
+    """固定槽位的共享内存 float32 向量缓冲区。"""
+
+    def __init__(self, slots: int, slot_rows: int, dim: int, name: Optional[str] = None, create: bool = True):
+        self.slots = slots
+        self.slot_rows = slot_rows
+        self.dim = dim
+        size = max(1, slots * slot_rows * dim * np.dtype(DTYPE).itemsize)
+        if create:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self._shm = _attach_shared_memory(name)
+        self.owner = create
+        self._matrix = np.ndarray((slots, slot_rows, dim), dtype=DTYPE, buffer=self._shm.buf)
+        # 以下仅在主进程（所有者）中使用
+        self._free = deque(range(slots))
+        self._available = threading.Semaphore(slots)
+        self._lock = threading.Lock()
+        self.stats = {"acquired": 0, "exhausted": 0}
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    def spec(self) -> Tuple[str, int, int, int]:
+        """传给子进程用于 attach() 的描述。"""
+        return (self.name, self.slots, self.slot_rows, self.dim)
+
+    @classmethod
+    def attach(cls, spec: Tuple[str, int, int, int]) -> "VectorRing":
+        name, slots, slot_rows, dim = spec
+        return cls(slots, slot_rows, dim, name=name, create=False)
+
+    # --- 槽位分配（主进程） ---
+    def acquire(self, timeout: Optional[float] = None) -> Optional[int]:
+        """占用一个空闲槽位；超时仍无空闲槽位时返回 None（调用方回退到队列传输）。"""
+        if not self._available.acquire(timeout=timeout):
+            self.stats["exhausted"] += 1
+            return None
+        with self._lock:
+            self.stats["acquired"] += 1
+            return self._free.popleft()
+
+    def release(self, slot: int):
+        with self._lock:
+            self._free.append(slot)
+        self._available.release()
+
+    def in_use(self) -> int:
+        with self._lock:
+            return self.slots - len(self._free)
+
+    # --- 读写 ---
+    def view(self, slot: int, rows: int) -> np.ndarray:
+        """槽位前 rows 行的视图（不复制）。"""
+        return self._matrix[slot, :rows]
+
+    def write(self, slot: int, vectors: np.ndarray):
+        self._matrix[slot, :len(vectors)] = vectors
+
+    def lease(self, slot: int, rows: int) -> VectorLease:
+        """把槽位内容以只读视图借出，归还时释放槽位。"""
+        array = self.view(slot, rows)
+        array.flags.writeable = False
+        return VectorLease(array, lambda: self.release(slot))
+
+    def describe(self) -> Dict[str, int]:
+        return {
+            "name": self.name,
+            "slots": self.slots,
+            "slot_rows": self.slot_rows,
+            "in_use": self.in_use(),
+            "shared_bytes": self._shm.size,
+            **self.stats,
+        }
+
+    def close(self):
+        """解除映射；所有者同时删除共享内存块。仍有视图存活时保持映射，由进程退出回收。"""
+        self._matrix = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass
+        if self.owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
@@ -4,16 +4,68 @@
 """
 
 import asyncio
+import os
+import re
+import time
 import uuid
-from typing import Dict, List, Any, Optional
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Any, Optional, Tuple
 from datetime import datetime
 
 # 导入重构后的核心组件
-from MiraMate.core.pipeline import final_chain, get_memory_for_session
+from MiraMate.core.pipeline import final_chain, get_memory_for_session, drop_session, restore_session, persist_session
 from MiraMate.core.post_sync_chain import post_sync_chain
 from MiraMate.core.post_async_chain import post_async_chain
-from MiraMate.core.idle_processor import IdleProcessor
+from MiraMate.core.idle_processor import IdleProcessor, USER_ACTIVITY_CHANNEL
 from MiraMate.modules.status_system import get_status_summary
+from MiraMate.modules.async_runtime import run_blocking
+from MiraMate.modules.shared_state import get_shared_state
+from MiraMate.web_api.stream_encoding import STREAM_DEBUG, TokenCoalescer, stream_debug
+
+# 客户端提供的会话 ID：字母、数字与 -_.: ，最长 128 个字符
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.:\-]{1,128}$")
+# 会话空闲超过该时长（秒）后回收其对话记忆与检索缓存（默认会话除外）
+SESSION_IDLE_TTL = int(os.getenv("MIRAMATE_SESSION_IDLE_TTL", "86400"))
+# 每个会话最多排队等待的回合数，超出时拒绝新请求
+SESSION_MAX_PENDING = int(os.getenv("MIRAMATE_SESSION_MAX_PENDING", "4"))
+# 合并窗口（毫秒）：同一会话在窗口内连续到达的消息合并为一个回合；0 表示关闭合并
+COALESCE_WINDOW_MS = float(os.getenv("MIRAMATE_COALESCE_WINDOW_MS", "0"))
+# 单个合并回合最多包含的消息数
+COALESCE_MAX_MESSAGES = int(os.getenv("MIRAMATE_COALESCE_MAX_MESSAGES", "8"))
+# 向运行 IdleProcessor 的 worker 转发互动信号的最小间隔（秒）
+ACTIVITY_PUBLISH_INTERVAL = 5.0
+
+
+class SessionBusyError(RuntimeError):
+    """会话排队等待的回合已达上限。"""
+
+
+class _TurnBatch:
+    """
+    一个待执行的回合及其合并进来的消息。
+    第一条消息的请求方（leader）负责执行回合；后续合并进来的请求方（follower）等待 result 完成。
+    """
+
+    def __init__(self, message: str):
+        self.id = uuid.uuid4().hex[:8]
+        self.messages = [message]
+        self.last_arrival = time.monotonic()
+        self.closed = False
+        self.result: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def add(self, message: str):
+        self.messages.append(message)
+        self.last_arrival = time.monotonic()
+
+    def finish(self, value: Dict[str, Any]):
+        if not self.result.done():
+            self.result.set_result(value)
+
+    def fail(self, error: BaseException):
+        if not self.result.done():
+            self.result.set_exception(error)
+            # 没有 follower 时避免 "exception was never retrieved" 警告
+            self.result.exception()
 
 
 class ConversationHandlerAdapter:
@@ -26,22 +78,172 @@ class ConversationHandlerAdapter:
         Args:
             config_path: 配置文件路径（保持兼容性，实际不使用）
         """
-        self.session_id = str(uuid.uuid4())  
+        # 默认会话：未携带 session_id 的请求共用（与原先的单会话行为一致）
+        self.session_id = str(uuid.uuid4())
+        # 会话 ID -> {"created_at", "last_active", "turns", "waiting", "running", "coalesced", "open_batch"}
+        self.sessions: Dict[str, Dict[str, Any]] = {}
+        # 每个会话一把锁：同一会话的回合串行执行，不同会话之间并行
+        self._session_locks: Dict[str, asyncio.Lock] = {}
         self.background_tasks_running = False
         self.idle_processor = None  
-        print(f"✅ ConversationHandlerAdapter 初始化完成，Session ID: {self.session_id}")
+        self._last_activity_publish = float("-inf")
+        print(f"✅ ConversationHandlerAdapter 初始化完成，默认 Session ID: {self.session_id}")
+
+    # --- 会话管理 ---
+    def resolve_session_id(self, session_id: Optional[str] = None) -> str:
+        """未提供时返回默认会话；格式非法时抛出 ValueError。"""
+        if not session_id:
+            return self.session_id
+        if not SESSION_ID_PATTERN.match(session_id):
+            raise ValueError("session_id 只能包含字母、数字和 -_.: ，且不超过 128 个字符")
+        return session_id
+
+    def _get_session(self, session_id: str) -> Dict[str, Any]:
+        info = self.sessions.get(session_id)
+        if info is None:
+            self._evict_idle_sessions()
+            now = time.time()
+            info = {"created_at": now, "last_active": now, "turns": 0, "waiting": 0, "running": False,
+                    "coalesced": 0, "open_batch": None}
+            self.sessions[session_id] = info
+            self._session_locks[session_id] = asyncio.Lock()
+        return info
+
+    def _evict_idle_sessions(self):
+        """回收长期空闲的会话（没有进行中或排队的回合）。"""
+        deadline = time.time() - SESSION_IDLE_TTL
+        for session_id, info in list(self.sessions.items()):
+            if session_id == self.session_id or info["running"] or info["waiting"] or info["open_batch"]:
+                continue
+            if info["last_active"] < deadline:
+                del self.sessions[session_id]
+                del self._session_locks[session_id]
+                drop_session(session_id)
+                print(f"🧹 回收空闲会话 {session_id[:8]}")
+
+    @asynccontextmanager
+    async def session_turn(self, session_id: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        进入一个会话回合：同一会话的回合按到达顺序串行执行，产出规范化后的会话 ID。
+        排队的回合数达到 SESSION_MAX_PENDING 时抛出 SessionBusyError。
+        多进程部署时另外持有跨进程的会话锁，并在回合前后与共享状态同步会话记忆。
+        """
+        session_id = self.resolve_session_id(session_id)
+        info = self._get_session(session_id)
+        if info["waiting"] >= SESSION_MAX_PENDING and self._session_locks[session_id].locked():
+            raise SessionBusyError(f"会话 {session_id[:8]} 已有 {info['waiting']} 个回合在排队，请稍后再试")
+        info["waiting"] += 1
+        try:
+            await self._session_locks[session_id].acquire()
+        finally:
+            info["waiting"] -= 1
+        info["running"] = True
+        try:
+            state = get_shared_state()
+            async with state.alock(f"session-{session_id}"):
+                if state.shared:
+                    await run_blocking(restore_session, session_id)
+                try:
+                    yield session_id
+                finally:
+                    if state.shared:
+                        await run_blocking(persist_session, session_id)
+        finally:
+            info["running"] = False
+            info["turns"] += 1
+            info["last_active"] = time.time()
+            self._session_locks[session_id].release()
+
+    def get_sessions_snapshot(self) -> Dict[str, Any]:
+        """会话概况（供 /api/stats 使用）。"""
+        return {
+            "default_session_id": self.session_id,
+            "total": len(self.sessions),
+            "running": sum(1 for info in self.sessions.values() if info["running"]),
+            "waiting": sum(info["waiting"] for info in self.sessions.values()),
+            "idle_ttl_seconds": SESSION_IDLE_TTL,
+            "max_pending": SESSION_MAX_PENDING,
+            "coalesce_window_ms": COALESCE_WINDOW_MS,
+            "coalesced_messages": sum(info["coalesced"] for info in self.sessions.values()),
+        }
+
+    def _join_batch(self, session_id: str, user_message: str) -> Tuple[_TurnBatch, bool]:
+        """
+        为消息找到所属回合，返回 (回合, 是否为 leader)。
+        开启合并时，若该会话有尚未开始执行的回合，消息并入其中（follower）；否则新建回合（leader）。
+        """
+        if COALESCE_WINDOW_MS <= 0:
+            return _TurnBatch(user_message), True
+        info = self._get_session(session_id)
+        batch = info["open_batch"]
+        if batch is not None and not batch.closed and len(batch.messages) < COALESCE_MAX_MESSAGES:
+            batch.add(user_message)
+            info["coalesced"] += 1
+            return batch, False
+        batch = _TurnBatch(user_message)
+        info["open_batch"] = batch
+        return batch, True
+
+    async def _close_batch(self, session_id: str, batch: _TurnBatch) -> str:
+        """
+        （leader 持有会话锁后调用）等到最后一条消息之后静默满一个合并窗口，停止接收新消息，返回合并后的用户输入。
+        """
+        if COALESCE_WINDOW_MS > 0:
+            window = COALESCE_WINDOW_MS / 1000.0
+            while True:
+                remaining = batch.last_arrival + window - time.monotonic()
+                if remaining <= 0 or len(batch.messages) >= COALESCE_MAX_MESSAGES:
+                    break
+                await asyncio.sleep(remaining)
+            batch.closed = True
+            info = self.sessions.get(session_id)
+            if info is not None and info["open_batch"] is batch:
+                info["open_batch"] = None
+        if len(batch.messages) > 1:
+            print(f"🧩 会话 {session_id[:8]}: {len(batch.messages)} 条消息合并为一个回合")
+        return "\n".join(batch.messages)
+
+    def _abandon_batch(self, session_id: str, batch: _TurnBatch, error: BaseException):
+        """leader 未能执行回合（排队已满、被取消或出错）时，通知 follower 并撤下该回合。"""
+        batch.closed = True
+        info = self.sessions.get(session_id)
+        if info is not None and info["open_batch"] is batch:
+            info["open_batch"] = None
+        batch.fail(error)
         
-    async def get_response_with_commands(self, user_message: str, enable_timing: bool = False) -> Dict[str, Any]:
+    async def get_response_with_commands(self, user_message: str, enable_timing: bool = False,
+                                         session_id: Optional[str] = None) -> Dict[str, Any]:
         """
         获取AI回复和视觉效果指令（兼容原有API接口，非流式）
         
         Args:
             user_message: 用户消息
             enable_timing: 是否启用时间统计
+            session_id: 会话 ID（为空时使用默认会话）
             
         Returns:
             包含回复文本和指令的字典
         """
+        session_id = self.resolve_session_id(session_id)
+        batch, leader = self._join_batch(session_id, user_message)
+        if not leader:
+            # 已并入同一会话中尚未开始的回合：等待该回合完成并返回同一回复
+            result = await asyncio.shield(batch.result)
+            return {**result, "coalesced": True}
+        try:
+            async with self.session_turn(session_id):
+                merged_message = await self._close_batch(session_id, batch)
+                result = await self._respond(merged_message, enable_timing, session_id)
+                # 本回合实际回复的全部用户消息（合并时多于一条），供调用方写入聊天记录
+                result["user_messages"] = list(batch.messages)
+        except BaseException as e:
+            self._abandon_batch(session_id, batch, e)
+            raise
+        batch.finish(result)
+        return result
+
+    async def _respond(self, user_message: str, enable_timing: bool, session_id: str) -> Dict[str, Any]:
+        """非流式回合的实际处理（调用方已持有会话锁）"""
         try:
             # 更新交互时间（用于IdleProcessor）
             self.update_interaction_time()
@@ -49,14 +251,14 @@ class ConversationHandlerAdapter:
             start_time = datetime.now() if enable_timing else None
             
             # 获取当前对话历史（用于后处理）
-            memory_instance = get_memory_for_session(self.session_id)
+            memory_instance = get_memory_for_session(session_id)
             history_before_turn = memory_instance.messages.copy()
             
             # 调用重构后的主对话链，获取AI回复
             full_response = ""
             async for chunk in final_chain.astream(
                 {"user_input": user_message},
-                config={"configurable": {"session_id": self.session_id}}
+                config={"configurable": {"session_id": session_id}}
             ):
                 full_response += chunk
             
@@ -107,7 +309,8 @@ class ConversationHandlerAdapter:
                 "processing_time": None
             }
     
-    async def get_response_stream(self, user_message: str, enable_timing: bool = False):
+    async def get_response_stream(self, user_message: str, enable_timing: bool = False,
+                                  session_id: Optional[str] = None):
         """
         获取AI回复流式输出（新增流式接口）
         目前主要的输出方法
@@ -115,10 +318,71 @@ class ConversationHandlerAdapter:
         Args:
             user_message: 用户消息
             enable_timing: 是否启用时间统计
+            session_id: 会话 ID（为空时使用默认会话）
             
         Yields:
             流式响应数据块
         """
+        session_id = self.resolve_session_id(session_id)
+        batch, leader = self._join_batch(session_id, user_message)
+        if not leader:
+            # 已并入同一会话中尚未开始的回合，回复内容由该回合的流输出
+            try:
+                await asyncio.shield(batch.result)
+            except SessionBusyError as e:
+                yield {
+                    "type": "error",
+                    "error": "session_busy",
+                    "message": str(e),
+                    "turn_id": batch.id,
+                    "timestamp": datetime.now().isoformat()
+                }
+                return
+            except Exception as e:
+                # 合并回合失败（处理出错或 leader 提前断开）：该消息并未得到回复
+                print(f"⚠️ 合并回合 {batch.id} 未完成: {e}")
+                yield {
+                    "type": "error",
+                    "error": "对话处理失败",
+                    "message": "抱歉，我刚才走神了...能再说一遍吗？ 😅",
+                    "turn_id": batch.id,
+                    "timestamp": datetime.now().isoformat()
+                }
+                return
+            yield {
+                "type": "coalesced",
+                "message": "该消息已与同一会话中的其他消息合并回复",
+                "turn_id": batch.id,
+                "timestamp": datetime.now().isoformat()
+            }
+            yield {"type": "end", "timestamp": datetime.now().isoformat()}
+            return
+
+        try:
+            async with self.session_turn(session_id):
+                merged_message = await self._close_batch(session_id, batch)
+                async for chunk in self._respond_stream(merged_message, enable_timing, session_id):
+                    if chunk["type"] == "metadata":
+                        chunk["merged_messages"] = len(batch.messages)
+                        chunk["user_messages"] = list(batch.messages)
+                        batch.finish({"response": chunk["full_response"], "commands": chunk["commands"],
+                                      "processing_time": chunk["processing_time"],
+                                      "user_messages": chunk["user_messages"]})
+                    yield chunk
+        except SessionBusyError as e:
+            self._abandon_batch(session_id, batch, e)
+            yield {
+                "type": "error",
+                "error": "session_busy",
+                "message": str(e),
+                "timestamp": datetime.now().isoformat()
+            }
+        finally:
+            # 流被客户端提前关闭或处理出错时，让等待中的 follower 结束
+            self._abandon_batch(session_id, batch, RuntimeError("合并回合未完成"))
+
+    async def _respond_stream(self, user_message: str, enable_timing: bool, session_id: str):
+        """流式回合的实际处理（调用方已持有会话锁）"""
         try:
             # 更新交互时间（用于IdleProcessor）
             self.update_interaction_time()
@@ -126,36 +390,45 @@ class ConversationHandlerAdapter:
             start_time = datetime.now() if enable_timing else None
             
             # 获取当前对话历史（用于后处理）
-            memory_instance = get_memory_for_session(self.session_id)
+            memory_instance = get_memory_for_session(session_id)
             history_before_turn = memory_instance.messages.copy()
             
-            full_response = ""
+            response_parts: List[str] = []
             chunk_count = 0
+            coalescer = TokenCoalescer()
             
-            # 流式输出AI回复
+            # 流式输出AI回复（相邻 token 按配置合并后成帧）
             async for chunk in final_chain.astream(
                 {"user_input": user_message},
-                config={"configurable": {"session_id": self.session_id}}
+                config={"configurable": {"session_id": session_id}}
             ):
-                chunk_count += 1
-                print(f"[DEBUG] 收到流式块 {chunk_count}: '{chunk}' (类型: {type(chunk)}, 长度: {len(str(chunk))})")
-                
-                # 确保 chunk 是字符串
-                chunk_str = str(chunk) if chunk is not None else ""
-                full_response += chunk_str
-                
-                # 只有当块非空时才发送
-                if chunk_str:
+                chunk_str = chunk if isinstance(chunk, str) else ("" if chunk is None else str(chunk))
+                if not chunk_str:
+                    continue
+                response_parts.append(chunk_str)
+                text = coalescer.push(chunk_str)
+                if text is not None:
+                    chunk_count += 1
                     yield {
                         "type": "content",
-                        "content": chunk_str,
+                        "content": text,
                         "chunk_id": chunk_count,
                         "timestamp": datetime.now().isoformat()
                     }
-                else:
-                    print(f"[DEBUG] 跳过空块 {chunk_count}")
             
-            print(f"[DEBUG] 流式处理完成，总共 {chunk_count} 块，完整回复长度: {len(full_response)}")
+            tail = coalescer.flush()
+            if tail:
+                chunk_count += 1
+                yield {
+                    "type": "content",
+                    "content": tail,
+                    "chunk_id": chunk_count,
+                    "timestamp": datetime.now().isoformat()
+                }
+            
+            full_response = "".join(response_parts)
+            if STREAM_DEBUG:
+                stream_debug(f"会话 {session_id} 流式处理完成：{len(response_parts)} 个 token，{chunk_count} 帧，回复长度 {len(full_response)}")
             
             # 执行同步后处理（状态更新）
             try:
@@ -246,13 +519,17 @@ class ConversationHandlerAdapter:
     def start_background_tasks(self):
         """启动后台任务（包括IdleProcessor）"""
         if not self.background_tasks_running:
+            # 多进程部署时只由一个 worker 运行 IdleProcessor，避免重复整理记忆缓存
+            if not get_shared_state().try_acquire_leadership("idle_processor"):
+                print("ℹ️ IdleProcessor 已由其他 worker 运行，本进程跳过")
+                return
             self.background_tasks_running = True
             
-            # 启动IdleProcessor - 20分钟空闲后处理记忆缓存
+            # 启动IdleProcessor - 20分钟空闲（或缓存积累到阈值后短暂安静）时处理记忆缓存
             self.idle_processor = IdleProcessor(idle_threshold_seconds=1200)
             self.idle_processor.start()
             
-            print("✅ 后台任务启动完成 - IdleProcessor已启动（20分钟空闲阈值）")
+            print(f"✅ 后台任务启动完成 - IdleProcessor已启动（20分钟空闲阈值，缓存阈值 {self.idle_processor.cache_threshold} 条）")
         else:
             print("⚠️  后台任务已在运行中")
     
@@ -275,3 +552,10 @@ class ConversationHandlerAdapter:
         """更新最后交互时间（用于IdleProcessor计时）"""
         if self.idle_processor and self.background_tasks_running:
             self.idle_processor.update_last_interaction_time()
+            return
+        state = get_shared_state()
+        now = time.monotonic()
+        if state.shared and now - self._last_activity_publish >= ACTIVITY_PUBLISH_INTERVAL:
+            # IdleProcessor 运行在其他 worker 中：转发互动信号，使其暂停整理并重新计时
+            self._last_activity_publish = now
+            state.publish(USER_ACTIVITY_CHANNEL, {"origin": os.getpid()})
@@ -13,6 +13,7 @@ class ChatRequest(BaseModel):
     message: str
     enable_timing: bool = True
     stream: bool = False  
+    session_id: Optional[str] = None  # 会话ID，为空时使用服务端默认会话
 
 
 class ChatResponse(BaseModel):
@@ -22,11 +23,12 @@ class ChatResponse(BaseModel):
     emotional_state: Optional[Dict[str, Any]] = None
     processing_time: Optional[float] = None
     commands: Optional[List[Dict[str, Any]]] = None  
+    user_messages: Optional[List[str]] = None  # 本回合回复的全部用户消息（多条消息被合并为一个回合时）
 
 
 class StreamChunk(BaseModel):
     """流式响应数据块模型"""
-    type: str  # "content", "metadata", "end", "error"
+    type: str  # "content", "metadata", "end", "error", "coalesced"
     content: Optional[str] = None  # 内容块（type="content"时使用）
     chunk_id: Optional[int] = None  # 块ID
     emotional_state: Optional[Dict[str, Any]] = None  # 情感状态（type="metadata"时使用）
@@ -34,6 +36,8 @@ class StreamChunk(BaseModel):
     processing_time: Optional[float] = None  # 处理时间
     full_response: Optional[str] = None  # 完整响应（type="metadata"时使用）
     total_chunks: Optional[int] = None  # 总块数
+    merged_messages: Optional[int] = None  # 合并进本回合的消息数（type="metadata"时使用）
+    user_messages: Optional[List[str]] = None  # 本回合回复的全部用户消息（type="metadata"时使用）
     error: Optional[str] = None  # 错误类型（type="error"时使用）
     message: Optional[str] = None  # 错误消息（type="error"时使用）
     timestamp: str
@@ -54,6 +58,7 @@ class ChatHistoryItem(BaseModel):
     ai_response: str
     timestamp: datetime
     emotional_state: Optional[Dict[str, Any]] = None
+    session_id: Optional[str] = None
 
 
 class ChatHistory(BaseModel):
@@ -61,6 +66,7 @@ class ChatHistory(BaseModel):
     items: List[ChatHistoryItem]
     total_count: int
     has_more: bool
+    next_cursor: Optional[int] = None  # 下一页的游标（传给 cursor 参数），为空表示没有更多记录
 
 
 # ===== 配置管理相关模型 =====
@@ -117,6 +123,7 @@ class HealthStatus(BaseModel):
     version: str = "1.0.0"
     uptime: float
     services: Dict[str, str]
+    components: Dict[str, Dict[str, Any]] = {}  # 组件就绪详情（状态、耗时、错误）
 
 
 class ErrorResponse(BaseModel):
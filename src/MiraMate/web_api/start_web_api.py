@@ -8,6 +8,7 @@ from pathlib import Path
 
 import shutil
 import importlib
+import importlib.util
 
 # Docker环境适配
 def get_project_root():
@@ -34,7 +35,7 @@ if str(project_root) not in sys.path:
 from MiraMate.modules.settings import get_server
 
 def check_dependencies():
-    """轻量依赖检查：通过导入探测所需模块，提供安装指引，不在运行时安装。"""
+    """轻量依赖检查：探测所需模块是否已安装，提供安装指引，不在运行时安装。"""
     # Docker 环境中跳过依赖检查（镜像构建阶段已安装）
     if os.getenv('DOCKER_ENV'):
         print("📦 Docker环境，跳过依赖检查…")
@@ -57,9 +58,10 @@ def check_dependencies():
     missing_optional = []
 
     def _try_import(mod: str) -> bool:
+        # 只定位模块而不真正导入：chromadb / sentence_transformers（torch）导入耗时数秒，
+        # 真正的加载交给服务启动后的后台预热
         try:
-            importlib.import_module(mod)
-            return True
+            return importlib.util.find_spec(mod) is not None
         except Exception:
             return False
 
@@ -155,12 +157,28 @@ def start_server():
     """启动Web API服务器"""
     try:
         import uvicorn
-        from MiraMate.web_api.web_api import app
         
         # 从环境变量获取配置
         srv = get_server()
         host = srv.get('HOST', '0.0.0.0')
         port = int(srv.get('PORT', 8000))
+        workers = max(1, int(os.getenv('MIRAMATE_WEB_WORKERS', '1')))
+        # WebSocket 协议层 ping/pong（由 uvicorn 发送），与应用层心跳共用间隔；0 表示关闭
+        ws_ping_interval = float(os.getenv('MIRAMATE_WS_HEARTBEAT_INTERVAL', '20')) or None
+        if workers > 1:
+            # 向量库只能由一个进程持有：多个 worker 必须连接独立的 Chroma 服务；
+            # 画像 / 标签 / 关注事件依赖 SQLite 状态存储在各 worker 间同步
+            if not os.getenv('MIRAMATE_CHROMA_HOST', '').strip():
+                print("❌ 多进程模式需要独立的 Chroma 服务：请先运行 `chroma run --path <记忆目录>/chroma_db`，"
+                      "并设置 MIRAMATE_CHROMA_HOST / MIRAMATE_CHROMA_PORT")
+                return
+            if os.getenv('MIRAMATE_STATE_BACKEND', 'sqlite').strip().lower() != 'sqlite':
+                print("❌ 多进程模式需要 SQLite 状态存储，请移除 MIRAMATE_STATE_BACKEND=json")
+                return
+            # 多个 worker 必须共用跨进程的共享状态后端（子进程继承此环境变量）
+            if os.getenv('MIRAMATE_SHARED_STATE', 'memory').strip().lower() == 'memory':
+                os.environ['MIRAMATE_SHARED_STATE'] = 'sqlite'
+            print(f"🧵 多进程模式: {workers} 个 worker，共享状态后端: {os.environ['MIRAMATE_SHARED_STATE']}")
         
         print(f"\n🚀 启动情感陪伴AI Web API服务器...")
         print("=" * 50)
@@ -171,13 +189,28 @@ def start_server():
         print("=" * 50)
         print("按 Ctrl+C 停止服务器\n")
         
-        # 直接传递app对象
-        uvicorn.run(
-            app,
-            host=host,
-            port=port,
-            log_level="info"
-        )
+        if workers > 1:
+            # 多 worker 时 uvicorn 需要以导入字符串的形式加载应用
+            uvicorn.run(
+                "MiraMate.web_api.web_api:app",
+                host=host,
+                port=port,
+                workers=workers,
+                ws_ping_interval=ws_ping_interval,
+                ws_ping_timeout=ws_ping_interval,
+                log_level="info"
+            )
+        else:
+            from MiraMate.web_api.web_api import app
+            # 直接传递app对象
+            uvicorn.run(
+                app,
+                host=host,
+                port=port,
+                ws_ping_interval=ws_ping_interval,
+                ws_ping_timeout=ws_ping_interval,
+                log_level="info"
+            )
         
     except KeyboardInterrupt:
         print("\n👋 服务器已停止")
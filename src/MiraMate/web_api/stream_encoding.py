@@ -0,0 +1,102 @@
+"""
+流式输出编码
+- 内容帧是流式回复中数量最多的帧：使用预先拼好的 SSE 模板，只对变化的 content 字段做一次 JSON 字符串转义
+  （json.encoder 的 C 实现），不再为每个 token 构造字典再整体 json.dumps
+- 调试输出由 MIRAMATE_STREAM_DEBUG 控制，默认关闭；热路径上只剩一次模块常量判断，不再逐块写 stdout
+- TokenCoalescer 按时间窗口 / 字符数合并相邻 token，减少每条回复的帧数（SSE 与 WebSocket 共用）：
+    MIRAMATE_STREAM_COALESCE_MS     合并窗口（毫秒），例如 30；0 表示不按时间合并
+    MIRAMATE_STREAM_COALESCE_CHARS  缓冲达到该字符数时立即发送；0 表示不按长度合并
+  两者均为 0（默认）时每个 token 单独成帧，与原行为一致
+"""
+import json
+import os
+import time
+from json.encoder import encode_basestring
+from typing import Any, Dict, List, Optional
+
+STREAM_DEBUG = os.getenv("MIRAMATE_STREAM_DEBUG", "0").strip().lower() in ("1", "true", "yes", "on")
+STREAM_COALESCE_MS = float(os.getenv("MIRAMATE_STREAM_COALESCE_MS", "0"))
+STREAM_COALESCE_CHARS = int(os.getenv("MIRAMATE_STREAM_COALESCE_CHARS", "0"))
+
+# 内容帧模板：字段顺序与原先 json.dumps(dict) 的输出保持一致，客户端无需改动
+_CONTENT_FRAME_HEAD = 'data: {"type": "content", "content": '
+_CONTENT_FRAME_ID = ', "chunk_id": '
+_CONTENT_FRAME_TS = ', "timestamp": "'
+_CONTENT_FRAME_TAIL = '"}\n\n'
+
+
+def stream_debug(message: str):
+    """流式调试输出；调用方应先判断 STREAM_DEBUG，避免在关闭时仍构造格式化字符串。"""
+    print(f"[STREAM] {message}")
+
+
+def sse_content_frame(content: str, chunk_id: int, timestamp: str) -> str:
+    """按模板拼接内容帧（content 经 JSON 转义，其余字段为已知安全的数字 / ISO 时间）。"""
+    return (
+        _CONTENT_FRAME_HEAD + encode_basestring(content)
+        + _CONTENT_FRAME_ID + str(chunk_id)
+        + _CONTENT_FRAME_TS + timestamp
+        + _CONTENT_FRAME_TAIL
+    )
+
+
+def sse_frame(payload: Dict[str, Any]) -> str:
+    """通用帧（元数据 / 结束 / 错误等低频帧）。"""
+    return f"data: {json.dumps(payload, ensure_ascii=False, default=str)}\n\n"
+
+
+def encode_sse_chunk(chunk: Dict[str, Any]) -> str:
+    """把适配器产出的流式块编码为 SSE 帧，内容帧走模板快路径。"""
+    if chunk.get("type") == "content":
+        return sse_content_frame(chunk["content"], chunk["chunk_id"], chunk["timestamp"])
+    return sse_frame(chunk)
+
+
+class TokenCoalescer:
+    """
+    相邻 token 合并缓冲。push() 返回需要立即发送的合并文本（未到阈值时返回 None），
+    流结束时调用 flush() 取出剩余内容。
+    时间窗口在下一个 token 到达时检查：合并只会推迟已缓冲的文本，最长不超过相邻 token 的到达间隔。
+    """
+
+    __slots__ = ("interval", "max_chars", "_parts", "_size", "_started")
+
+    def __init__(self, interval_ms: float = STREAM_COALESCE_MS, max_chars: int = STREAM_COALESCE_CHARS):
+        self.interval = max(0.0, interval_ms) / 1000.0
+        self.max_chars = max(0, max_chars)
+        self._parts: List[str] = []
+        self._size = 0
+        self._started = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0 or self.max_chars > 0
+
+    def push(self, text: str) -> Optional[str]:
+        if not self.enabled:
+            return text
+        if not self._parts:
+            self._started = time.monotonic()
+        self._parts.append(text)
+        self._size += len(text)
+        if self.max_chars and self._size >= self.max_chars:
+            return self.flush()
+        if self.interval and time.monotonic() - self._started >= self.interval:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        self._parts.clear()
+        self._size = 0
+        return text
+
+
+def describe_stream_encoding() -> Dict[str, Any]:
+    return {
+        "debug": STREAM_DEBUG,
+        "coalesce_ms": STREAM_COALESCE_MS,
+        "coalesce_chars": STREAM_COALESCE_CHARS,
+    }
@@ -8,9 +8,10 @@ import sys
 import time
 import json
 import uuid
+import asyncio
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, TYPE_CHECKING
 from contextlib import asynccontextmanager
 
 # 添加项目根目录到Python路径
@@ -45,9 +46,14 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.encoders import jsonable_encoder
 import logging
 
-from MiraMate.web_api.conversation_adapter import ConversationHandlerAdapter
+from MiraMate.modules.startup import components, READY, FAILED, SKIPPED
+from MiraMate.modules import registry
+from MiraMate.modules.async_runtime import loop_lag_monitor, shutdown_blocking_executor, run_blocking
+from MiraMate.modules.shared_state import get_shared_state
+from MiraMate.modules.chat_history import create_history_store
 from MiraMate.web_api.config_manager import ConfigManager
 from MiraMate.web_api.websocket_handler import ws_manager, proactive_service, start_proactive_service
+from MiraMate.web_api.stream_encoding import STREAM_DEBUG, stream_debug, encode_sse_chunk, sse_frame, describe_stream_encoding
 from MiraMate.web_api import auth
 from MiraMate.web_api.models import (
     ChatRequest, ChatResponse, EmotionalState, 
@@ -56,20 +62,80 @@ from MiraMate.web_api.models import (
     ConfigResponse, StreamChunk
 )
 
+if TYPE_CHECKING:
+    # 对话适配器会连带导入整个对话管线，改为在后台预热阶段导入
+    from MiraMate.web_api.conversation_adapter import ConversationHandlerAdapter
+
+# 需要预热的重量级组件（LLM 客户端、ChromaDB + 嵌入模型、对话管线）
+WARMUP_COMPONENTS = ("llms", "memory_system", "conversation_handler")
+
 
 class WebAPIServer:
     """Web API 服务器类"""
     
     def __init__(self):
-        self.conversation_handler: Optional[ConversationHandlerAdapter] = None
+        self.conversation_handler: Optional["ConversationHandlerAdapter"] = None
+        self._warmup_task: Optional[asyncio.Task] = None
+        self._reload_lock: Optional[asyncio.Lock] = None
         self.start_time = time.time()
-        self.chat_history: List[ChatHistoryItem] = []
+        self.shared_state = get_shared_state()
         self.max_history_size = 1000
+        # 聊天记录：单进程时为环形缓冲 + 分段持久化日志，多进程部署时保存在共享状态后端中
+        self.history = create_history_store(self.shared_state, self.max_history_size)
         # 传递项目根目录给配置管理器
         self.config_manager = ConfigManager(project_root)
         
+    def add_history(self, item: ChatHistoryItem):
+        """追加一条聊天记录（内存中最多保留 max_history_size 条，更早的记录保存在持久化日志中）。"""
+        self.history.append(item.model_dump(mode="json"))
+
+    def history_count(self) -> int:
+        return self.history.count()
+
     async def initialize(self):
-        """初始化ConversationHandler和WebSocket服务"""
+        """
+        启动时调用：只登记组件并在后台启动预热任务，立即返回，使服务器尽快开始监听端口。
+        预热完成前，聊天接口返回"正在初始化"的提示，/api/health 按组件报告加载进度。
+        """
+        components.register(*WARMUP_COMPONENTS)
+        loop_lag_monitor.start()
+        await ws_manager.start_fanout()
+        ws_manager.start_heartbeat()
+        self._warmup_task = asyncio.create_task(self.warm_up())
+
+    async def reload(self) -> bool:
+        """
+        配置变更后重建对话处理器：取消进行中的预热，停止当前处理器的后台任务（IdleProcessor），
+        再等待新的预热完成。并发调用依次执行。返回新的处理器是否就绪。
+        """
+        if self._reload_lock is None:
+            self._reload_lock = asyncio.Lock()
+        async with self._reload_lock:
+            task, self._warmup_task = self._warmup_task, None
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+            handler, self.conversation_handler = self.conversation_handler, None
+            if handler is not None:
+                # 先停掉旧的 IdleProcessor，避免新旧两个调度器同时整理同一批缓存、互相覆盖检查点
+                handler.stop_background_tasks()
+            self._warmup_task = asyncio.create_task(self.warm_up())
+            await asyncio.shield(self._warmup_task)
+            return self.conversation_handler is not None
+
+    @property
+    def warming_up(self) -> bool:
+        return self._warmup_task is not None and not self._warmup_task.done()
+
+    async def warm_up(self):
+        """
+        分阶段预热（重量级构建都在线程池中执行，不阻塞事件循环）：
+        1. 并行加载 LLM 客户端与记忆系统（ChromaDB + 嵌入模型）
+        2. 导入对话管线并创建 ConversationHandlerAdapter，启动后台任务
+        """
         try:
             # 使用新的配置文件名称和路径
             config_path = os.path.join(
@@ -78,28 +144,58 @@ class WebAPIServer:
             )
             
             # 检查配置文件是否有有效的API密钥
-            if self._has_valid_api_keys(config_path):
-                # 使用新的适配器替代原有的ConversationHandler
-                self.conversation_handler = ConversationHandlerAdapter(config_path)
-                
-                # 启动后台任务
-                self.conversation_handler.start_background_tasks()
-                
-                print(f"✅ ConversationHandlerAdapter初始化成功")
-                print(f"✅ 配置文件: {config_path}")
-            else:
+            if not self._has_valid_api_keys(config_path):
                 print(f"⚠️  API配置不完整，ConversationHandler暂未初始化")
                 print(f"💡 可通过Web界面配置API密钥后重启服务")
+                for name in WARMUP_COMPONENTS:
+                    components.mark(name, SKIPPED, error="needs_configuration")
                 self.conversation_handler = None
+                return
+
+            warmup_start = time.perf_counter()
+
+            def _load_llms():
+                from MiraMate.modules.llms import get_llms
+                main_llm, small_llm = get_llms()
+                if main_llm is None or small_llm is None:
+                    raise RuntimeError("LLM 加载失败")
+
+            def _load_memory_system():
+                from MiraMate.modules.memory_system import get_memory_system
+                get_memory_system()
+
+            # 阶段 1：两类重量级组件互不依赖，并行加载
+            await asyncio.gather(asyncio.to_thread(_load_llms), asyncio.to_thread(_load_memory_system))
+
+            # 阶段 2：对话管线（此时各依赖已就绪，导入只会组装链）
+            def _build_handler():
+                from MiraMate.web_api.conversation_adapter import ConversationHandlerAdapter
+                return ConversationHandlerAdapter(config_path)
+
+            with components.track("conversation_handler"):
+                handler = await asyncio.to_thread(_build_handler)
+                # 启动后台任务
+                handler.start_background_tasks()
+            self.conversation_handler = handler
+
+            print(f"✅ ConversationHandlerAdapter初始化成功（预热耗时 {time.perf_counter() - warmup_start:.1f}s）")
+            process_footprint = registry.footprint_report()["process"]
+            print(f"📊 进程内存: RSS {process_footprint['rss_mb']} MB，峰值 {process_footprint['peak_rss_mb']} MB")
+            print(f"✅ 配置文件: {config_path}")
             
             # TODO: 主动消息功能未完成，暂时禁用
             # # 启动WebSocket主动消息服务
             # await start_proactive_service()
             # print(f"✅ WebSocket主动消息服务启动成功")
             
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             print(f"⚠️  服务初始化失败: {e}")
-            print(f"💡 Web服务器仍将启动，可通过界面配置后重启")
+            print(f"💡 Web服务器仍在运行，可通过界面配置后重启")
+            for name in WARMUP_COMPONENTS:
+                if components.status(name) not in (READY, FAILED):
+                    components.mark(name, FAILED, error=str(e))
             self.conversation_handler = None
     
     def _has_valid_api_keys(self, config_path: str) -> bool:
@@ -137,13 +233,19 @@ class WebAPIServer:
     
     async def cleanup(self):
         """清理资源"""
+        if self.warming_up:
+            self._warmup_task.cancel()
         if self.conversation_handler:
             self.conversation_handler.stop_background_tasks()
             print("✅ 后台任务已停止")
+        await loop_lag_monitor.stop()
+        shutdown_blocking_executor()
+        self.history.close()
         
         # 停止WebSocket主动消息服务
         from MiraMate.web_api.websocket_handler import proactive_service
         await proactive_service.stop()
+        await ws_manager.stop_heartbeat()
         print("✅ WebSocket服务已停止")
 
 
@@ -213,9 +315,8 @@ async def websocket_endpoint(websocket: WebSocket):
     
     try:
         while True:
-            # 接收客户端消息
-            data = await websocket.receive_text()
-            message = ws_manager.validate_message(data)
+            # 接收客户端消息（文本帧，或二进制协议下的二进制帧）
+            message = await ws_manager.receive_message(websocket)
             
             if not message:
                 await ws_manager.send_message(websocket, {
@@ -243,8 +344,9 @@ async def handle_websocket_message(websocket: WebSocket, message: dict):
     
     try:
         if message_type == "chat":
-            # 处理聊天消息
-            await handle_chat_message(websocket, message_data)
+            # 处理聊天消息：会话 ID 取自消息本身，其次取自连接 URL 的 session_id 参数
+            session_id = message.get("session_id") or websocket.query_params.get("session_id")
+            await handle_chat_message(websocket, message_data, session_id)
             
         elif message_type == "ping":
             # 处理心跳检测
@@ -253,6 +355,10 @@ async def handle_websocket_message(websocket: WebSocket, message: dict):
                 "timestamp": time.time()
             })
             
+        elif message_type == "pong":
+            # 客户端应答服务端心跳，用于计算往返时延
+            ws_manager.record_pong(websocket, message)
+            
         elif message_type == "get_emotional_state":
             # 获取情感状态
             await handle_emotional_state_request(websocket)
@@ -274,7 +380,7 @@ async def handle_websocket_message(websocket: WebSocket, message: dict):
         })
 
 
-async def handle_chat_message(websocket: WebSocket, user_message: str):
+async def handle_chat_message(websocket: WebSocket, user_message: str, session_id: Optional[str] = None):
     """处理聊天消息 - 使用流式输出"""
     if not user_message.strip():
         await ws_manager.send_message(websocket, {
@@ -292,11 +398,22 @@ async def handle_chat_message(websocket: WebSocket, user_message: str):
     proactive_service.update_last_message_time()
     
     if server.conversation_handler:
+        try:
+            session_id = server.conversation_handler.resolve_session_id(session_id)
+        except ValueError as e:
+            await ws_manager.send_message(websocket, {
+                "type": "error",
+                "data": str(e),
+                "timestamp": time.time()
+            })
+            return
         try:
             # 使用流式处理
-            full_response = ""
+            response_parts = []
             emotional_state = None
             commands = []
+            # 本回合回复的用户消息（开启合并时可能包含同一会话中随后到达的消息）
+            user_messages = [user_message]
             start_time = datetime.now()
             
             # 发送开始流式传输消息
@@ -305,51 +422,45 @@ async def handle_chat_message(websocket: WebSocket, user_message: str):
                 "timestamp": time.time()
             })
             
-            async for chunk_data in server.conversation_handler.get_response_stream(user_message, enable_timing=True):
+            async for chunk_data in server.conversation_handler.get_response_stream(
+                user_message, enable_timing=True, session_id=session_id
+            ):
                 chunk_type = chunk_data.get('type')
                 
                 if chunk_type == "content":
                     # 累积完整响应
                     content = chunk_data.get('content', '')
-                    full_response += content
+                    response_parts.append(content)
                     
-                    # 发送内容块
-                    await ws_manager.send_message(websocket, {
-                        "type": "chat_stream_chunk",
-                        "data": {
-                            "content": content,
-                            "chunk_id": chunk_data.get('chunk_id')
-                        },
-                        "timestamp": time.time()
-                    })
+                    # 发送内容块（放入连接发送队列，慢客户端不阻塞回复生成）
+                    await ws_manager.send_stream_chunk(websocket, content, chunk_data.get('chunk_id'))
                     
                 elif chunk_type == "metadata":
                     emotional_state = chunk_data.get('emotional_state')
                     commands = chunk_data.get('commands', [])
+                    user_messages = chunk_data.get('user_messages') or user_messages
                     
                 elif chunk_type == "end":
-                    # 发送完整响应（兼容原有客户端）
-                    await ws_manager.send_message(websocket, {
-                        "type": "chat_response",
-                        "data": {
-                            "response": full_response,
-                            "emotional_state": emotional_state,
-                            "commands": commands
-                        },
-                        "timestamp": time.time()
-                    })
+                    # 旧版协议再发送完整回复（兼容原有客户端），紧凑协议只发送结束消息
+                    await ws_manager.send_stream_end(
+                        websocket, "".join(response_parts), emotional_state, commands, len(response_parts)
+                    )
+                    break
                     
-                    # 发送流结束消息
+                elif chunk_type == "coalesced":
+                    # 该消息已并入同一会话的上一个回合，回复由那个回合输出
                     await ws_manager.send_message(websocket, {
                         "type": "chat_stream_end",
                         "data": {
-                            "total_response": full_response,
-                            "processing_complete": True
+                            "total_response": "",
+                            "processing_complete": True,
+                            "coalesced": True,
+                            "turn_id": chunk_data.get('turn_id')
                         },
                         "timestamp": time.time()
                     })
                     break
-                    
+
                 elif chunk_type == "error":
                     await ws_manager.send_message(websocket, {
                         "type": "error",
@@ -359,20 +470,18 @@ async def handle_chat_message(websocket: WebSocket, user_message: str):
                     break
             
             # 添加到聊天历史
+            full_response = "".join(response_parts)
             if full_response:
                 history_item = ChatHistoryItem(
                     id=str(uuid.uuid4()),
-                    user_message=user_message,
+                    user_message="\n".join(user_messages),
                     ai_response=full_response,
                     timestamp=start_time,
-                    emotional_state=emotional_state
+                    emotional_state=emotional_state,
+                    session_id=session_id
                 )
                 
-                server.chat_history.append(history_item)
-                
-                # 限制历史记录数量
-                if len(server.chat_history) > server.max_history_size:
-                    server.chat_history = server.chat_history[-server.max_history_size:]
+                server.add_history(history_item)
                 
         except Exception as e:
             logging.error(f"WebSocket聊天处理失败: {e}")
@@ -473,6 +582,31 @@ async def chat_endpoint(request: ChatRequest):
     聊天接口 - 支持流式和非流式输出
     """
     if not server.conversation_handler:
+        if server.warming_up:
+            # 后台预热尚未完成：提示客户端稍后重试，而不是要求重新配置
+            error_detail = {
+                "error": "service_warming_up",
+                "message": "服务正在启动，模型加载中，请稍后再试",
+                "components": components.snapshot()
+            }
+            if request.stream:
+                async def warming_up_stream():
+                    error_chunk = StreamChunk(
+                        type="error",
+                        error="service_warming_up",
+                        message=error_detail["message"],
+                        timestamp=datetime.now().isoformat()
+                    )
+                    yield f"data: {error_chunk.model_dump_json()}\n\n"
+
+                return StreamingResponse(
+                    warming_up_stream(),
+                    media_type="text/event-stream",
+                    status_code=503,
+                    headers={"Retry-After": "5"}
+                )
+            raise HTTPException(status_code=503, detail=error_detail, headers={"Retry-After": "5"})
+
         error_detail = {
             "error": "ConversationHandler未初始化",
             "message": "请先配置API密钥后重启服务",
@@ -503,6 +637,11 @@ async def chat_endpoint(request: ChatRequest):
         else:
             raise HTTPException(status_code=503, detail=error_detail)
     
+    try:
+        request.session_id = server.conversation_handler.resolve_session_id(request.session_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     if request.stream:
         # 流式响应
         return StreamingResponse(
@@ -524,63 +663,58 @@ async def generate_chat_stream(request: ChatRequest):
     try:
         # 记录开始时间用于历史记录
         start_time = datetime.now()
-        full_response = ""
+        response_parts = []
         emotional_state = None
         commands = []
         processing_time = None
+        user_messages = [request.message]
         
-        print(f"[DEBUG] 开始流式处理消息: '{request.message}'")
+        if STREAM_DEBUG:
+            stream_debug(f"开始流式处理消息: '{request.message}'")
         
-        # 发送流式数据
+        # 发送流式数据：内容帧走预序列化模板，其余低频帧整体序列化
         async for chunk_data in server.conversation_handler.get_response_stream(
             request.message,
-            enable_timing=request.enable_timing
+            enable_timing=request.enable_timing,
+            session_id=request.session_id
         ):
-            print(f"[DEBUG] 从适配器收到数据块: {chunk_data}")
-            
-            # 直接使用字典创建 StreamChunk，避免 Pydantic 序列化问题
             chunk_type = chunk_data.get('type')
             
             # 累积完整响应用于历史记录
             if chunk_type == "content":
-                content = chunk_data.get('content', '')
-                full_response += content
-                
+                response_parts.append(chunk_data.get('content', ''))
             elif chunk_type == "metadata":
                 emotional_state = chunk_data.get('emotional_state')
                 commands = chunk_data.get('commands', [])
                 processing_time = chunk_data.get('processing_time')
+                user_messages = chunk_data.get('user_messages') or user_messages
             
-            # 直接序列化字典而不是通过 Pydantic 模型
             try:
-                json_data = json.dumps(chunk_data, ensure_ascii=False)
-                sse_line = f"data: {json_data}\n\n"
-                print(f"[DEBUG] 发送 SSE 数据: {sse_line.strip()}")
-                yield sse_line
+                yield encode_sse_chunk(chunk_data)
             except Exception as e:
-                print(f"[DEBUG] JSON序列化失败: {e}, 数据: {chunk_data}")
+                print(f"⚠️ 流式块序列化失败: {e}")
                 continue
         
-        print(f"[DEBUG] 流式处理完成，完整回复: '{full_response}'")
+        full_response = "".join(response_parts)
+        if STREAM_DEBUG:
+            stream_debug(f"流式处理完成，完整回复: '{full_response}'")
         
         # 添加到聊天历史（在流结束后）
         if full_response:
             chat_id = str(uuid.uuid4())
             chat_item = ChatHistoryItem(
                 id=chat_id,
-                user_message=request.message,
+                user_message="\n".join(user_messages),
                 ai_response=full_response,
                 timestamp=start_time,
-                emotional_state=emotional_state
+                emotional_state=emotional_state,
+                session_id=request.session_id
             )
             
-            server.chat_history.append(chat_item)
-            # 限制历史记录大小
-            if len(server.chat_history) > server.max_history_size:
-                server.chat_history = server.chat_history[-server.max_history_size:]
+            server.add_history(chat_item)
         
     except Exception as e:
-        print(f"[DEBUG] 流式处理异常: {e}")
+        print(f"❌ 流式处理异常: {e}")
         import traceback
         traceback.print_exc()
         
@@ -592,21 +726,23 @@ async def generate_chat_stream(request: ChatRequest):
             "timestamp": datetime.now().isoformat()
         }
         try:
-            json_data = json.dumps(error_data, ensure_ascii=False)
-            yield f"data: {json_data}\n\n"
+            yield sse_frame(error_data)
         except:
             yield f"data: {{\"type\": \"error\", \"message\": \"Unknown error\"}}\n\n"
 
 
 async def handle_non_stream_chat(request: ChatRequest) -> JSONResponse:
     """处理非流式聊天请求（原有逻辑）"""
+    # 此时对话管线已完成预热，导入不会触发重量级加载
+    from MiraMate.web_api.conversation_adapter import SessionBusyError
     try:
         start_time = time.time()
         
         # 获取AI回复（包含视觉效果指令）
         response_data = await server.conversation_handler.get_response_with_commands(
             request.message, 
-            enable_timing=request.enable_timing
+            enable_timing=request.enable_timing,
+            session_id=request.session_id
         )
         
         processing_time = time.time() - start_time
@@ -626,30 +762,33 @@ async def handle_non_stream_chat(request: ChatRequest) -> JSONResponse:
         chat_id = str(uuid.uuid4())
         timestamp = datetime.now()
         
-        # 添加到聊天历史
-        chat_item = ChatHistoryItem(
-            id=chat_id,
-            user_message=request.message,
-            ai_response=ai_response,
-            timestamp=timestamp,
-            emotional_state=emotional_state
-        )
-        
-        server.chat_history.append(chat_item)
-        # 限制历史记录大小
-        if len(server.chat_history) > server.max_history_size:
-            server.chat_history = server.chat_history[-server.max_history_size:]
+        # 添加到聊天历史（合并进其他回合的消息不重复记录回复）
+        if not response_data.get("coalesced"):
+            chat_item = ChatHistoryItem(
+                id=chat_id,
+                # 合并回合记录全部用户消息（与模型看到的输入一致）
+                user_message="\n".join(response_data.get("user_messages") or [request.message]),
+                ai_response=ai_response,
+                timestamp=timestamp,
+                emotional_state=emotional_state,
+                session_id=request.session_id
+            )
+            
+            server.add_history(chat_item)
 
         chat_response = ChatResponse(
             response=ai_response,
             timestamp=timestamp,
             emotional_state=emotional_state,
             processing_time=processing_time if request.enable_timing else None,
-            commands=commands if commands else None
+            commands=commands if commands else None,
+            user_messages=response_data.get("user_messages") if len(response_data.get("user_messages") or []) > 1 else None
         )
         
         return JSONResponse(content=jsonable_encoder(chat_response))
         
+    except SessionBusyError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "2"})
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -685,37 +824,64 @@ async def get_emotional_state():
         )
 
 
+# 超过该条数的分页以分块方式流式输出，避免一次性构造巨大的 JSON 响应体
+HISTORY_STREAM_THRESHOLD = 100
+HISTORY_MAX_PAGE = 5000
+
+
+def _stream_history_page(records: List[dict], total_count: int, next_cursor: Optional[int], batch_size: int = 50):
+    """分块输出与 ChatHistory 相同结构的 JSON"""
+    yield '{"items":['
+    for start in range(0, len(records), batch_size):
+        batch = records[start:start + batch_size]
+        yield ("," if start else "") + ",".join(json.dumps(record, ensure_ascii=False) for record in batch)
+    tail = {"total_count": total_count, "has_more": next_cursor is not None, "next_cursor": next_cursor}
+    yield "]," + json.dumps(tail)[1:]
+
+
 @app.get("/api/chat/history", response_model=ChatHistory)
 async def get_chat_history(
     limit: int = 50,
     offset: int = 0,
-    reverse: bool = True
+    reverse: bool = True,
+    cursor: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    q: Optional[str] = None
 ):
     """
     获取聊天历史记录
     
     Args:
-        limit: 返回记录数量限制 (默认50)
-        offset: 偏移量 (默认0)
+        limit: 返回记录数量限制 (默认50，最大5000；超过100条时分块流式输出)
+        offset: 偏移量 (默认0，未提供 cursor 时使用)
         reverse: 是否倒序返回 (默认True，最新的在前)
+        cursor: 游标，取自上一页响应的 next_cursor
+        since / until: 只返回该时间范围内的记录
+        q: 全文检索关键词（空格分隔，需全部出现在用户消息或回复中）
     """
     try:
-        total_count = len(server.chat_history)
-        
-        # 处理倒序
-        history = list(reversed(server.chat_history)) if reverse else server.chat_history
+        limit = max(0, min(limit, HISTORY_MAX_PAGE))
+        total_count = server.history_count()
         
-        # 应用分页
-        start_idx = offset
-        end_idx = offset + limit
+        # 分页读取（磁盘读取在线程池中执行），成本只与页大小有关
+        records, next_cursor = await run_blocking(
+            server.history.query,
+            cursor=cursor, limit=limit, reverse=reverse,
+            since=since, until=until, text=q, offset=offset
+        )
         
-        items = history[start_idx:end_idx]
-        has_more = end_idx < total_count
+        if len(records) > HISTORY_STREAM_THRESHOLD:
+            return StreamingResponse(
+                _stream_history_page(records, total_count, next_cursor),
+                media_type="application/json"
+            )
         
         return ChatHistory(
-            items=items,
+            items=[ChatHistoryItem(**record) for record in records],
             total_count=total_count,
-            has_more=has_more
+            has_more=next_cursor is not None,
+            next_cursor=next_cursor
         )
         
     except Exception as e:
@@ -731,7 +897,7 @@ async def clear_chat_history():
     清空聊天历史记录
     """
     try:
-        server.chat_history.clear()
+        server.history.clear()
         response_data = {"message": "聊天历史已清空", "timestamp": datetime.now()}
         return JSONResponse(content=jsonable_encoder(response_data))
         
@@ -745,7 +911,7 @@ async def clear_chat_history():
 @app.get("/api/health", response_model=HealthStatus)
 async def health_check():
     """
-    健康检查接口 (包含WebSocket状态)
+    健康检查接口 (包含WebSocket状态与各重量级组件的预热进度)
     """
     uptime = time.time() - server.start_time
     # 检查API配置状态 - 使用新的配置文件路径
@@ -755,8 +921,9 @@ async def health_check():
     )
     has_valid_keys = server._has_valid_api_keys(config_path)
     
+    component_states = components.snapshot()
     services = {
-        "conversation_handler": "healthy" if server.conversation_handler else "not_configured",
+        "conversation_handler": "healthy" if server.conversation_handler else ("warming_up" if server.warming_up else "not_configured"),
         "chat_history": "healthy",
         "api_server": "healthy",
         "api_config": "healthy" if has_valid_keys else "needs_configuration",
@@ -766,15 +933,22 @@ async def health_check():
         "background_tasks": "running" if (server.conversation_handler and server.conversation_handler.background_tasks_running) else "stopped",
         "idle_processor": "active" if (server.conversation_handler and server.conversation_handler.idle_processor) else "inactive"
     }
+    # 各组件就绪状态：pending / loading / ready / failed / skipped
+    for name, state in component_states.items():
+        services[f"component.{name}"] = state["status"]
       # 如果ConversationHandler未初始化但是服务器运行正常，仍然返回部分可用状态
-    overall_status = "healthy" if server.conversation_handler else "partial"
+    if server.conversation_handler:
+        overall_status = "healthy"
+    else:
+        overall_status = "starting" if server.warming_up else "partial"
     
     health_status = HealthStatus(
         status=overall_status,
         timestamp=datetime.now(),
         version="1.0.0",
         uptime=uptime,
-        services=services
+        services=services,
+        components=component_states
     )
     
     # 使用jsonable_encoder确保datetime对象正确序列化
@@ -792,12 +966,19 @@ async def get_stats():
         stats_data = {
             "uptime_seconds": uptime,
             "uptime_formatted": str(timedelta(seconds=int(uptime))),
-            "chat_history_count": len(server.chat_history),
+            "chat_history_count": server.history_count(),
             "max_history_size": server.max_history_size,
+            "chat_history_store": server.history.describe(),
             "conversation_handler_status": "initialized" if server.conversation_handler else "not_initialized",
             "websocket_connections": ws_manager.get_connection_count(),
             "proactive_service_running": proactive_service.is_running,
             "proactive_last_message": proactive_service.last_message_time.isoformat() if hasattr(proactive_service, 'last_message_time') else None,
+            "memory_footprint": await asyncio.to_thread(registry.footprint_report),
+            "event_loop": loop_lag_monitor.snapshot(),
+            "stream_encoding": describe_stream_encoding(),
+            "shared_state": server.shared_state.describe(),
+            "sessions": server.conversation_handler.get_sessions_snapshot() if server.conversation_handler else None,
+            "idle_processor": server.conversation_handler.idle_processor.snapshot() if (server.conversation_handler and server.conversation_handler.idle_processor) else None,
             "timestamp": datetime.now()
         }
         
@@ -821,6 +1002,8 @@ async def get_websocket_status():
             "service_running": True,
             "active_connections": ws_manager.get_connection_count(),
             "max_connections": ws_manager.max_connections,
+            "connections": ws_manager.get_connection_stats(),
+            "connection_list": ws_manager.list_connections(),
             "proactive_service": {
                 "running": proactive_service.is_running,
                 "check_interval": proactive_service.check_interval,
@@ -893,14 +1076,16 @@ async def update_llm_configs(configs: List[LLMConfig]):
         if success:
             # 重新初始化ConversationHandler以使用新配置
             try:
-                await server.initialize()
-                print("✅ 配置更新后ConversationHandler重新初始化成功")
+                ready = await server.reload()
+                init_msg = "系统已重新初始化" if ready else "但系统未能完成初始化，请检查配置"
+                print(f"{'✅' if ready else '⚠️'} 配置更新后ConversationHandler{'重新初始化成功' if ready else '未就绪'}")
             except Exception as e:
+                init_msg = f"重新初始化失败: {e}"
                 print(f"⚠️ 重新初始化ConversationHandler失败: {e}")
             
             return ConfigResponse(
                 success=True,
-                message="LLM配置更新成功，系统已重新初始化",
+                message=f"LLM配置更新成功，{init_msg}",
                 config={"configs": [config.dict() for config in configs]}
             )
         else:
@@ -969,8 +1154,8 @@ async def update_environment_config(config: EnvironmentConfig):
         if success:
             # 保存成功后，立即尝试重新初始化系统，使配置即时生效
             try:
-                await server.initialize()
-                init_msg = "系统已重新初始化"
+                ready = await server.reload()
+                init_msg = "系统已重新初始化" if ready else "但系统未能完成初始化，请检查配置"
             except Exception as e:
                 init_msg = f"重新初始化失败: {e}"
             return ConfigResponse(
@@ -1073,14 +1258,16 @@ async def restore_configs(backup_path: str):
         if success:
             # 重新初始化ConversationHandler以使用恢复的配置
             try:
-                await server.initialize()
-                print("✅ 配置恢复后ConversationHandler重新初始化成功")
+                ready = await server.reload()
+                init_msg = "系统已重新初始化" if ready else "但系统未能完成初始化，请检查配置"
+                print(f"{'✅' if ready else '⚠️'} 配置恢复后ConversationHandler{'重新初始化成功' if ready else '未就绪'}")
             except Exception as e:
+                init_msg = f"重新初始化失败: {e}"
                 print(f"⚠️ 重新初始化ConversationHandler失败: {e}")
             
             return ConfigResponse(
                 success=True,
-                message="配置恢复成功，系统已重新初始化",
+                message=f"配置恢复成功，{init_msg}",
                 config=None
             )
         else:
@@ -1103,11 +1290,12 @@ async def reinitialize_system():
     手动重新初始化系统（在配置更新后使用）
     """
     try:
-        await server.initialize()
+        ready = await server.reload()
         return {
-            "success": True,
-            "message": "系统重新初始化成功",
-            "conversation_handler_status": "initialized" if server.conversation_handler else "not_initialized"
+            "success": ready,
+            "message": "系统重新初始化成功" if ready else "系统重新初始化未完成，请检查配置",
+            "conversation_handler_status": "initialized" if ready else "not_initialized",
+            "components": components.snapshot()
         }
     except Exception as e:
         return {
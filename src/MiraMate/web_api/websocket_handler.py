@@ -4,38 +4,181 @@ WebSocket处理器模块
 """
 
 import json
+import os
 import asyncio
 import time
 import random
+import uuid
+from collections import deque
 from datetime import datetime, timedelta
 from fastapi import WebSocket, WebSocketDisconnect
 from typing import List, Dict, Optional
 import logging
 
+from MiraMate.modules.shared_state import get_shared_state
+from MiraMate.web_api.ws_protocol import WireProtocol, Frame, negotiate
+
 # 配置日志
 logger = logging.getLogger(__name__)
 
+# 多进程部署时跨 worker 广播所用的频道
+BROADCAST_CHANNEL = "ws_broadcast"
+# 每个连接的发送队列上限（帧数）；客户端消费过慢导致队列写满时断开该连接，而不是阻塞生产者
+SEND_QUEUE_SIZE = int(os.getenv("MIRAMATE_WS_SEND_QUEUE", "256"))
+# 最大连接数
+MAX_CONNECTIONS = int(os.getenv("MIRAMATE_WS_MAX_CONNECTIONS", "10"))
+# 广播时单个连接的发送超时（秒）：超时未写出的连接视为失效并移除
+BROADCAST_SEND_TIMEOUT = float(os.getenv("MIRAMATE_WS_BROADCAST_TIMEOUT", "5"))
+# 服务端心跳间隔（秒，0 表示关闭）与超时：应答过服务端 ping 的客户端超过 HEARTBEAT_TIMEOUT 秒未发来任何消息（含 pong）时被回收；
+# 从不应答 ping 的旧客户端只用于测量 / 展示，断线检测交给 uvicorn 的协议层 ping（ws_ping_interval / ws_ping_timeout）
+HEARTBEAT_INTERVAL = float(os.getenv("MIRAMATE_WS_HEARTBEAT_INTERVAL", "20"))
+HEARTBEAT_TIMEOUT = float(os.getenv("MIRAMATE_WS_HEARTBEAT_TIMEOUT", "60"))
+
+
+class _Peer:
+    """单个连接的协议与发送队列：生产者只负责入队，由独立的写任务按顺序发出。"""
+
+    def __init__(self, websocket: WebSocket, protocol: WireProtocol, queue_size: int = SEND_QUEUE_SIZE):
+        self.id = uuid.uuid4().hex[:12]
+        self.connected_at = time.time()
+        self.websocket = websocket
+        self.protocol = protocol
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.writer: Optional[asyncio.Task] = None
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        # 心跳：最近一次收到客户端消息的时间、未应答的 ping 与往返时延
+        self.last_seen = time.monotonic()
+        self.pending_ping: Optional[tuple] = None  # (ping_id, 发送时刻)
+        self.answers_ping = False  # 是否应答过应用层 ping（只有这类客户端才按心跳超时回收）
+        self.rtt_ms: Optional[float] = None
+        self.rtt_avg_ms: Optional[float] = None
+
+    def record_rtt(self, rtt_ms: float):
+        self.rtt_ms = rtt_ms
+        # 指数滑动平均，平滑单次抖动
+        self.rtt_avg_ms = rtt_ms if self.rtt_avg_ms is None else 0.8 * self.rtt_avg_ms + 0.2 * rtt_ms
+
+    def stats(self) -> Dict:
+        return {
+            "id": self.id,
+            "connected_at": self.connected_at,
+            "protocol": self.protocol.name,
+            "queued": self.queue.qsize(),
+            "frames_sent": self.frames_sent,
+            "bytes_sent": self.bytes_sent,
+            "idle_seconds": round(time.monotonic() - self.last_seen, 1),
+            "rtt_ms": round(self.rtt_ms, 2) if self.rtt_ms is not None else None,
+            "rtt_avg_ms": round(self.rtt_avg_ms, 2) if self.rtt_avg_ms is not None else None,
+        }
+
 
 class SimpleWebSocketManager:
     """简单的WebSocket连接管理器"""
     
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self.max_connections = 10  # 最大连接数限制
+    def __init__(self, max_connections: int = MAX_CONNECTIONS):
+        self.connections: Dict[str, _Peer] = {}  # 连接 ID → 连接（协议与发送队列）
+        self._peers: Dict[WebSocket, _Peer] = {}  # WebSocket 对象 → 连接，供按 socket 查找
+        self.max_connections = max_connections  # 最大连接数限制
         self.message_rate_limit: Dict[str, List[float]] = {}  # 消息频率限制
+        self._fanout_enabled = False  # 是否已订阅跨 worker 广播
+        self.slow_client_disconnects = 0
+        self.pruned_connections = 0  # 广播发送超时 / 失败而移除的连接数
+        self._fanout_latency_ms: deque = deque(maxlen=100)  # 最近若干次广播的扇出耗时
+        self.heartbeat_interval = HEARTBEAT_INTERVAL
+        self.heartbeat_timeout = HEARTBEAT_TIMEOUT
+        self.reaped_connections = 0  # 心跳超时被回收的连接数
+        self._heartbeat_task: Optional[asyncio.Task] = None
         
+    async def start_fanout(self):
+        """多进程部署时订阅其他 worker 发出的广播，转发给本进程的连接。"""
+        state = get_shared_state()
+        if state.shared and not self._fanout_enabled:
+            state.subscribe_async(BROADCAST_CHANNEL, self._on_remote_broadcast)
+            self._fanout_enabled = True
+            logger.info("已启用跨 worker WebSocket 广播")
+
+    def start_heartbeat(self):
+        """启动服务端心跳任务（幂等；间隔为 0 时不启动）"""
+        if self.heartbeat_interval <= 0:
+            return
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop(), name="ws-heartbeat")
+            logger.info(f"WebSocket服务端心跳已启动（间隔 {self.heartbeat_interval}s，超时 {self.heartbeat_timeout}s）")
+
+    async def stop_heartbeat(self):
+        task, self._heartbeat_task = self._heartbeat_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat_once()
+            except Exception as e:
+                logger.error(f"WebSocket心跳检查异常: {e}")
+
+    async def heartbeat_once(self):
+        """回收应答过 ping 但已超时无响应的连接，并向其余连接发送 ping"""
+        now = time.monotonic()
+        for peer in list(self.connections.values()):
+            idle = now - peer.last_seen
+            if peer.answers_ping and idle > self.heartbeat_timeout:
+                self.reaped_connections += 1
+                logger.warning(f"WebSocket连接 [{peer.id}] {idle:.0f}s 无响应，回收该连接")
+                self.disconnect(peer.websocket)
+                asyncio.create_task(self._close_quietly(peer.websocket, 1001, "Heartbeat timeout"))
+                continue
+            ping_id = uuid.uuid4().hex[:8]
+            peer.pending_ping = (ping_id, time.perf_counter())
+            await self.send_message(peer.websocket, {
+                "type": "ping",
+                "data": {"id": ping_id},
+                "timestamp": time.time()
+            })
+
+    def record_pong(self, websocket: WebSocket, message: dict):
+        """客户端应答服务端 ping：按 ping id 计算往返时延"""
+        peer = self._peers.get(websocket)
+        if peer is None or peer.pending_ping is None:
+            return
+        data = message.get("data")
+        ping_id, sent_at = peer.pending_ping
+        if isinstance(data, dict) and data.get("id") == ping_id:
+            peer.pending_ping = None
+            peer.answers_ping = True
+            peer.record_rtt((time.perf_counter() - sent_at) * 1000)
+
+    async def _on_remote_broadcast(self, envelope: dict):
+        if envelope.get("origin") != os.getpid():
+            await self._broadcast_local(envelope["message"])
+
     async def connect(self, websocket: WebSocket) -> bool:
         """建立WebSocket连接"""
         try:
             # 检查连接数限制
-            if len(self.active_connections) >= self.max_connections:
+            if len(self.connections) >= self.max_connections:
                 await websocket.close(code=1008, reason="Too many connections")
                 logger.warning(f"连接被拒绝：超过最大连接数限制 ({self.max_connections})")
                 return False
                 
-            await websocket.accept()
-            self.active_connections.append(websocket)
-            logger.info(f"WebSocket连接建立，当前连接数: {len(self.active_connections)}")
+            protocol, subprotocol = negotiate(
+                websocket.scope.get("subprotocols", []),
+                websocket.query_params.get("protocol")
+            )
+            await websocket.accept(subprotocol=subprotocol)
+            peer = _Peer(websocket, protocol)
+            peer.writer = asyncio.create_task(self._writer(peer), name="ws-writer")
+            self._peers[websocket] = peer
+            self.connections[peer.id] = peer
+            if protocol.name != "json":
+                await self.send_message(websocket, {"type": "protocol", "data": protocol.describe()})
+            logger.info(f"WebSocket连接建立 [{peer.id}]（协议 {protocol.name}），当前连接数: {len(self.connections)}")
             return True
             
         except Exception as e:
@@ -44,37 +187,209 @@ class SimpleWebSocketManager:
     
     def disconnect(self, websocket: WebSocket):
         """断开WebSocket连接"""
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-            logger.info(f"WebSocket连接断开，当前连接数: {len(self.active_connections)}")
-    
-    async def send_message(self, websocket: WebSocket, message: dict) -> bool:
-        """向指定WebSocket发送消息"""
+        peer = self._peers.pop(websocket, None)
+        if peer is None:
+            return
+        self.connections.pop(peer.id, None)
+        if peer.writer is not None and peer.writer is not asyncio.current_task():
+            peer.writer.cancel()
+        logger.info(f"WebSocket连接断开 [{peer.id}]，当前连接数: {len(self.connections)}")
+
+    def get_protocol(self, websocket: WebSocket) -> Optional[WireProtocol]:
+        peer = self._peers.get(websocket)
+        return peer.protocol if peer else None
+
+    async def _writer(self, peer: _Peer):
+        """连接的写任务：按入队顺序发送帧，发送失败时移除连接。"""
+        websocket = peer.websocket
+        sent: Optional[asyncio.Future] = None
         try:
-            await websocket.send_text(json.dumps(message, ensure_ascii=False))
-            return True
+            while True:
+                frame = await peer.queue.get()
+                if isinstance(frame, tuple):
+                    # 广播帧附带完成通知，用于发送超时判断与扇出耗时统计
+                    frame, sent = frame
+                if isinstance(frame, bytes):
+                    await websocket.send_bytes(frame)
+                else:
+                    await websocket.send_text(frame)
+                peer.frames_sent += 1
+                peer.bytes_sent += len(frame) if isinstance(frame, bytes) else len(frame.encode("utf-8"))
+                if sent is not None:
+                    if not sent.done():
+                        sent.set_result(True)
+                    sent = None
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             logger.error(f"发送消息失败: {e}")
-            # 如果发送失败，从连接列表中移除
             self.disconnect(websocket)
+        finally:
+            # 连接已失效：通知仍在等待的广播发送
+            pending = [sent] if sent is not None else []
+            while not peer.queue.empty():
+                item = peer.queue.get_nowait()
+                if isinstance(item, tuple):
+                    pending.append(item[1])
+            for future in pending:
+                if not future.done():
+                    future.set_result(False)
+
+    def _enqueue(self, websocket: WebSocket, frame: Frame) -> bool:
+        peer = self._peers.get(websocket)
+        if peer is None:
+            return False
+        try:
+            peer.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            # 客户端读取跟不上：断开该连接，释放缓冲，生产者不被拖慢
+            self.slow_client_disconnects += 1
+            logger.warning(f"WebSocket发送队列已满（{peer.queue.maxsize} 帧），断开过慢的连接")
+            self.disconnect(websocket)
+            asyncio.create_task(self._close_quietly(websocket, 1013, "Client too slow"))
             return False
+
+    @staticmethod
+    async def _close_quietly(websocket: WebSocket, code: int, reason: str):
+        try:
+            await websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    async def send_message(self, websocket: WebSocket, message: dict) -> bool:
+        """向指定WebSocket发送消息（按连接协议编码后放入发送队列，不等待实际写出）"""
+        peer = self._peers.get(websocket)
+        if peer is None:
+            return False
+        try:
+            frame = peer.protocol.encode(message)
+        except Exception as e:
+            logger.error(f"消息编码失败: {e}")
+            return False
+        return self._enqueue(websocket, frame)
+
+    async def send_stream_chunk(self, websocket: WebSocket, content: str, chunk_id: Optional[int] = None) -> bool:
+        """发送流式内容块：紧凑协议只发送增量帧，旧版协议发送完整信封"""
+        peer = self._peers.get(websocket)
+        if peer is None:
+            return False
+        return self._enqueue(websocket, peer.protocol.encode_delta(content, chunk_id))
+
+    async def send_stream_end(self, websocket: WebSocket, full_response: str,
+                              emotional_state: Optional[dict], commands: list, total_chunks: int) -> bool:
+        """发送流结束：旧版协议重复发送完整回复（chat_response + chat_stream_end），紧凑协议只发送一条结束消息"""
+        protocol = self.get_protocol(websocket)
+        if protocol is None:
+            return False
+        if protocol.delta_only:
+            return await self.send_message(websocket, {
+                "type": "chat_stream_end",
+                "data": {
+                    "emotional_state": emotional_state,
+                    "commands": commands,
+                    "total_chunks": total_chunks,
+                    "length": len(full_response),
+                    "processing_complete": True
+                }
+            })
+        # 发送完整响应（兼容原有客户端）
+        await self.send_message(websocket, {
+            "type": "chat_response",
+            "data": {
+                "response": full_response,
+                "emotional_state": emotional_state,
+                "commands": commands
+            },
+            "timestamp": time.time()
+        })
+        return await self.send_message(websocket, {
+            "type": "chat_stream_end",
+            "data": {
+                "total_response": full_response,
+                "processing_complete": True
+            },
+            "timestamp": time.time()
+        })
+
+    async def receive_message(self, websocket: WebSocket) -> Optional[dict]:
+        """接收并验证一条客户端消息（文本或按连接协议解码的二进制帧），格式无效时返回 None"""
+        raw = await websocket.receive()
+        if raw["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(raw.get("code", 1000))
+        peer = self._peers.get(websocket)
+        if peer is not None:
+            # 收到任何消息都说明连接存活
+            peer.last_seen = time.monotonic()
+        if raw.get("text") is not None:
+            return self.validate_message(raw["text"])
+        data = raw.get("bytes") or b""
+        protocol = self.get_protocol(websocket)
+        if protocol is None or not protocol.binary:
+            return self.validate_message(data.decode("utf-8", errors="replace"))
+        if len(data) > 10000:
+            logger.warning("消息过大，拒绝处理")
+            return None
+        try:
+            message = protocol.decode(data)
+        except Exception as e:
+            logger.error(f"二进制消息解析失败: {e}")
+            return None
+        if not isinstance(message, dict) or not isinstance(message.get("type"), str):
+            logger.warning("消息格式错误：缺少type字段")
+            return None
+        return message
     
     async def broadcast(self, message: dict) -> int:
-        """向所有连接广播消息"""
-        if not self.active_connections:
+        """向所有连接广播消息（多进程部署时同时发布给其他 worker），返回本进程内成功发送的连接数"""
+        if self._fanout_enabled:
+            get_shared_state().publish(BROADCAST_CHANNEL, {"origin": os.getpid(), "message": message})
+        return await self._broadcast_local(message)
+
+    async def _broadcast_local(self, message: dict) -> int:
+        """向本进程内的所有连接并发广播消息，发送超时或失败的连接被移除"""
+        if not self.connections:
             logger.debug("没有活跃连接，跳过广播")
             return 0
-            
-        success_count = 0
-        # 复制连接列表，避免在迭代过程中修改
-        connections_copy = self.active_connections.copy()
-        
-        for connection in connections_copy:
-            if await self.send_message(connection, message):
-                success_count += 1
-                
-        logger.info(f"广播消息完成，成功发送到 {success_count}/{len(connections_copy)} 个连接")
+
+        started = time.perf_counter()
+        # 复制连接表，避免在发送过程中被修改；同一协议的连接共用一次编码结果
+        peers = list(self.connections.values())
+        frames: Dict[str, Frame] = {}
+        for peer in peers:
+            if peer.protocol.name not in frames:
+                frames[peer.protocol.name] = peer.protocol.encode(message)
+
+        results = await asyncio.gather(
+            *(self._deliver(peer, frames[peer.protocol.name]) for peer in peers)
+        )
+        success_count = sum(1 for ok in results if ok)
+        latency_ms = (time.perf_counter() - started) * 1000
+        self._fanout_latency_ms.append(latency_ms)
+
+        logger.info(f"广播消息完成，成功发送到 {success_count}/{len(peers)} 个连接，耗时 {latency_ms:.1f}ms")
         return success_count
+
+    async def _deliver(self, peer: _Peer, frame: Frame, timeout: float = BROADCAST_SEND_TIMEOUT) -> bool:
+        """把广播帧放入连接的发送队列并等待写出；超时视为失效连接"""
+        sent = asyncio.get_running_loop().create_future()
+
+        async def _put_and_wait():
+            await peer.queue.put((frame, sent))
+            return await sent
+
+        try:
+            if await asyncio.wait_for(_put_and_wait(), timeout):
+                return True
+        except asyncio.TimeoutError:
+            logger.warning(f"广播发送超时（{timeout}s），移除连接 [{peer.id}]")
+            asyncio.create_task(self._close_quietly(peer.websocket, 1013, "Send timeout"))
+        except Exception as e:
+            logger.error(f"广播发送失败 [{peer.id}]: {e}")
+        if peer.id in self.connections:
+            self.pruned_connections += 1
+            self.disconnect(peer.websocket)
+        return False
     
     def validate_message(self, message_text: str) -> Optional[dict]:
         """验证消息格式"""
@@ -102,7 +417,51 @@ class SimpleWebSocketManager:
     
     def get_connection_count(self) -> int:
         """获取当前连接数"""
-        return len(self.active_connections)
+        return len(self.connections)
+
+    def get_connection_stats(self) -> Dict:
+        """按连接汇总的协议、队列与发送量统计"""
+        peers = list(self.connections.values())
+        protocols: Dict[str, int] = {}
+        for peer in peers:
+            protocols[peer.protocol.name] = protocols.get(peer.protocol.name, 0) + 1
+        return {
+            "protocols": protocols,
+            "send_queue_size": SEND_QUEUE_SIZE,
+            "max_queued": max((p.queue.qsize() for p in peers), default=0),
+            "frames_sent": sum(p.frames_sent for p in peers),
+            "bytes_sent": sum(p.bytes_sent for p in peers),
+            "slow_client_disconnects": self.slow_client_disconnects,
+            "pruned_connections": self.pruned_connections,
+            "heartbeat": self._heartbeat_snapshot(peers),
+            "fanout_latency_ms": self._fanout_latency_snapshot(),
+        }
+
+    def _fanout_latency_snapshot(self) -> Dict:
+        samples = sorted(self._fanout_latency_ms)
+        if not samples:
+            return {"samples": 0}
+        return {
+            "samples": len(samples),
+            "last": round(self._fanout_latency_ms[-1], 2),
+            "p50": round(samples[len(samples) // 2], 2),
+            "max": round(samples[-1], 2),
+        }
+
+    def _heartbeat_snapshot(self, peers: List[_Peer]) -> Dict:
+        rtts = sorted(p.rtt_avg_ms for p in peers if p.rtt_avg_ms is not None)
+        return {
+            "running": self._heartbeat_task is not None and not self._heartbeat_task.done(),
+            "interval": self.heartbeat_interval,
+            "timeout": self.heartbeat_timeout,
+            "reaped_connections": self.reaped_connections,
+            "rtt_p50_ms": round(rtts[len(rtts) // 2], 2) if rtts else None,
+            "rtt_max_ms": round(rtts[-1], 2) if rtts else None,
+        }
+
+    def list_connections(self) -> List[Dict]:
+        """各连接的明细"""
+        return [peer.stats() for peer in self.connections.values()]
 
 # TODO：完善主动消息相关功能，加入llm自主活动、回复
 class ProactiveMessageService:
@@ -0,0 +1,108 @@
+"""
+WebSocket 帧协议
+连接建立时协商（Sec-WebSocket-Protocol 子协议，或连接 URL 参数 ?protocol=）：
+- json     （miramate.json，默认）  旧版 JSON 文本信封，每个内容块都带 type/data/timestamp，
+                                   回复结束时再以 chat_response 与 chat_stream_end 各发送一次完整回复
+- compact  （miramate.compact）     紧凑 JSON 文本：内容块只发送增量 ["c", "文本"]，结束时只发送一条
+                                   chat_stream_end（携带情感状态与指令，不重复完整回复）
+- msgpack  （miramate.msgpack）     与 compact 相同的消息结构，以 msgpack 二进制帧发送（需安装 msgpack，
+                                   未安装时回退为 compact）
+客户端使用非默认协议时，服务端在连接建立后先发送 {"type": "protocol", "data": {...}} 告知实际生效的协议。
+"""
+import json
+import time
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    import msgpack
+except ImportError:  # 可选依赖：pip install -e ".[ws]"
+    msgpack = None
+
+Frame = Union[str, bytes]
+
+SUBPROTOCOL_PREFIX = "miramate."
+# 紧凑协议中内容增量帧的标记
+DELTA_TAG = "c"
+
+
+class WireProtocol:
+    """旧版 JSON 文本协议（默认）。"""
+
+    name = "json"
+    binary = False
+    delta_only = False
+
+    def encode(self, message: Dict[str, Any]) -> Frame:
+        return json.dumps(message, ensure_ascii=False)
+
+    def encode_delta(self, content: str, chunk_id: Optional[int] = None) -> Frame:
+        return self.encode({
+            "type": "chat_stream_chunk",
+            "data": {"content": content, "chunk_id": chunk_id},
+            "timestamp": time.time()
+        })
+
+    def decode(self, data: Frame) -> Any:
+        return json.loads(data)
+
+    def describe(self) -> Dict[str, Any]:
+        return {"name": self.name, "binary": self.binary, "delta_only": self.delta_only}
+
+
+class CompactJsonProtocol(WireProtocol):
+    """紧凑 JSON 文本协议：无多余空白，内容块只发送增量。"""
+
+    name = "compact"
+    delta_only = True
+
+    def encode(self, message: Dict[str, Any]) -> Frame:
+        return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+    def encode_delta(self, content: str, chunk_id: Optional[int] = None) -> Frame:
+        # WebSocket 保证消息有序，chunk_id 由客户端按到达顺序自行推断
+        return self.encode([DELTA_TAG, content])
+
+
+class MsgpackProtocol(CompactJsonProtocol):
+    """msgpack 二进制协议，消息结构与 compact 相同。"""
+
+    name = "msgpack"
+    binary = True
+
+    def encode(self, message: Any) -> Frame:
+        return msgpack.packb(message, use_bin_type=True, default=str)
+
+    def decode(self, data: Frame) -> Any:
+        if isinstance(data, str):
+            # 客户端仍可发送 JSON 文本消息
+            return json.loads(data)
+        return msgpack.unpackb(data, raw=False)
+
+
+PROTOCOLS: Dict[str, WireProtocol] = {
+    "json": WireProtocol(),
+    "compact": CompactJsonProtocol(),
+}
+if msgpack is not None:
+    PROTOCOLS["msgpack"] = MsgpackProtocol()
+
+
+def negotiate(offered: List[str], requested: Optional[str] = None):
+    """
+    选择连接使用的协议，返回 (protocol, subprotocol)。
+    subprotocol 为需要在握手响应中回应的子协议名（客户端未通过子协议协商时为 None）。
+    """
+    for sub in offered or []:
+        if not sub.startswith(SUBPROTOCOL_PREFIX):
+            continue
+        name = sub[len(SUBPROTOCOL_PREFIX):]
+        if name in PROTOCOLS:
+            return PROTOCOLS[name], sub
+    if requested:
+        name = requested.strip().lower()
+        if name == "msgpack" and name not in PROTOCOLS:
+            # 服务端未安装 msgpack：退回到同样只发送增量的紧凑文本协议
+            name = "compact"
+        if name in PROTOCOLS:
+            return PROTOCOLS[name], None
+    return PROTOCOLS["json"], None